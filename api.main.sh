@@ -31,6 +31,7 @@ then
   python3 database/init.py
   exec gunicorn \
     --workers "${DUO_WORKERS:-4}" \
+    --threads "${DUO_THREADS:-1}" \
     --bind "0.0.0.0:$PORT" \
     --timeout 0 \
     service.application:app
@@ -21,6 +21,9 @@ then
   python3 -m pip install -r chat.requirements.txt
 fi
 
+# With DUO_CHAT_WORKERS set (e.g. to 'auto'), each port is served by a
+# supervisor which forks that many workers sharing the port via SO_REUSEPORT,
+# so a single port is usually enough.
 if [ -z "$DUO_CHAT_PORTS" ]
 then
   DUO_CHAT_PORTS='5443'
@@ -1,6 +1,7 @@
 from typing import Any
 import os
 import psycopg
+from psycopg_pool import ConnectionPool
 import random
 import threading
 import time
@@ -11,6 +12,43 @@ DB_PORT = os.environ['DUO_DB_PORT']
 DB_USER = os.environ['DUO_DB_USER']
 DB_PASS = os.environ['DUO_DB_PASS']
 
+POOL_MIN_SIZE = int(os.environ.get('DUO_DB_POOL_MIN_SIZE', '1'))
+POOL_MAX_SIZE = int(os.environ.get('DUO_DB_POOL_MAX_SIZE', '10'))
+
+# How long a transaction waits for a free connection before giving up
+POOL_TIMEOUT_SECONDS = float(os.environ.get(
+    'DUO_DB_POOL_TIMEOUT_SECONDS',
+    str(30),
+))
+
+# Connections are replaced after this long, to avoid long-lived backends
+# accumulating memory on the Postgres side
+POOL_MAX_LIFETIME_SECONDS = float(os.environ.get(
+    'DUO_DB_POOL_MAX_LIFETIME_SECONDS',
+    str(60 * 60), # 1 hour
+))
+
+# Read-only transactions against duo_api are sent to these replicas, given as a
+# space-separated list of `host:port` pairs, e.g. "10.0.0.2:5432 10.0.0.3:5432"
+REPLICA_HOSTS = os.environ.get('DUO_DB_REPLICA_HOSTS', '').split()
+
+# Replicas lagging further than this behind the primary aren't used
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get(
+    'DUO_DB_REPLICA_MAX_LAG_SECONDS',
+    str(5),
+))
+
+REPLICA_POLL_SECONDS = float(os.environ.get(
+    'DUO_DB_REPLICA_POLL_SECONDS',
+    str(5),
+))
+
+# Kept short so that an overloaded replica falls back to the primary quickly
+REPLICA_POOL_TIMEOUT_SECONDS = float(os.environ.get(
+    'DUO_DB_REPLICA_POOL_TIMEOUT_SECONDS',
+    str(1),
+))
+
 _valid_isolation_levels = [
     'SERIALIZABLE',
     'REPEATABLE READ',
@@ -40,107 +78,233 @@ _chat_conninfo = psycopg.conninfo.make_conninfo(
     **(_coninfo_args | dict(dbname='duo_chat'))
 )
 
-_api_conn  = None
-_chat_conn = None
-
-_api_conn_lock  = threading.Lock()
-_chat_conn_lock = threading.Lock()
+def _replica_conninfo(host_port: str):
+    host, _, port = host_port.partition(':')
+
+    return psycopg.conninfo.make_conninfo(
+        **(_coninfo_args | dict(host=host, port=port or DB_PORT, dbname='duo_api'))
+    )
+
+Q_REPLICA_LAG = """
+SELECT
+    CASE
+        WHEN NOT pg_is_in_recovery()
+        THEN NULL
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+        THEN 0
+        ELSE EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp())
+    END AS lag_seconds
+"""
+
+def _make_pool(
+    name: str,
+    conninfo: str,
+    timeout: float = POOL_TIMEOUT_SECONDS,
+):
+    # The pool is opened lazily, on the first transaction. This module is also
+    # imported by processes which only use `database.asyncdatabase`, and they
+    # shouldn't hold idle connections open.
+    return ConnectionPool(
+        conninfo=conninfo,
+        kwargs=dict(row_factory=psycopg.rows.dict_row),
+        min_size=POOL_MIN_SIZE,
+        max_size=max(POOL_MIN_SIZE, POOL_MAX_SIZE),
+        timeout=timeout,
+        max_lifetime=POOL_MAX_LIFETIME_SECONDS,
+        check=ConnectionPool.check_connection,
+        name=name,
+        open=False,
+    )
+
+_api_pool  = _make_pool('api',  _api_conninfo)
+_chat_pool = _make_pool('chat', _chat_conninfo)
+
+class _Replica:
+    def __init__(self, name: str, conninfo: str):
+        self.pool = _make_pool(name, conninfo, REPLICA_POOL_TIMEOUT_SECONDS)
+
+        # Seconds behind the primary, or None if the replica is unusable
+        self.lag_seconds: float | None = None
+
+_api_replicas = [
+    _Replica(f'api-replica-{i}', _replica_conninfo(host_port))
+    for i, host_port in enumerate(REPLICA_HOSTS)
+]
 
-class api_tx:
-    def __init__(self, isolation_level=_default_transaction_isolation):
+_pool_open_lock = threading.Lock()
+
+def _open_pool(pool: ConnectionPool):
+    if not pool.closed:
+        return pool
+
+    with _pool_open_lock:
+        if pool.closed:
+            pool.open()
+            threading.Thread(
+                target=_check_pool_forever,
+                args=(pool,),
+                daemon=True,
+            ).start()
+
+    return pool
+
+_replica_monitor_lock = threading.Lock()
+_replica_monitor_started = False
+
+def _start_replica_monitor():
+    global _replica_monitor_started
+
+    if _replica_monitor_started:
+        return
+
+    with _replica_monitor_lock:
+        if not _replica_monitor_started:
+            for replica in _api_replicas:
+                _open_pool(replica.pool)
+
+            threading.Thread(
+                target=_check_replica_lag_forever,
+                daemon=True,
+            ).start()
+
+            _replica_monitor_started = True
+
+def _choose_replica(replicas: list[_Replica]) -> _Replica | None:
+    # Other threads can set a replica's lag to None at any moment, so each lag
+    # is read exactly once
+    usable = [
+        (r, lag)
+        for r in replicas
+        for lag in [r.lag_seconds]
+        if lag is not None and lag <= REPLICA_MAX_LAG_SECONDS
+    ]
+
+    if not usable:
+        return None
+
+    # Spread load evenly over every replica which is about as fresh as the
+    # freshest one, rather than always hammering the single best replica
+    min_lag = min(lag for _, lag in usable)
+    freshest = [r for r, lag in usable if lag <= min_lag + 1]
+
+    return random.choice(freshest)
+
+class _tx:
+    _pool: ConnectionPool
+    _replicas: list[_Replica] = []
+
+    def __init__(
+        self,
+        isolation_level=_default_transaction_isolation,
+        read_only=False,
+    ):
         normalized_isolation_level = isolation_level.upper()
 
         if normalized_isolation_level not in _valid_isolation_levels:
             raise ValueError(isolation_level)
 
         self.isolation_level = normalized_isolation_level
+        self.read_only = read_only
 
+        self.pool = None
+        self.conn = None
         self.cur = None
 
-    def __enter__(self):
-        _api_conn_lock.acquire()
-
-        global _api_conn
-        if not _api_conn or _api_conn.closed:
-            try:
-                _api_conn = psycopg.Connection.connect(
-                    conninfo=_api_conninfo,
-                    row_factory=psycopg.rows.dict_row,
-                )
-            except:
-                print(traceback.format_exc())
-                raise
+    def _getconn(self):
+        # Hot standbys don't support serializable transactions
+        use_replica = (
+            self.read_only and
+            self._replicas and
+            self.isolation_level != 'SERIALIZABLE')
 
-        self.cur = _api_conn.cursor()
+        if use_replica:
+            _start_replica_monitor()
 
-        if self.isolation_level != _default_transaction_isolation:
-            self.cur.execute(
-                f'SET TRANSACTION ISOLATION LEVEL {self.isolation_level}'
-            )
-        return self.cur
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        try:
-            if exc_type is None:
-                _api_conn.commit()
-            else:
-                _api_conn.rollback()
-                traceback.print_exception(exc_type, exc_val, exc_tb)
-        finally:
-            try:
-                self.cur.close()
-            except:
-                print(traceback.format_exc())
+            replica = _choose_replica(self._replicas)
 
-        _api_conn_lock.release()
+            if replica:
+                try:
+                    return replica.pool, replica.pool.getconn()
+                except:
+                    print(
+                        f'Replica {replica.pool.name} unavailable; '
+                        'falling back to primary')
+                    replica.lag_seconds = None
 
-class chat_tx:
-    def __init__(self, isolation_level=_default_transaction_isolation):
-        normalized_isolation_level = isolation_level.upper()
+        pool = _open_pool(self._pool)
 
-        if normalized_isolation_level not in _valid_isolation_levels:
-            raise ValueError(isolation_level)
+        return pool, pool.getconn()
 
-        self.isolation_level = normalized_isolation_level
+    def __enter__(self):
+        try:
+            self.pool, self.conn = self._getconn()
+        except:
+            print(traceback.format_exc())
+            raise
 
-        self.cur = None
+        try:
+            self.cur = self.conn.cursor()
 
-    def __enter__(self):
-        _chat_conn_lock.acquire()
-
-        global _chat_conn
-        if not _chat_conn or _chat_conn.closed:
-            try:
-                _chat_conn = psycopg.Connection.connect(
-                    conninfo=_chat_conninfo,
-                    row_factory=psycopg.rows.dict_row,
+            if self.isolation_level != _default_transaction_isolation:
+                self.cur.execute(
+                    f'SET TRANSACTION ISOLATION LEVEL {self.isolation_level}'
                 )
-            except:
-                print(traceback.format_exc())
-                raise
-
-        self.cur = _chat_conn.cursor()
+            if self.read_only:
+                self.cur.execute('SET TRANSACTION READ ONLY')
+        except:
+            self._release()
+            raise
 
-        if self.isolation_level != _default_transaction_isolation:
-            self.cur.execute(
-                f'SET TRANSACTION ISOLATION LEVEL {self.isolation_level}'
-            )
         return self.cur
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         try:
             if exc_type is None:
-                _chat_conn.commit()
+                self.conn.commit()
             else:
-                _chat_conn.rollback()
+                self.conn.rollback()
                 traceback.print_exception(exc_type, exc_val, exc_tb)
         finally:
-            try:
+            self._release()
+
+    def _release(self):
+        try:
+            if self.cur:
                 self.cur.close()
-            except:
-                print(traceback.format_exc())
+        except:
+            print(traceback.format_exc())
+
+        # `putconn` rolls back anything left open and discards broken
+        # connections, so the pool never hands out a dirty connection.
+        self.pool.putconn(self.conn)
+
+        self.pool = None
+        self.conn = None
+        self.cur = None
 
-        _chat_conn_lock.release()
+class api_tx(_tx):
+    """
+    Pass `read_only=True` for transactions which only SELECT and can tolerate
+    up to `REPLICA_MAX_LAG_SECONDS` of staleness. They're sent to a replica
+    when one is configured and healthy, otherwise to the primary.
+    """
+    _pool = _api_pool
+    _replicas = _api_replicas
+
+class chat_tx(_tx):
+    _pool = _chat_pool
+
+def api_conn() -> psycopg.Connection:
+    """
+    Opens a connection to duo_api outside of the pool, in autocommit mode. It's
+    meant for long-lived sessions, such as ones which LISTEN for
+    notifications, which would otherwise tie up a pooled connection forever.
+    """
+    return psycopg.connect(
+        _api_conninfo,
+        autocommit=True,
+        row_factory=psycopg.rows.dict_row,
+    )
 
 def fetchall_sets(tx: psycopg.Cursor[Any]):
     result = []
@@ -151,23 +315,51 @@ def fetchall_sets(tx: psycopg.Cursor[Any]):
             break
     return result
 
-def _check_api_connection_forever():
+def pool_stats() -> dict[str, dict[str, int]]:
+    """
+    Returns the psycopg_pool statistics for each pool. The most interesting
+    ones are `requests_waiting`, `requests_wait_ms` and `requests_errors`
+    (i.e. timeouts), which show whether `POOL_MAX_SIZE` is too small. Counters
+    are reset each time `_check_pool_forever` logs them.
+    """
+    return {
+        pool.name: pool.get_stats()
+        for pool in [_api_pool, _chat_pool] + [r.pool for r in _api_replicas]
+        if not pool.closed
+    }
+
+def replica_lag() -> dict[str, float | None]:
+    return {r.pool.name: r.lag_seconds for r in _api_replicas}
+
+def _check_pool_forever(pool: ConnectionPool):
     while True:
-        try:
-            with api_tx() as tx:
-                tx.execute('SELECT 1')
-        except:
-            print(traceback.format_exc())
         time.sleep(random.randint(30, 90))
-
-def _check_chat_connection_forever():
-    while True:
         try:
-            with chat_tx() as tx:
-                tx.execute('SELECT 1')
+            pool.check()
+            stats = pool.pop_stats()
+            if stats.get('requests_waiting') or stats.get('requests_errors'):
+                print(f'Connection pool {pool.name} is saturated:', stats)
         except:
             print(traceback.format_exc())
-        time.sleep(random.randint(30, 90))
 
-threading.Thread(target=_check_api_connection_forever,  daemon=True).start()
-threading.Thread(target=_check_chat_connection_forever, daemon=True).start()
+def _check_replica_lag_once(replica: _Replica):
+    try:
+        with replica.pool.connection() as conn:
+            row = conn.execute(Q_REPLICA_LAG).fetchone()
+            lag_seconds = row['lag_seconds']
+    except:
+        print(traceback.format_exc())
+        lag_seconds = None
+
+    if lag_seconds is None and replica.lag_seconds is not None:
+        print(f'Replica {replica.pool.name} is unusable')
+    elif lag_seconds is not None and lag_seconds > REPLICA_MAX_LAG_SECONDS:
+        print(f'Replica {replica.pool.name} is lagging by {lag_seconds}s')
+
+    replica.lag_seconds = None if lag_seconds is None else float(lag_seconds)
+
+def _check_replica_lag_forever():
+    while True:
+        for replica in _api_replicas:
+            _check_replica_lag_once(replica)
+        time.sleep(REPLICA_POLL_SECONDS)
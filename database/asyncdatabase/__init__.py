@@ -2,9 +2,8 @@ from typing import Any
 import asyncio
 import os
 import psycopg
+from psycopg_pool import AsyncConnectionPool
 import random
-import threading
-import time
 import traceback
 
 DB_HOST = os.environ['DUO_DB_HOST']
@@ -12,6 +11,29 @@ DB_PORT = os.environ['DUO_DB_PORT']
 DB_USER = os.environ['DUO_DB_USER']
 DB_PASS = os.environ['DUO_DB_PASS']
 
+# The pool starts small and grows towards `POOL_MAX_SIZE` whenever coroutines
+# are queueing for a connection, then shrinks again once connections have been
+# idle for `POOL_MAX_IDLE_SECONDS`. That way it tracks the number of
+# concurrently-running transactions on the event loop rather than the number
+# of open websockets.
+POOL_MIN_SIZE = int(os.environ.get('DUO_DB_ASYNC_POOL_MIN_SIZE', '1'))
+POOL_MAX_SIZE = int(os.environ.get('DUO_DB_ASYNC_POOL_MAX_SIZE', '20'))
+
+POOL_TIMEOUT_SECONDS = float(os.environ.get(
+    'DUO_DB_ASYNC_POOL_TIMEOUT_SECONDS',
+    str(30),
+))
+
+POOL_MAX_IDLE_SECONDS = float(os.environ.get(
+    'DUO_DB_ASYNC_POOL_MAX_IDLE_SECONDS',
+    str(60 * 10), # 10 minutes
+))
+
+POOL_MAX_LIFETIME_SECONDS = float(os.environ.get(
+    'DUO_DB_ASYNC_POOL_MAX_LIFETIME_SECONDS',
+    str(60 * 60), # 1 hour
+))
+
 _valid_isolation_levels = [
     'SERIALIZABLE',
     'REPEATABLE READ',
@@ -41,61 +63,40 @@ _chat_conninfo = psycopg.conninfo.make_conninfo(
     **(_coninfo_args | dict(dbname='duo_chat'))
 )
 
-_api_conn = None
-_chat_conn = None
-
-_api_conn_lock = asyncio.Lock()
-_chat_conn_lock = asyncio.Lock()
+def _make_pool(name: str, conninfo: str):
+    # Async pools can only be opened from inside a running event loop, so
+    # they're opened on first use.
+    return AsyncConnectionPool(
+        conninfo=conninfo,
+        kwargs=dict(row_factory=psycopg.rows.dict_row),
+        min_size=POOL_MIN_SIZE,
+        max_size=max(POOL_MIN_SIZE, POOL_MAX_SIZE),
+        timeout=POOL_TIMEOUT_SECONDS,
+        max_idle=POOL_MAX_IDLE_SECONDS,
+        max_lifetime=POOL_MAX_LIFETIME_SECONDS,
+        check=AsyncConnectionPool.check_connection,
+        name=name,
+        open=False,
+    )
 
-class api_tx:
-    def __init__(self, isolation_level=_default_transaction_isolation):
-        normalized_isolation_level = isolation_level.upper()
+_api_pool = _make_pool('api', _api_conninfo)
+_chat_pool = _make_pool('chat', _chat_conninfo)
 
-        if normalized_isolation_level not in _valid_isolation_levels:
-            raise ValueError(isolation_level)
+_pool_open_lock = asyncio.Lock()
 
-        self.isolation_level = normalized_isolation_level
+async def _open_pool(pool: AsyncConnectionPool):
+    if not pool.closed:
+        return pool
 
-        self.cur = None
+    async with _pool_open_lock:
+        if pool.closed:
+            await pool.open()
 
-    async def __aenter__(self):
-        await _api_conn_lock.acquire()
-
-        global _api_conn
-        if not _api_conn or _api_conn.closed:
-            try:
-                _api_conn = await psycopg.AsyncConnection.connect(
-                    conninfo=_api_conninfo,
-                    row_factory=psycopg.rows.dict_row,
-                )
-            except:
-                print(traceback.format_exc())
-                raise
+    return pool
 
-        self.cur = _api_conn.cursor()
+class _tx:
+    _pool: AsyncConnectionPool
 
-        if self.isolation_level != _default_transaction_isolation:
-            await self.cur.execute(
-                f'SET TRANSACTION ISOLATION LEVEL {self.isolation_level}'
-            )
-        return self.cur
-
-    async def __aexit__(self, exc_type, exc_val, exc_tb):
-        try:
-            if exc_type is None:
-                await _api_conn.commit()
-            else:
-                await _api_conn.rollback()
-                traceback.print_exception(exc_type, exc_val, exc_tb)
-        finally:
-            try:
-                await self.cur.close()
-            except:
-                print(traceback.format_exc())
-
-        _api_conn_lock.release()
-
-class chat_tx:
     def __init__(self, isolation_level=_default_transaction_isolation):
         normalized_isolation_level = isolation_level.upper()
 
@@ -104,65 +105,108 @@ class chat_tx:
 
         self.isolation_level = normalized_isolation_level
 
+        self.conn = None
         self.cur = None
 
     async def __aenter__(self):
-        await _chat_conn_lock.acquire()
-
-        global _chat_conn
-        if not _chat_conn or _chat_conn.closed:
-            try:
-                _chat_conn = await psycopg.AsyncConnection.connect(
-                    conninfo=_chat_conninfo,
-                    row_factory=psycopg.rows.dict_row,
-                )
-            except:
-                print(traceback.format_exc())
-                raise
+        pool = await _open_pool(self._pool)
 
-        self.cur = _chat_conn.cursor()
+        try:
+            self.conn = await pool.getconn()
+        except:
+            print(traceback.format_exc())
+            raise
+
+        try:
+            self.cur = self.conn.cursor()
+
+            if self.isolation_level != _default_transaction_isolation:
+                await self.cur.execute(
+                    f'SET TRANSACTION ISOLATION LEVEL {self.isolation_level}'
+                )
+        except:
+            await self._release()
+            raise
 
-        if self.isolation_level != _default_transaction_isolation:
-            await self.cur.execute(
-                f'SET TRANSACTION ISOLATION LEVEL {self.isolation_level}'
-            )
         return self.cur
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         try:
             if exc_type is None:
-                await _chat_conn.commit()
+                await self.conn.commit()
             else:
-                await _chat_conn.rollback()
+                await self.conn.rollback()
                 traceback.print_exception(exc_type, exc_val, exc_tb)
         finally:
-            try:
-                await self.cur.close()
-            except:
-                print(traceback.format_exc())
+            await self._release()
 
-        _chat_conn_lock.release()
-
-async def _check_api_connection_forever():
-    while True:
+    async def _release(self):
         try:
-            async with api_tx() as tx:
-                await tx.execute('SELECT 1')
+            if self.cur:
+                await self.cur.close()
         except:
             print(traceback.format_exc())
-        await asyncio.sleep(random.randint(30, 90))
 
-async def _check_chat_connection_forever():
+        await self._pool.putconn(self.conn)
+
+        self.conn = None
+        self.cur = None
+
+class api_tx(_tx):
+    _pool = _api_pool
+
+class chat_tx(_tx):
+    _pool = _chat_pool
+
+async def api_conn() -> psycopg.AsyncConnection:
+    """
+    Opens a connection to duo_api outside of the pool, in autocommit mode. It's
+    meant for long-lived sessions, such as ones which LISTEN for
+    notifications, which would otherwise tie up a pooled connection forever.
+    """
+    return await psycopg.AsyncConnection.connect(
+        _api_conninfo,
+        autocommit=True,
+        row_factory=psycopg.rows.dict_row,
+    )
+
+async def chat_conn() -> psycopg.AsyncConnection:
+    """
+    Like `api_conn`, but for duo_chat
+    """
+    return await psycopg.AsyncConnection.connect(
+        _chat_conninfo,
+        autocommit=True,
+        row_factory=psycopg.rows.dict_row,
+    )
+
+def pool_stats() -> dict[str, dict[str, int]]:
+    """
+    Returns the psycopg_pool statistics for each open pool. `pool_size` close
+    to `pool_max` together with non-zero `requests_waiting` means the pool is
+    saturated and `DUO_DB_ASYNC_POOL_MAX_SIZE` should be raised.
+    """
+    return {
+        pool.name: pool.get_stats()
+        for pool in [_api_pool, _chat_pool]
+        if not pool.closed
+    }
+
+async def _check_pool_forever(pool: AsyncConnectionPool):
     while True:
         try:
-            async with chat_tx() as tx:
-                await tx.execute('SELECT 1')
-        except:
+            await _open_pool(pool)
+            await pool.check()
+
+            stats = pool.pop_stats()
+            if stats.get('requests_waiting') or stats.get('requests_errors'):
+                print(f'Connection pool {pool.name} is saturated:', stats)
+        except Exception:
             print(traceback.format_exc())
         await asyncio.sleep(random.randint(30, 90))
 
 async def check_connections_forever():
     await asyncio.gather(
-        _check_api_connection_forever(),
-        _check_chat_connection_forever(),
+        _check_pool_forever(_api_pool),
+        _check_pool_forever(_chat_pool),
     )
@@ -47,6 +47,7 @@ def init_db():
         location,
         person,
         question,
+        search,
     )
 
     init_funcs = [
@@ -54,6 +55,7 @@ def init_db():
         location.init_db,
         question.init_db,
         person.init_db,
+        search.init_db,
     ]
 
     print('Initializing DB...')
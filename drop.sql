@@ -8,10 +8,12 @@ DROP FUNCTION IF EXISTS array_full(INT, INT) CASCADE;
 DROP FUNCTION IF EXISTS clamp(FLOAT, FLOAT, FLOAT) CASCADE;
 DROP FUNCTION IF EXISTS compute_personality_vectors(INT[], INT[], INT[], INT[], INT[], INT[], SMALLINT) CASCADE;
 DROP FUNCTION IF EXISTS insert_into_search_tables CASCADE;
+DROP FUNCTION IF EXISTS person_relationships(INT, INT[]) CASCADE;
 DROP FUNCTION IF EXISTS trait_ratio(INT[], INT[], INT) CASCADE;
 DROP FUNCTION IF EXISTS update_search_tables CASCADE;
 DROP TABLE IF EXISTS answer CASCADE;
 DROP TABLE IF EXISTS duo_session CASCADE;
+DROP TABLE IF EXISTS email_outbox CASCADE;
 DROP TABLE IF EXISTS ethnicity CASCADE;
 DROP TABLE IF EXISTS frequency CASCADE;
 DROP TABLE IF EXISTS gender CASCADE;
@@ -34,6 +36,7 @@ DROP TABLE IF EXISTS search_for_quiz_prospects;
 DROP TABLE IF EXISTS search_for_standard_prospects;
 DROP TABLE IF EXISTS search_preference_age CASCADE;
 DROP TABLE IF EXISTS search_preference_answer CASCADE;
+DROP TABLE IF EXISTS search_preference_bitmask CASCADE;
 DROP TABLE IF EXISTS search_preference_distance CASCADE;
 DROP TABLE IF EXISTS search_preference_drinking CASCADE;
 DROP TABLE IF EXISTS search_preference_drugs CASCADE;
@@ -0,0 +1,34 @@
+"""
+Runs the chat and cron services' event loops. DUO_EVENT_LOOP selects the loop:
+
+  * 'asyncio' - The standard library's loop (the default)
+  * 'uvloop'  - uvloop, which must be installed
+  * 'auto'    - uvloop if it's installed, otherwise the standard loop
+"""
+
+from typing import Any, Coroutine
+import asyncio
+import os
+
+EVENT_LOOP = os.environ.get('DUO_EVENT_LOOP', 'asyncio')
+
+if EVENT_LOOP not in ['asyncio', 'uvloop', 'auto']:
+    raise ValueError(f'Invalid DUO_EVENT_LOOP: {EVENT_LOOP}')
+
+def _uvloop():
+    try:
+        import uvloop
+        return uvloop
+    except ImportError:
+        if EVENT_LOOP == 'uvloop':
+            raise
+        return None
+
+def run(main: Coroutine[Any, Any, Any]):
+    uvloop = _uvloop() if EVENT_LOOP != 'asyncio' else None
+
+    if uvloop is None:
+        return asyncio.run(main)
+    else:
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            return runner.run(main)
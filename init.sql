@@ -28,6 +28,11 @@ RETURNS FLOAT AS $$
     SELECT LEAST(hi, GREATEST(lo, val));
 $$ LANGUAGE sql IMMUTABLE LEAKPROOF PARALLEL SAFE;
 
+CREATE OR REPLACE FUNCTION bitmask_contains(mask BIGINT, id INT)
+RETURNS BOOLEAN AS $$
+    SELECT (mask & (1::BIGINT << id)) != 0;
+$$ LANGUAGE sql IMMUTABLE LEAKPROOF PARALLEL SAFE;
+
 CREATE OR REPLACE FUNCTION base62_encode(num bigint) RETURNS text AS $$
 DECLARE
     characters text := '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ';
@@ -195,7 +200,6 @@ CREATE TABLE IF NOT EXISTS person (
     gender_id SMALLINT REFERENCES gender(id) NOT NULL,
     about TEXT NOT NULL,
 
-    -- TODO: CREATE INDEX ON person USING ivfflat (personality2 vector_ip_ops) WITH (lists = 100);
     -- There's 46 `trait`s. In principle, it's possible for someone to have a
     -- score of 0 for each trait. We add an extra, constant, non-zero dimension
     -- to avoid that.
@@ -245,6 +249,15 @@ CREATE TABLE IF NOT EXISTS person (
     -- Whether the user deactivated their account via the settings
     activated BOOLEAN NOT NULL DEFAULT TRUE,
 
+    -- Denormalized from `search_preference_distance` and `search_preference_age`
+    -- by `refresh_search_preference_bounds`, so that mutual search filters are
+    -- plain column comparisons. The date-of-birth bounds are inclusive and move
+    -- with CURRENT_DATE, so they're refreshed daily by a cron job. A person
+    -- with no age preference accepts nobody, hence the infinite defaults.
+    search_max_distance_meters FLOAT8 NOT NULL DEFAULT 1e9,
+    search_earliest_date_of_birth DATE NOT NULL DEFAULT 'infinity',
+    search_latest_date_of_birth DATE NOT NULL DEFAULT '-infinity',
+
     -- Primary keys and constraints
     UNIQUE (email),
     PRIMARY KEY (id)
@@ -481,6 +494,28 @@ CREATE TABLE IF NOT EXISTS search_preference_skipped (
     PRIMARY KEY (person_id)
 );
 
+-- A denormalized copy of the categorical `search_preference_*` tables, where
+-- bit `n` of each column is set when the person accepts the value whose ID is
+-- `n`. It's maintained by `refresh_search_preference_bitmask`.
+CREATE TABLE IF NOT EXISTS search_preference_bitmask (
+    person_id INT NOT NULL REFERENCES person(id) ON DELETE CASCADE ON UPDATE CASCADE,
+    orientation BIGINT NOT NULL DEFAULT 0,
+    ethnicity BIGINT NOT NULL DEFAULT 0,
+    has_profile_picture BIGINT NOT NULL DEFAULT 0,
+    looking_for BIGINT NOT NULL DEFAULT 0,
+    smoking BIGINT NOT NULL DEFAULT 0,
+    drinking BIGINT NOT NULL DEFAULT 0,
+    drugs BIGINT NOT NULL DEFAULT 0,
+    long_distance BIGINT NOT NULL DEFAULT 0,
+    relationship_status BIGINT NOT NULL DEFAULT 0,
+    has_kids BIGINT NOT NULL DEFAULT 0,
+    wants_kids BIGINT NOT NULL DEFAULT 0,
+    exercise BIGINT NOT NULL DEFAULT 0,
+    religion BIGINT NOT NULL DEFAULT 0,
+    star_sign BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (person_id)
+);
+
 CREATE TABLE IF NOT EXISTS messaged (
     subject_person_id INT NOT NULL REFERENCES person(id) ON DELETE CASCADE ON UPDATE CASCADE,
     object_person_id INT NOT NULL REFERENCES person(id) ON DELETE CASCADE ON UPDATE CASCADE,
@@ -536,35 +571,73 @@ CREATE TABLE IF NOT EXISTS banned_person (
     PRIMARY KEY (normalized_email, ip_address)
 );
 
+-- Emails are written here in the same transaction as whatever caused them, and
+-- sent by the `emailoutbox` cron module. Sent emails are deleted, as are
+-- emails which are no longer worth sending after `expires_at`. Emails which
+-- fail too many times are kept, with `dead_lettered_at` set and their bodies
+-- cleared.
+CREATE TABLE IF NOT EXISTS email_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    to_addr TEXT NOT NULL,
+    from_addr TEXT,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    attempts INT NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    dead_lettered_at TIMESTAMP,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
 --------------------------------------------------------------------------------
 -- TABLES TO SPEED UP SEARCHING
 --------------------------------------------------------------------------------
 
+-- The old, one-row-per-prospect format of `search_cache` is dropped so that the
+-- table below is recreated. Losing its contents only forces uncached searches.
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1
+        FROM information_schema.columns
+        WHERE table_name = 'search_cache' AND column_name = 'position'
+    ) THEN
+        DROP TABLE search_cache;
+    END IF;
+END;
+$$;
+
+-- Search results are cached as one row per searcher, rather than one per
+-- prospect, to keep uncached searches' writes small. Display fields are
+-- hydrated from `person` for just the page being viewed.
+--
+-- Element `i` of each array belongs to the prospect at position `i`. When a
+-- prospect is skipped, their ID is replaced with NULL, so that the positions of
+-- the remaining prospects don't shift while the searcher pages through them.
+--
+-- Each score is `200 * has_profile_photo + 100 * has_mutual_club +
+-- match_percentage`, i.e. the search's sort key.
+--
+-- `is_prewarmed` marks rows written ahead of time by the `searchprewarm` cron
+-- module, which the searcher's next uncached search may serve instead of
+-- searching again. See `DUO_SEARCH_CACHE_MAX_AGE_SECONDS`.
 CREATE UNLOGGED TABLE IF NOT EXISTS search_cache (
     searcher_person_id INT REFERENCES person(id) ON DELETE CASCADE ON UPDATE CASCADE,
-    position SMALLINT,
-    prospect_person_id INT NOT NULL,
-    prospect_uuid UUID NOT NULL,
-    has_mutual_club BOOLEAN NOT NULL DEFAULT FALSE,
-    profile_photo_uuid TEXT,
-    name TEXT NOT NULL,
-    age SMALLINT,
-    match_percentage SMALLINT NOT NULL,
-    personality VECTOR(47) NOT NULL,
-    PRIMARY KEY (searcher_person_id, position)
+    prospect_person_ids INT[] NOT NULL,
+    scores SMALLINT[] NOT NULL,
+    cached_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    is_prewarmed BOOLEAN NOT NULL DEFAULT FALSE,
+    PRIMARY KEY (searcher_person_id)
 );
 
 --------------------------------------------------------------------------------
 -- INDEXES
 --------------------------------------------------------------------------------
 
-CREATE INDEX IF NOT EXISTS idx__person__activated__coordinates__gender_id
+CREATE INDEX IF NOT EXISTS idx__person__activated__coordinates__gender_id__date_of_birth
     ON person
-    USING GIST(coordinates, gender_id)
+    USING GIST(coordinates, gender_id, date_of_birth)
     WHERE activated;
 
-CREATE INDEX IF NOT EXISTS idx__search_cache__searcher_person_id__position ON search_cache(searcher_person_id, position);
-
 CREATE INDEX IF NOT EXISTS idx__answer__question_id ON answer(question_id);
 CREATE INDEX IF NOT EXISTS idx__answer__person_id_public_answer ON answer(person_id, public_, answer);
 
@@ -609,6 +682,14 @@ CREATE INDEX IF NOT EXISTS idx__skipped__object_person_id__created_at__reported
     ON skipped(object_person_id, created_at)
     WHERE reported;
 
+CREATE INDEX IF NOT EXISTS idx__email_outbox__next_attempt_at
+    ON email_outbox(next_attempt_at)
+    WHERE dead_lettered_at IS NULL;
+
+CREATE INDEX IF NOT EXISTS idx__email_outbox__dead_lettered_at
+    ON email_outbox(dead_lettered_at)
+    WHERE dead_lettered_at IS NOT NULL;
+
 --------------------------------------------------------------------------------
 -- DATA
 --------------------------------------------------------------------------------
@@ -1200,6 +1281,71 @@ RETURNS TABLE(trait_id SMALLINT, ratio FLOAT4) AS $$
     FROM UNNEST(presence_score, absence_score) as t(a, b);
 $$ LANGUAGE sql IMMUTABLE LEAKPROOF PARALLEL SAFE;
 
+-- Whether `p_person_id` and each of `p_other_person_ids` have messaged or
+-- skipped each other. Each kind of relationship is looked up for all the other
+-- persons in one index scan, rather than with one probe per person, so this
+-- should be used to decorate whole pages of results at once.
+CREATE OR REPLACE FUNCTION person_relationships(
+    p_person_id INT,
+    p_other_person_ids INT[]
+)
+RETURNS TABLE(
+    other_person_id INT,
+    person_messaged_other BOOLEAN,
+    other_messaged_person BOOLEAN,
+    person_skipped_other BOOLEAN,
+    other_skipped_person BOOLEAN
+) AS $$
+    WITH other_person AS (
+        SELECT DISTINCT
+            id
+        FROM
+            UNNEST(p_other_person_ids) AS id
+        WHERE
+            id IS NOT NULL
+    ), person_messaged_other AS (
+        SELECT object_person_id AS id
+        FROM messaged
+        WHERE
+            subject_person_id = p_person_id AND
+            object_person_id = ANY(p_other_person_ids)
+    ), other_messaged_person AS (
+        SELECT subject_person_id AS id
+        FROM messaged
+        WHERE
+            subject_person_id = ANY(p_other_person_ids) AND
+            object_person_id = p_person_id
+    ), person_skipped_other AS (
+        SELECT object_person_id AS id
+        FROM skipped
+        WHERE
+            subject_person_id = p_person_id AND
+            object_person_id = ANY(p_other_person_ids)
+    ), other_skipped_person AS (
+        SELECT subject_person_id AS id
+        FROM skipped
+        WHERE
+            subject_person_id = ANY(p_other_person_ids) AND
+            object_person_id = p_person_id
+    )
+    SELECT
+        other_person.id,
+        person_messaged_other.id IS NOT NULL,
+        other_messaged_person.id IS NOT NULL,
+        person_skipped_other.id IS NOT NULL,
+        other_skipped_person.id IS NOT NULL
+    FROM
+        other_person
+    LEFT JOIN
+        person_messaged_other ON person_messaged_other.id = other_person.id
+    LEFT JOIN
+        other_messaged_person ON other_messaged_person.id = other_person.id
+    LEFT JOIN
+        person_skipped_other ON person_skipped_other.id = other_person.id
+    LEFT JOIN
+        other_skipped_person ON other_skipped_person.id = other_person.id
+$$ LANGUAGE sql STABLE PARALLEL SAFE;
+
 --------------------------------------------------------------------------------
 -- TRIGGER - refresh_has_profile_picture_id
 --------------------------------------------------------------------------------
@@ -1245,8 +1391,447 @@ AFTER INSERT OR DELETE ON photo
 FOR EACH ROW
 EXECUTE FUNCTION trigger_fn_refresh_has_profile_picture_id();
 
+--------------------------------------------------------------------------------
+-- TRIGGER - refresh_search_preference_bitmask
+--------------------------------------------------------------------------------
+
+CREATE OR REPLACE FUNCTION refresh_search_preference_bitmask(p_person_id INT)
+RETURNS INTEGER AS $$
+    WITH upserted AS (
+        INSERT INTO search_preference_bitmask (
+            person_id,
+            orientation,
+            ethnicity,
+            has_profile_picture,
+            looking_for,
+            smoking,
+            drinking,
+            drugs,
+            long_distance,
+            relationship_status,
+            has_kids,
+            wants_kids,
+            exercise,
+            religion,
+            star_sign
+        )
+        SELECT
+            p_person_id,
+            (
+                SELECT COALESCE(BIT_OR(1::BIGINT << orientation_id), 0)
+                FROM search_preference_orientation
+                WHERE person_id = p_person_id
+            ),
+            (
+                SELECT COALESCE(BIT_OR(1::BIGINT << ethnicity_id), 0)
+                FROM search_preference_ethnicity
+                WHERE person_id = p_person_id
+            ),
+            (
+                SELECT COALESCE(BIT_OR(1::BIGINT << has_profile_picture_id), 0)
+                FROM search_preference_has_profile_picture
+                WHERE person_id = p_person_id
+            ),
+            (
+                SELECT COALESCE(BIT_OR(1::BIGINT << looking_for_id), 0)
+                FROM search_preference_looking_for
+                WHERE person_id = p_person_id
+            ),
+            (
+                SELECT COALESCE(BIT_OR(1::BIGINT << smoking_id), 0)
+                FROM search_preference_smoking
+                WHERE person_id = p_person_id
+            ),
+            (
+                SELECT COALESCE(BIT_OR(1::BIGINT << drinking_id), 0)
+                FROM search_preference_drinking
+                WHERE person_id = p_person_id
+            ),
+            (
+                SELECT COALESCE(BIT_OR(1::BIGINT << drugs_id), 0)
+                FROM search_preference_drugs
+                WHERE person_id = p_person_id
+            ),
+            (
+                SELECT COALESCE(BIT_OR(1::BIGINT << long_distance_id), 0)
+                FROM search_preference_long_distance
+                WHERE person_id = p_person_id
+            ),
+            (
+                SELECT COALESCE(BIT_OR(1::BIGINT << relationship_status_id), 0)
+                FROM search_preference_relationship_status
+                WHERE person_id = p_person_id
+            ),
+            (
+                SELECT COALESCE(BIT_OR(1::BIGINT << has_kids_id), 0)
+                FROM search_preference_has_kids
+                WHERE person_id = p_person_id
+            ),
+            (
+                SELECT COALESCE(BIT_OR(1::BIGINT << wants_kids_id), 0)
+                FROM search_preference_wants_kids
+                WHERE person_id = p_person_id
+            ),
+            (
+                SELECT COALESCE(BIT_OR(1::BIGINT << exercise_id), 0)
+                FROM search_preference_exercise
+                WHERE person_id = p_person_id
+            ),
+            (
+                SELECT COALESCE(BIT_OR(1::BIGINT << religion_id), 0)
+                FROM search_preference_religion
+                WHERE person_id = p_person_id
+            ),
+            (
+                SELECT COALESCE(BIT_OR(1::BIGINT << star_sign_id), 0)
+                FROM search_preference_star_sign
+                WHERE person_id = p_person_id
+            )
+        WHERE
+            EXISTS (SELECT 1 FROM person WHERE id = p_person_id)
+        ON CONFLICT (person_id) DO UPDATE SET
+            orientation = EXCLUDED.orientation,
+            ethnicity = EXCLUDED.ethnicity,
+            has_profile_picture = EXCLUDED.has_profile_picture,
+            looking_for = EXCLUDED.looking_for,
+            smoking = EXCLUDED.smoking,
+            drinking = EXCLUDED.drinking,
+            drugs = EXCLUDED.drugs,
+            long_distance = EXCLUDED.long_distance,
+            relationship_status = EXCLUDED.relationship_status,
+            has_kids = EXCLUDED.has_kids,
+            wants_kids = EXCLUDED.wants_kids,
+            exercise = EXCLUDED.exercise,
+            religion = EXCLUDED.religion,
+            star_sign = EXCLUDED.star_sign
+        RETURNING 1
+    )
+    SELECT COUNT(*) FROM upserted;
+$$ LANGUAGE sql;
+
+-- Statement-level, so that setting many preferences at once (e.g. during
+-- onboarding) refreshes each person's bitmask once per table rather than once
+-- per row
+CREATE OR REPLACE FUNCTION trigger_fn_refresh_search_preference_bitmask()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM refresh_search_preference_bitmask(person_id)
+        FROM (SELECT DISTINCT person_id FROM new_rows) AS t;
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM refresh_search_preference_bitmask(person_id)
+        FROM (SELECT DISTINCT person_id FROM old_rows) AS t;
+    ELSE
+        PERFORM refresh_search_preference_bitmask(person_id)
+        FROM (
+            SELECT person_id FROM old_rows
+            UNION
+            SELECT person_id FROM new_rows
+        ) AS t;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Transition tables can't be used by triggers which fire on more than one kind
+-- of event, so each table gets one trigger per event
+DO $$
+DECLARE
+    table_name TEXT;
+BEGIN
+    FOREACH table_name IN ARRAY ARRAY[
+        'search_preference_orientation',
+        'search_preference_ethnicity',
+        'search_preference_has_profile_picture',
+        'search_preference_looking_for',
+        'search_preference_smoking',
+        'search_preference_drinking',
+        'search_preference_drugs',
+        'search_preference_long_distance',
+        'search_preference_relationship_status',
+        'search_preference_has_kids',
+        'search_preference_wants_kids',
+        'search_preference_exercise',
+        'search_preference_religion',
+        'search_preference_star_sign'
+    ] LOOP
+        EXECUTE format('
+            CREATE OR REPLACE TRIGGER trigger_refresh_search_preference_bitmask_insert
+            AFTER INSERT ON %I
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT
+            EXECUTE FUNCTION trigger_fn_refresh_search_preference_bitmask()
+        ', table_name);
+
+        EXECUTE format('
+            CREATE OR REPLACE TRIGGER trigger_refresh_search_preference_bitmask_update
+            AFTER UPDATE ON %I
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT
+            EXECUTE FUNCTION trigger_fn_refresh_search_preference_bitmask()
+        ', table_name);
+
+        EXECUTE format('
+            CREATE OR REPLACE TRIGGER trigger_refresh_search_preference_bitmask_delete
+            AFTER DELETE ON %I
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT
+            EXECUTE FUNCTION trigger_fn_refresh_search_preference_bitmask()
+        ', table_name);
+    END LOOP;
+END;
+$$;
+
+--------------------------------------------------------------------------------
+-- TRIGGER - refresh_search_preference_bounds
+--------------------------------------------------------------------------------
+
+CREATE OR REPLACE FUNCTION refresh_search_preference_bounds(p_person_ids INT[])
+RETURNS INTEGER AS $$
+-- plpgsql rather than sql, because the columns it updates are added by a
+-- migration, after this function is created
+DECLARE
+    n_updated INTEGER;
+BEGIN
+    WITH bounds AS (
+        SELECT
+            person.id,
+            COALESCE(1000 * search_preference_distance.distance, 1e9)
+                AS max_distance_meters,
+            CASE
+                WHEN search_preference_age.person_id IS NULL
+                THEN 'infinity'::DATE
+                ELSE (
+                    CURRENT_DATE -
+                    INTERVAL '1 year' *
+                    (COALESCE(search_preference_age.max_age, 999) + 1)
+                )::DATE + 1
+            END AS earliest_date_of_birth,
+            CASE
+                WHEN search_preference_age.person_id IS NULL
+                THEN '-infinity'::DATE
+                ELSE (
+                    CURRENT_DATE -
+                    INTERVAL '1 year' *
+                    COALESCE(search_preference_age.min_age, 0)
+                )::DATE
+            END AS latest_date_of_birth
+        FROM
+            person
+        LEFT JOIN
+            search_preference_distance
+        ON
+            search_preference_distance.person_id = person.id
+        LEFT JOIN
+            search_preference_age
+        ON
+            search_preference_age.person_id = person.id
+        WHERE
+            person.id = ANY(p_person_ids)
+    ), updated AS (
+        UPDATE person
+        SET
+            search_max_distance_meters = bounds.max_distance_meters,
+            search_earliest_date_of_birth = bounds.earliest_date_of_birth,
+            search_latest_date_of_birth = bounds.latest_date_of_birth
+        FROM
+            bounds
+        WHERE
+            person.id = bounds.id
+        AND (
+                person.search_max_distance_meters,
+                person.search_earliest_date_of_birth,
+                person.search_latest_date_of_birth
+            ) IS DISTINCT FROM (
+                bounds.max_distance_meters,
+                bounds.earliest_date_of_birth,
+                bounds.latest_date_of_birth
+            )
+        RETURNING 1
+    )
+    SELECT COUNT(*) INTO n_updated FROM updated;
+
+    RETURN n_updated;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION trigger_fn_refresh_search_preference_bounds()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM refresh_search_preference_bounds(ARRAY[OLD.person_id]);
+        RETURN OLD;
+    ELSE
+        PERFORM refresh_search_preference_bounds(ARRAY[NEW.person_id]);
+        RETURN NEW;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER trigger_refresh_search_preference_bounds
+AFTER INSERT OR DELETE OR UPDATE
+ON search_preference_distance
+FOR EACH ROW
+EXECUTE FUNCTION trigger_fn_refresh_search_preference_bounds();
+
+CREATE OR REPLACE TRIGGER trigger_refresh_search_preference_bounds
+AFTER INSERT OR DELETE OR UPDATE
+ON search_preference_age
+FOR EACH ROW
+EXECUTE FUNCTION trigger_fn_refresh_search_preference_bounds();
+
+--------------------------------------------------------------------------------
+-- TRIGGER - notify_search_engine
+--------------------------------------------------------------------------------
+
+-- Tells `service.search.engine` which persons' search data changed. The
+-- trigger's argument names the column holding the person's ID.
+CREATE OR REPLACE FUNCTION trigger_fn_notify_search_engine()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('search_engine', to_jsonb(OLD)->>TG_ARGV[0]);
+        RETURN OLD;
+    ELSE
+        PERFORM pg_notify('search_engine', to_jsonb(NEW)->>TG_ARGV[0]);
+        RETURN NEW;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER trigger_notify_search_engine
+AFTER INSERT OR DELETE OR UPDATE OF
+    activated,
+    personality,
+    coordinates,
+    gender_id,
+    date_of_birth,
+    has_profile_picture_id
+ON person
+FOR EACH ROW
+EXECUTE FUNCTION trigger_fn_notify_search_engine('id');
+
+CREATE OR REPLACE TRIGGER trigger_notify_search_engine
+AFTER INSERT OR DELETE OR UPDATE
+ON search_preference_gender
+FOR EACH ROW
+EXECUTE FUNCTION trigger_fn_notify_search_engine('person_id');
+
+CREATE OR REPLACE TRIGGER trigger_notify_search_engine
+AFTER INSERT OR DELETE OR UPDATE
+ON search_preference_age
+FOR EACH ROW
+EXECUTE FUNCTION trigger_fn_notify_search_engine('person_id');
+
+CREATE OR REPLACE TRIGGER trigger_notify_search_engine
+AFTER INSERT OR DELETE OR UPDATE
+ON search_preference_distance
+FOR EACH ROW
+EXECUTE FUNCTION trigger_fn_notify_search_engine('person_id');
+
+CREATE OR REPLACE TRIGGER trigger_notify_search_engine
+AFTER INSERT OR DELETE OR UPDATE
+ON person_club
+FOR EACH ROW
+EXECUTE FUNCTION trigger_fn_notify_search_engine('person_id');
+
+--------------------------------------------------------------------------------
+-- TRIGGER - notify_chat_relationship
+--------------------------------------------------------------------------------
+
+-- Tells the chat service which cached relationships changed. Payloads are
+-- '<table> <subject_person_id> <object_person_id>' for `skipped` and
+-- `messaged`, and 'person <id>' for `person`.
+CREATE OR REPLACE FUNCTION trigger_fn_notify_chat_relationship()
+RETURNS TRIGGER AS $$
+DECLARE
+    r RECORD;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        r := OLD;
+    ELSE
+        r := NEW;
+    END IF;
+
+    IF TG_TABLE_NAME = 'person' THEN
+        PERFORM pg_notify('chat_relationship', 'person ' || r.id);
+    ELSE
+        PERFORM pg_notify(
+            'chat_relationship',
+            TG_TABLE_NAME || ' ' ||
+            r.subject_person_id || ' ' ||
+            r.object_person_id
+        );
+    END IF;
+
+    RETURN r;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER trigger_notify_chat_relationship
+AFTER DELETE
+ON person
+FOR EACH ROW
+EXECUTE FUNCTION trigger_fn_notify_chat_relationship();
+
+CREATE OR REPLACE TRIGGER trigger_notify_chat_relationship
+AFTER INSERT OR DELETE
+ON skipped
+FOR EACH ROW
+EXECUTE FUNCTION trigger_fn_notify_chat_relationship();
+
+CREATE OR REPLACE TRIGGER trigger_notify_chat_relationship
+AFTER DELETE
+ON messaged
+FOR EACH ROW
+EXECUTE FUNCTION trigger_fn_notify_chat_relationship();
+
+--------------------------------------------------------------------------------
+-- TRIGGER - notify_email_outbox
+--------------------------------------------------------------------------------
+
+-- Wakes the `emailoutbox` cron module, so that emails such as OTPs are sent as
+-- soon as they're committed rather than at its next poll
+CREATE OR REPLACE FUNCTION trigger_fn_notify_email_outbox()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('email_outbox', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER trigger_notify_email_outbox
+AFTER INSERT
+ON email_outbox
+FOR EACH STATEMENT
+EXECUTE FUNCTION trigger_fn_notify_email_outbox();
+
 --------------------------------------------------------------------------------
 -- Migrations
 --------------------------------------------------------------------------------
 
+SELECT refresh_search_preference_bitmask(id)
+FROM person
+WHERE id NOT IN (SELECT person_id FROM search_preference_bitmask);
+
+ALTER TABLE person
+    ADD COLUMN IF NOT EXISTS search_max_distance_meters FLOAT8 NOT NULL DEFAULT 1e9,
+    ADD COLUMN IF NOT EXISTS search_earliest_date_of_birth DATE NOT NULL DEFAULT 'infinity',
+    ADD COLUMN IF NOT EXISTS search_latest_date_of_birth DATE NOT NULL DEFAULT '-infinity';
+
+SELECT refresh_search_preference_bounds(ARRAY(SELECT id FROM person));
+
+DROP INDEX IF EXISTS idx__person__activated__coordinates__gender_id;
+
+ALTER TABLE search_cache
+    ADD COLUMN IF NOT EXISTS cached_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    ADD COLUMN IF NOT EXISTS is_prewarmed BOOLEAN NOT NULL DEFAULT FALSE;
+
+ALTER TABLE email_outbox
+    ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP;
+
+UPDATE email_outbox
+SET body = ''
+WHERE dead_lettered_at IS NOT NULL AND body <> '';
+
 --------------------------------------------------------------------------------
@@ -0,0 +1,367 @@
+"""
+Search queries shared by the API and the `searchprewarm` cron module. This
+package has no dependencies, so that cron can import it without pulling in the
+API's.
+"""
+
+Q_UNCACHED_SEARCH_1 = """
+DELETE FROM search_cache
+WHERE searcher_person_id = %(searcher_person_id)s
+"""
+
+Q_UNCACHED_SEARCH_2 = """
+WITH searcher AS MATERIALIZED (
+    SELECT
+        coordinates,
+        personality,
+        gender_id,
+        search_max_distance_meters AS distance_preference,
+        search_earliest_date_of_birth,
+        search_latest_date_of_birth,
+        date_of_birth
+    FROM
+        person
+    WHERE
+        person.id = %(searcher_person_id)s
+    LIMIT 1
+), searcher_club AS MATERIALIZED (
+    SELECT
+        club_name
+    FROM
+        person_club
+    WHERE
+        person_id = %(searcher_person_id)s
+), prospects_first_pass AS (
+    SELECT
+        id AS prospect_person_id,
+
+        uuid AS prospect_uuid,
+
+        name,
+        EXTRACT(YEAR FROM AGE(date_of_birth)) AS age,
+
+        personality,
+        personality <#> (SELECT personality FROM searcher) AS negative_dot_prod,
+
+        has_profile_picture_id,
+        orientation_id,
+        ethnicity_id,
+        occupation,
+        education,
+        height_cm,
+        looking_for_id,
+        smoking_id,
+        drinking_id,
+        drugs_id,
+        long_distance_id,
+        relationship_status_id,
+        has_kids_id,
+        wants_kids_id,
+        exercise_id,
+        religion_id,
+        star_sign_id,
+
+        show_my_age,
+        hide_me_from_strangers,
+
+        EXISTS (
+            SELECT club_name FROM searcher_club
+
+            INTERSECT
+
+            SELECT club_name FROM person_club
+            WHERE person_id = prospect.id
+            LIMIT 1
+        ) AS has_mutual_club
+
+    FROM
+        person AS prospect
+
+    WHERE
+        prospect.activated
+    AND
+        prospect.gender_id IN (
+            SELECT
+                gender_id
+            FROM
+                search_preference_gender AS preference
+            WHERE
+                person_id = %(searcher_person_id)s
+        )
+    AND
+        ST_DWithin(
+            prospect.coordinates,
+            (SELECT coordinates FROM searcher),
+            (SELECT distance_preference FROM searcher)
+        )
+    AND
+        prospect.id != %(searcher_person_id)s
+    AND
+        -- The searcher meets the prospect's gender preference
+        EXISTS (
+            SELECT 1
+            FROM search_preference_gender AS preference
+            WHERE
+                preference.person_id = prospect.id AND
+                preference.gender_id = (SELECT gender_id FROM searcher)
+            LIMIT 1
+        )
+    AND
+        -- The searcher meets the prospect's location preference
+        ST_DWithin(
+            prospect.coordinates,
+            (SELECT coordinates FROM searcher),
+            prospect.search_max_distance_meters
+        )
+    AND
+        -- The prospect meets the searcher's age preference
+        prospect.date_of_birth BETWEEN
+            (SELECT search_earliest_date_of_birth FROM searcher) AND
+            (SELECT search_latest_date_of_birth FROM searcher)
+    AND
+        -- The searcher meets the prospect's age preference
+        (SELECT date_of_birth FROM searcher) BETWEEN
+            prospect.search_earliest_date_of_birth AND
+            prospect.search_latest_date_of_birth
+    AND (
+            -- The users have at least a 50%% match
+            (personality <#> (SELECT personality FROM searcher)) < 1e-5
+        OR
+            -- Both users signed up before the introduction of the 50%% cut-off
+            prospect.id < 10630 AND %(searcher_person_id)s < 10630
+    )
+
+    ORDER BY
+        -- If this is changed, other queries will need changing too
+        has_profile_picture_id,
+        has_mutual_club DESC,
+        negative_dot_prod
+
+    LIMIT
+        500
+), prospects_second_pass AS (
+    SELECT
+        prospect_person_id,
+        prospect_uuid,
+        (
+            SELECT uuid
+            FROM photo
+            WHERE
+                person_id = prospect_person_id
+            ORDER BY
+                position
+            LIMIT 1
+        ) AS profile_photo_uuid,
+        has_mutual_club,
+        name,
+        CASE WHEN show_my_age THEN age ELSE NULL END AS age,
+        CLAMP(0, 99, 100 * (1 - negative_dot_prod) / 2) AS match_percentage,
+        personality
+    FROM
+        prospects_first_pass AS prospect
+    JOIN
+        search_preference_bitmask AS searcher_bitmask
+    ON
+        searcher_bitmask.person_id = %(searcher_person_id)s
+    WHERE
+        bitmask_contains(searcher_bitmask.orientation, prospect.orientation_id)
+    AND
+        bitmask_contains(searcher_bitmask.ethnicity, prospect.ethnicity_id)
+    AND
+       EXISTS (
+            SELECT 1
+            FROM search_preference_height_cm AS preference
+            WHERE
+                preference.person_id = %(searcher_person_id)s AND
+                COALESCE(preference.min_height_cm, 0)   <= COALESCE(prospect.height_cm, 0) AND
+                COALESCE(preference.max_height_cm, 999) >= COALESCE(prospect.height_cm, 999)
+            LIMIT 1
+        )
+    AND
+        bitmask_contains(searcher_bitmask.has_profile_picture, prospect.has_profile_picture_id)
+    AND
+        bitmask_contains(searcher_bitmask.looking_for, prospect.looking_for_id)
+    AND
+        bitmask_contains(searcher_bitmask.smoking, prospect.smoking_id)
+    AND
+        bitmask_contains(searcher_bitmask.drinking, prospect.drinking_id)
+    AND
+        bitmask_contains(searcher_bitmask.drugs, prospect.drugs_id)
+    AND
+        bitmask_contains(searcher_bitmask.long_distance, prospect.long_distance_id)
+    AND
+        bitmask_contains(searcher_bitmask.relationship_status, prospect.relationship_status_id)
+    AND
+        bitmask_contains(searcher_bitmask.has_kids, prospect.has_kids_id)
+    AND
+        bitmask_contains(searcher_bitmask.wants_kids, prospect.wants_kids_id)
+    AND
+        bitmask_contains(searcher_bitmask.exercise, prospect.exercise_id)
+    AND
+        bitmask_contains(searcher_bitmask.religion, prospect.religion_id)
+    AND
+        bitmask_contains(searcher_bitmask.star_sign, prospect.star_sign_id)
+    AND
+       EXISTS (
+            (
+                SELECT 1 WHERE NOT prospect.hide_me_from_strangers
+            ) UNION ALL (
+                SELECT 1
+                FROM messaged
+                WHERE
+                    messaged.subject_person_id = prospect_person_id AND
+                    messaged.object_person_id = %(searcher_person_id)s AND
+                    prospect.hide_me_from_strangers
+                LIMIT 1
+            )
+            LIMIT 1
+        )
+    AND
+        -- The prospect did not skip the searcher
+        NOT EXISTS (
+            SELECT 1
+            FROM
+                skipped
+            WHERE
+                subject_person_id = prospect_person_id AND
+                object_person_id  = %(searcher_person_id)s
+            LIMIT 1
+        )
+    AND
+        -- The searcher did not skip the prospect, or the searcher wishes to
+        -- view skipped prospects
+        NOT EXISTS (
+            SELECT 1
+            FROM search_preference_skipped AS preference
+            JOIN skipped
+            ON
+                preference.person_id      = %(searcher_person_id)s AND
+                preference.skipped_id     = 2 AND
+                skipped.subject_person_id = %(searcher_person_id)s AND
+                skipped.object_person_id  = prospect_person_id
+            LIMIT 1
+        )
+    AND
+       NOT EXISTS (
+            SELECT 1
+            FROM search_preference_messaged AS preference
+            JOIN messaged
+            ON
+                preference.person_id       = %(searcher_person_id)s AND
+                preference.messaged_id     = 2 AND
+                messaged.subject_person_id = %(searcher_person_id)s AND
+                messaged.object_person_id  = prospect_person_id
+            LIMIT 1
+        )
+    AND
+        -- NOT EXISTS an answer contrary to the searcher's preference...
+        NOT EXISTS (
+            SELECT 1
+            FROM (
+                SELECT *
+                FROM search_preference_answer
+                WHERE person_id = %(searcher_person_id)s) AS pref
+            LEFT JOIN
+                answer ans
+            ON
+                ans.person_id = prospect_person_id AND
+                ans.question_id = pref.question_id
+            WHERE
+                -- Contrary because the answer exists and is wrong
+                ans.answer IS NOT NULL AND
+                ans.answer != pref.answer
+            OR
+                -- Contrary because the answer doesn't exist but should
+                ans.answer IS NULL AND
+                pref.accept_unanswered = FALSE
+            LIMIT 1
+        )
+), ranked_prospects AS (
+    SELECT
+        prospect_person_id,
+        prospect_uuid,
+        profile_photo_uuid,
+        has_mutual_club,
+        name,
+        age::SMALLINT AS age,
+        match_percentage::SMALLINT AS match_percentage,
+        ROW_NUMBER() OVER (
+            ORDER BY
+                -- If this is changed, other queries will need changing too
+                (profile_photo_uuid IS NOT NULL) DESC,
+                has_mutual_club DESC,
+                match_percentage DESC
+        ) AS position
+    FROM
+        prospects_second_pass
+), updated_search_cache AS (
+    INSERT INTO search_cache (
+        searcher_person_id,
+        prospect_person_ids,
+        scores
+    )
+    SELECT
+        %(searcher_person_id)s,
+        COALESCE(
+            ARRAY_AGG(prospect_person_id ORDER BY position),
+            '{}'
+        ),
+        COALESCE(
+            ARRAY_AGG(
+                (
+                    200 * (profile_photo_uuid IS NOT NULL)::INT +
+                    100 * has_mutual_club::INT +
+                    match_percentage
+                )::SMALLINT
+                ORDER BY position
+            ),
+            '{}'
+        )
+    FROM
+        ranked_prospects
+    ON CONFLICT (searcher_person_id) DO UPDATE SET
+        prospect_person_ids = EXCLUDED.prospect_person_ids,
+        scores = EXCLUDED.scores,
+        cached_at = EXCLUDED.cached_at,
+        is_prewarmed = EXCLUDED.is_prewarmed
+), page AS MATERIALIZED (
+    SELECT
+        *
+    FROM
+        ranked_prospects
+    ORDER BY
+        position
+    LIMIT
+        %(n)s
+)
+SELECT
+    page.prospect_person_id,
+    page.prospect_uuid,
+    page.profile_photo_uuid,
+    page.name,
+    page.age,
+    page.match_percentage,
+    relationship.person_messaged_other AS person_messaged_prospect,
+    relationship.other_messaged_person AS prospect_messaged_person
+FROM
+    page
+JOIN
+    person_relationships(
+        %(searcher_person_id)s,
+        ARRAY(SELECT prospect_person_id FROM page)
+    ) AS relationship
+ON
+    relationship.other_person_id = page.prospect_person_id
+ORDER BY
+    page.position
+"""
+
+# Run after `Q_UNCACHED_SEARCH_2` by the `searchprewarm` cron module
+Q_MARK_SEARCH_CACHE_PREWARMED = """
+UPDATE
+    search_cache
+SET
+    is_prewarmed = TRUE
+WHERE
+    searcher_person_id = %(searcher_person_id)s
+"""
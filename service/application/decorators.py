@@ -11,6 +11,7 @@ from werkzeug.middleware.proxy_fix import ProxyFix
 import ipaddress
 import traceback
 from antispam import normalize_email
+import sessioncache
 
 disable_ip_rate_limit_file = (
     Path(__file__).parent.parent.parent /
@@ -92,7 +93,9 @@ SELECT
     duo_session.person_id,
     person.uuid::TEXT AS person_uuid,
     duo_session.email,
-    duo_session.signed_in
+    duo_session.signed_in,
+    EXTRACT(EPOCH FROM session_expiry - LOCALTIMESTAMP)::FLOAT
+        AS session_ttl_seconds
 FROM
     duo_session
 LEFT JOIN
@@ -176,10 +179,20 @@ def require_auth(expected_onboarding_status, expected_sign_in_status):
                 return 'Missing or malformed authorization header', 400
 
             session_token_hash = sha512(session_token)
-            params = dict(session_token_hash=session_token_hash)
-            row = None
-            with api_tx('READ COMMITTED') as tx:
-                row = tx.execute(Q_GET_SESSION, params).fetchone()
+            row = sessioncache.get(session_token_hash)
+
+            if row is None:
+                params = dict(session_token_hash=session_token_hash)
+                with api_tx('READ COMMITTED') as tx:
+                    row = tx.execute(Q_GET_SESSION, params).fetchone()
+
+                if row:
+                    session_ttl_seconds = row.pop('session_ttl_seconds')
+                    sessioncache.put(
+                        session_token_hash,
+                        row,
+                        session_ttl_seconds,
+                    )
 
             if row:
                 email=row['email']
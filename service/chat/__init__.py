@@ -1,91 +1,224 @@
 # TODO: Conversations need to be migrated
-from database.asyncdatabase import api_tx, chat_tx, check_connections_forever
+from database.asyncdatabase import (
+    api_conn,
+    api_tx,
+    chat_tx,
+    check_connections_forever,
+)
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler
 from lxml import etree
+from socketserver import TCPServer
 import asyncio
 import base64
+import contextlib
+from datetime import datetime, timedelta
 import duohash
+import duoloop
+import math
+import multiprocessing
+import os
 import regex
+import signal
+import threading
+import time
 import traceback
 import websockets
 import sys
-from websockets.exceptions import ConnectionClosedError
+from websockets.exceptions import ConnectionClosedError, ConnectionClosedOK
 
 
 PORT = sys.argv[1] if len(sys.argv) >= 2 else 5443
 
+# When set, this process becomes a supervisor which forks this many workers,
+# all listening on `PORT` via SO_REUSEPORT. 'auto' means one per available CPU.
+WORKERS = os.environ.get('DUO_CHAT_WORKERS', '')
+
+# After SIGTERM, workers stop accepting connections and wait this long for
+# existing connections to close before closing them
+DRAIN_SECONDS = float(os.environ.get('DUO_CHAT_DRAIN_SECONDS', '10'))
+
+# Workers whose event loops haven't sent a heartbeat for this long are killed
+# and replaced
+WORKER_HEARTBEAT_TIMEOUT_SECONDS = float(os.environ.get(
+    'DUO_CHAT_WORKER_HEARTBEAT_TIMEOUT_SECONDS',
+    '30',
+))
+
+# If set, the supervisor serves `/health` on this port
+HEALTH_PORT = os.environ.get('DUO_CHAT_HEALTH_PORT', '')
+
+# Frames waiting to be sent to each side of a connection are queued. Once a
+# queue holds `QUEUE_HIGH_WATERMARK` frames, reading from the side which fills
+# it is paused until it drains to `QUEUE_LOW_WATERMARK`. Connections which stay
+# paused for `QUEUE_SHED_SECONDS` are closed.
+QUEUE_HIGH_WATERMARK = int(os.environ.get(
+    'DUO_CHAT_QUEUE_HIGH_WATERMARK',
+    '256',
+))
+
+QUEUE_LOW_WATERMARK = int(os.environ.get(
+    'DUO_CHAT_QUEUE_LOW_WATERMARK',
+    '64',
+))
+
+QUEUE_SHED_SECONDS = float(os.environ.get(
+    'DUO_CHAT_QUEUE_SHED_SECONDS',
+    '30',
+))
+
+# Once either side of a connection closes, frames already queued for the other
+# side, such as MongooseIM's `<close/>`, get this long to be sent
+QUEUE_FLUSH_SECONDS = float(os.environ.get(
+    'DUO_CHAT_QUEUE_FLUSH_SECONDS',
+    '2',
+))
+
+QUEUE_STATS_SECONDS = float(os.environ.get(
+    'DUO_CHAT_QUEUE_STATS_SECONDS',
+    '60',
+))
+
+UPSTREAM_URL = os.environ.get('DUO_CHAT_UPSTREAM_URL', 'ws://127.0.0.1:5442')
+
+# The largest frame, in bytes, accepted from either websocket
+WS_MAX_SIZE = int(os.environ.get('DUO_CHAT_WS_MAX_SIZE', str(2 ** 20)))
+
+# How many received frames each websocket buffers before it stops reading
+WS_MAX_QUEUE = int(os.environ.get('DUO_CHAT_WS_MAX_QUEUE', '32'))
+
+# The size in bytes of each websocket's write buffer beyond which sends wait
+# for it to drain
+WS_WRITE_LIMIT = int(os.environ.get('DUO_CHAT_WS_WRITE_LIMIT', str(2 ** 16)))
+
+# Keepalive pings are sent to clients this often. 0 disables them.
+WS_PING_INTERVAL_SECONDS = float(os.environ.get(
+    'DUO_CHAT_WS_PING_INTERVAL_SECONDS',
+    '20',
+)) or None
+
+WS_PING_TIMEOUT_SECONDS = float(os.environ.get(
+    'DUO_CHAT_WS_PING_TIMEOUT_SECONDS',
+    '20',
+)) or None
+
+# Whether clients may negotiate permessage-deflate. It trades CPU for
+# bandwidth, so it's never used for the upstream, which is local.
+WS_PERMESSAGE_DEFLATE = os.environ.get(
+    'DUO_CHAT_WS_PERMESSAGE_DEFLATE',
+    'true',
+).lower() not in ['false', 'f', '0', 'no']
+
+_WS_LIMITS = dict(
+    max_size=WS_MAX_SIZE,
+    max_queue=WS_MAX_QUEUE,
+    write_limit=WS_WRITE_LIMIT,
+)
+
 # TODO: Lock down the XMPP server by only allowing certain types of message
 
+# `intro_hash` is partitioned, so it can't have a unique constraint on `hash`.
+# This lock stands in for one, and must be taken in a separate statement from
+# `Q_UNIQUENESS`, in a READ COMMITTED transaction.
+Q_LOCK_INTRO_HASH = """
+SELECT pg_advisory_xact_lock(hashtextextended(%(hash)s, 0))
+"""
+
 Q_UNIQUENESS = """
 INSERT INTO intro_hash (hash)
-VALUES (%(hash)s)
-ON CONFLICT DO NOTHING
+SELECT %(hash)s
+WHERE NOT EXISTS (SELECT 1 FROM intro_hash WHERE hash = %(hash)s)
 RETURNING hash
 """
 
-Q_IS_SKIPPED = """
-WITH from_username AS (
-    SELECT id FROM person WHERE uuid = %(from_username)s
-), to_username AS (
-    SELECT id FROM person WHERE uuid = %(to_username)s
+# Like `Q_UNIQUENESS`, but only looks at hashes created since `since`. Used
+# when `intro_hash_filter` says that no older hash matches, so that only the
+# newest partitions need searching.
+Q_UNIQUENESS_SINCE = """
+INSERT INTO intro_hash (hash)
+SELECT %(hash)s
+WHERE NOT EXISTS (
+    SELECT
+        1
+    FROM
+        intro_hash
+    WHERE
+        hash = %(hash)s
+    AND
+        created_at >= %(since)s
 )
+RETURNING hash
+"""
+
+Q_INTRO_HASHES = """
+SELECT
+    hash
+FROM
+    intro_hash
+WHERE
+    hash > %(after)s
+ORDER BY
+    hash
+LIMIT
+    %(n)s
+"""
+
+Q_INTRO_HASHES_SINCE = """
+SELECT
+    hash
+FROM
+    intro_hash
+WHERE
+    created_at >= %(since)s
+"""
+
+Q_NOW = """
+SELECT NOW()::TIMESTAMP AS now
+"""
+
+Q_PERSON_IDS = """
+SELECT
+    id,
+    uuid::TEXT
+FROM
+    person
+WHERE
+    uuid = ANY(%(uuids)s::UUID[])
+"""
+
+Q_IS_SKIPPED = """
 SELECT
     1
 FROM
     skipped
 WHERE
     (
-        subject_person_id = (SELECT id FROM from_username) AND
-        object_person_id  = (SELECT id FROM to_username)
+        subject_person_id = %(from_id)s AND
+        object_person_id  = %(to_id)s
     )
 OR
     (
-        subject_person_id = (SELECT id FROM to_username) AND
-        object_person_id  = (SELECT id FROM from_username)
+        subject_person_id = %(to_id)s AND
+        object_person_id  = %(from_id)s
     )
 LIMIT 1
 """
 
 Q_SET_MESSAGED = """
-WITH subject_person_id AS (
-    SELECT
-        id
-    FROM
-        person
-    WHERE
-        uuid = %(subject_person_id)s
-), object_person_id AS (
-    SELECT
-        id
-    FROM
-        person
-    WHERE
-        uuid = %(object_person_id)s
-), can_insert AS (
-    SELECT
-        1
-    WHERE
-        EXISTS (SELECT 1 FROM subject_person_id)
-    AND EXISTS (SELECT 1 FROM object_person_id)
-), insertion AS (
-    INSERT INTO messaged (
-        subject_person_id,
-        object_person_id
-    )
-    SELECT
-        (SELECT id FROM subject_person_id),
-        (SELECT id FROM object_person_id)
-    WHERE EXISTS (
-        SELECT
-            1
-        FROM
-            can_insert
-    )
-    ON CONFLICT DO NOTHING
+INSERT INTO messaged (
+    subject_person_id,
+    object_person_id
 )
 SELECT
-    1
+    subject_person_id,
+    object_person_id
 FROM
-    can_insert
+    UNNEST(
+        %(subject_person_ids)s::INT[],
+        %(object_person_ids)s::INT[]
+    ) AS t(subject_person_id, object_person_id)
+ON CONFLICT DO NOTHING
 """
 
 Q_SET_TOKEN = """
@@ -101,6 +234,45 @@ DO UPDATE SET
 
 MAX_MESSAGE_LEN = 5000
 
+RELATIONSHIP_CACHE_SIZE = int(os.environ.get(
+    'DUO_CHAT_RELATIONSHIP_CACHE_SIZE',
+    '100000',
+))
+
+# `messaged` rows are written in batches which are flushed after this long, or
+# once they reach `MESSAGED_BATCH_SIZE`, whichever comes first
+MESSAGED_FLUSH_SECONDS = float(os.environ.get(
+    'DUO_CHAT_MESSAGED_FLUSH_SECONDS',
+    '0.005',
+))
+
+MESSAGED_BATCH_SIZE = int(os.environ.get(
+    'DUO_CHAT_MESSAGED_BATCH_SIZE',
+    '100',
+))
+
+INTRO_HASH_FILTER_CAPACITY = int(os.environ.get(
+    'DUO_CHAT_INTRO_HASH_FILTER_CAPACITY',
+    '5000000',
+))
+
+INTRO_HASH_FILTER_FALSE_POSITIVE_RATE = float(os.environ.get(
+    'DUO_CHAT_INTRO_HASH_FILTER_FALSE_POSITIVE_RATE',
+    '0.01',
+))
+
+# Hashes inserted by other chat processes are picked up this often. Until
+# then, uniqueness checks for hashes which aren't in the filter have to search
+# every partition created since the last refresh.
+INTRO_HASH_FILTER_REFRESH_SECONDS = float(os.environ.get(
+    'DUO_CHAT_INTRO_HASH_FILTER_REFRESH_SECONDS',
+    '10',
+))
+
+# Added to the refresh interval to cover transactions which committed after
+# the previous refresh, but whose `created_at` was set before it
+_INTRO_HASH_FILTER_REFRESH_OVERLAP = timedelta(seconds=30)
+
 NON_ALPHANUMERIC_RE = regex.compile(r'[^\p{L}\p{N}]')
 REPEATED_CHARACTERS_RE = regex.compile(r'(.)\1{1,}')
 
@@ -108,41 +280,312 @@ class Username:
     def __init__(self):
         self.username = None
 
+class LruCache:
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        return self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+class RelationshipCache:
+    """
+    Caches persons' IDs by UUID, whether pairs of persons have skipped each
+    other, and which persons have messaged whom. Entries are dropped when the
+    `chat_relationship` notifications sent by triggers in init.sql say they've
+    changed. The cache is only used while those notifications are being
+    received.
+    """
+    def __init__(self, max_size: int):
+        self.is_ready = False
+
+        # Incremented on every invalidation, so that query results which might
+        # predate an invalidation aren't cached
+        self.generation = 0
+
+        self._ids = LruCache(max_size)
+        self._uuids = LruCache(max_size)
+        self._skipped = LruCache(max_size)
+        self._messaged = LruCache(max_size)
+
+    def _enabled(self, generation: int):
+        return self.is_ready and generation == self.generation
+
+    def get_id(self, uuid: str) -> int | None:
+        return self._ids.get(uuid) if self.is_ready else None
+
+    def put_id(self, uuid: str, person_id: int, generation: int):
+        if self._enabled(generation):
+            self._ids.put(uuid, person_id)
+            self._uuids.put(person_id, uuid)
+
+    def get_is_skipped(self, a: int, b: int) -> bool | None:
+        return self._skipped.get(frozenset([a, b])) if self.is_ready else None
+
+    def put_is_skipped(self, a: int, b: int, is_skipped: bool, generation: int):
+        if self._enabled(generation):
+            self._skipped.put(frozenset([a, b]), is_skipped)
+
+    def get_has_messaged(self, subject: int, object_: int) -> bool:
+        return self.is_ready and bool(self._messaged.get((subject, object_)))
+
+    def put_has_messaged(self, subject: int, object_: int, generation: int):
+        if self._enabled(generation):
+            self._messaged.put((subject, object_), True)
+
+    def invalidate(self, payload: str):
+        self.generation += 1
+
+        table, *ids = payload.split()
+        ids = [int(i) for i in ids]
+
+        if table == 'person':
+            [person_id] = ids
+            uuid = self._uuids.pop(person_id)
+            if uuid is not None:
+                self._ids.pop(uuid)
+        elif table == 'skipped':
+            self._skipped.pop(frozenset(ids))
+        elif table == 'messaged':
+            self._messaged.pop(tuple(ids))
+
+    def clear(self):
+        self.generation += 1
+
+        self._ids.clear()
+        self._uuids.clear()
+        self._skipped.clear()
+        self._messaged.clear()
+
+relationship_cache = RelationshipCache(RELATIONSHIP_CACHE_SIZE)
+
+class MessagedWriter:
+    """
+    Inserts `messaged` rows for pairs which aren't already known to have
+    messaged. Pairs are deduplicated in memory and inserted in multi-row
+    batches. Callers wait for their pair's batch to commit, because `messaged`
+    has to exist before a first message is delivered.
+    """
+    def __init__(self, flush_seconds: float, batch_size: int):
+        self._flush_seconds = flush_seconds
+        self._batch_size = batch_size
+
+        self._pending: dict[tuple[int, int], asyncio.Future] = {}
+        self._is_full = asyncio.Event()
+        self._flush_task = None
+
+    async def write(self, subject_id: int, object_id: int) -> bool:
+        if relationship_cache.get_has_messaged(subject_id, object_id):
+            return True
+
+        key = (subject_id, object_id)
+
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = future
+
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_soon())
+        if len(self._pending) >= self._batch_size:
+            self._is_full.set()
+
+        # Shielded so that one caller's cancellation doesn't affect others
+        # waiting on the same pair
+        return await asyncio.shield(future)
+
+    async def _flush_soon(self):
+        try:
+            await asyncio.wait_for(self._is_full.wait(), self._flush_seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._is_full.clear()
+            self._flush_task = None
+
+        batch, self._pending = self._pending, {}
+
+        generation = relationship_cache.generation
+
+        try:
+            await self._insert(list(batch))
+            results = {key: True for key in batch}
+        except:
+            # One bad pair (e.g. a person who was just deleted) fails the whole
+            # batch, so retry the pairs one at a time
+            results = {key: await self._insert_one(key) for key in batch}
+
+        for key, future in batch.items():
+            if results[key]:
+                relationship_cache.put_has_messaged(*key, generation)
+            future.set_result(results[key])
+
+    async def _insert(self, keys: list[tuple[int, int]]):
+        params = dict(
+            subject_person_ids=[subject_id for subject_id, _ in keys],
+            object_person_ids=[object_id for _, object_id in keys],
+        )
+
+        async with api_tx() as tx:
+            await tx.execute(Q_SET_MESSAGED, params)
+
+    async def _insert_one(self, key: tuple[int, int]) -> bool:
+        try:
+            await self._insert([key])
+            return True
+        except:
+            return False
+
+messaged_writer = MessagedWriter(MESSAGED_FLUSH_SECONDS, MESSAGED_BATCH_SIZE)
+
+class BloomFilter:
+    """
+    A Bloom filter of the hex MD5 hashes in `intro_hash`. A hash which isn't in
+    the filter definitely isn't among the hashes created before
+    `covers_until`. Newer ones, which other chat processes might have
+    inserted, still need checking in the database.
+    """
+    def __init__(self, capacity: int, false_positive_rate: float):
+        num_bits = int(
+            -capacity * math.log(false_positive_rate) / math.log(2) ** 2)
+
+        self._num_bits = max(8, num_bits)
+        self._num_hashes = max(
+            1,
+            round(self._num_bits / capacity * math.log(2)))
+        self._bits = bytearray((self._num_bits + 7) // 8)
+
+        self.is_ready = False
+        self.covers_until: datetime | None = None
+
+    def _positions(self, md5_hash: str):
+        # MD5 hashes are already uniformly distributed, so the positions are
+        # derived from the hash's two halves by double hashing
+        h1 = int(md5_hash[:16], 16)
+        h2 = int(md5_hash[16:], 16) | 1
+
+        return (
+            (h1 + i * h2) % self._num_bits
+            for i in range(self._num_hashes)
+        )
+
+    def add(self, md5_hash: str):
+        for position in self._positions(md5_hash):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, md5_hash: str):
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(md5_hash)
+        )
+
+def _new_intro_hash_filter():
+    return BloomFilter(
+        INTRO_HASH_FILTER_CAPACITY,
+        INTRO_HASH_FILTER_FALSE_POSITIVE_RATE,
+    )
+
+intro_hash_filter = _new_intro_hash_filter()
+
+@dataclass(frozen=True)
+class AuthFrame:
+    username: str
+
+@dataclass(frozen=True)
+class RegisterPushTokenFrame:
+    token: str
+
+@dataclass(frozen=True)
+class ChatMessageFrame:
+    id: str
+    to: str
+    do_check_uniqueness: bool
+    maybe_message_body: str | None
+
+Frame = AuthFrame | RegisterPushTokenFrame | ChatMessageFrame | None
+
+# A safe XML parser. Parsers aren't thread-safe, but each chat process only
+# parses on its event loop's thread, so one can be shared.
+_XML_PARSER = etree.XMLParser(resolve_entities=False, no_network=True)
+
 def parse_xml(s):
-    parser = etree.XMLParser(resolve_entities=False, no_network=True)
-    return etree.fromstring(s, parser=parser)
+    return etree.fromstring(s, parser=_XML_PARSER)
 
-def get_message_attrs(message_xml):
-    try:
-        # Create a safe XML parser
-        root = parse_xml(message_xml)
+def _classify_auth(root) -> AuthFrame:
+    decodedBytes = base64.b64decode(root.text)
+    decodedString = decodedBytes.decode('utf-8')
+
+    auth_parts = decodedString.split('\0')
+
+    return AuthFrame(username=auth_parts[1])
 
-        if root.tag != '{jabber:client}message':
-            raise Exception('Not a message')
+def _classify_register_push_token(root) -> RegisterPushTokenFrame:
+    token = root.attrib.get('token')
 
-        if root.attrib.get('type') != 'chat':
-            raise Exception('type != chat')
+    if not token:
+        raise Exception('Token not set in duo_register_push_token')
 
-        do_check_uniqueness = root.attrib.get('check_uniqueness') == 'true'
+    return RegisterPushTokenFrame(token=token)
 
-        maybe_message_body = root.find('{jabber:client}body')
+def _classify_chat_message(root) -> ChatMessageFrame:
+    if root.attrib.get('type') != 'chat':
+        raise Exception('type != chat')
 
-        maybe_message_body = None
-        body = root.find('{jabber:client}body')
-        if body is not None:
-            maybe_message_body = body.text
+    do_check_uniqueness = root.attrib.get('check_uniqueness') == 'true'
 
-        _id = root.attrib.get('id')
-        assert _id is not None
+    maybe_message_body = None
+    body = root.find('{jabber:client}body')
+    if body is not None:
+        maybe_message_body = body.text
 
-        to = root.attrib.get('to')
-        assert to is not None
+    _id = root.attrib.get('id')
+    assert _id is not None
 
-        return (True, _id, to, do_check_uniqueness, maybe_message_body)
+    to = root.attrib.get('to')
+    assert to is not None
+
+    return ChatMessageFrame(
+        id=_id,
+        to=to,
+        do_check_uniqueness=do_check_uniqueness,
+        maybe_message_body=maybe_message_body,
+    )
+
+_CLASSIFIERS = {
+    '{urn:ietf:params:xml:ns:xmpp-sasl}auth': _classify_auth,
+    'duo_register_push_token': _classify_register_push_token,
+    '{jabber:client}message': _classify_chat_message,
+}
+
+def classify_frame(message_xml) -> Frame:
+    """
+    Parses `message_xml` once and returns the record which the auth, push token
+    registration and message handlers need from it, or None if it's none of
+    those and should just be forwarded.
+    """
+    try:
+        root = parse_xml(message_xml)
+        classifier = _CLASSIFIERS.get(root.tag)
+        return classifier(root) if classifier else None
     except Exception as e:
         pass
 
-    return False, None, None, None, None
+    return None
 
 def normalize_message(message_str):
     message_str = message_str.lower()
@@ -158,25 +601,17 @@ def normalize_message(message_str):
 def is_message_too_long(message_str):
     return len(message_str) > MAX_MESSAGE_LEN
 
-async def maybe_register(message_xml, username):
+async def maybe_register(frame: Frame, username):
     if not username:
         return False
 
-    try:
-        # Create a safe XML parser
-        root = parse_xml(message_xml)
-
-        if root.tag != 'duo_register_push_token':
-            raise Exception('Not a duo_register_push_token message')
-
-        token = root.attrib.get('token')
-
-        if not token:
-            raise Exception('Token not set in duo_register_push_token')
+    if not isinstance(frame, RegisterPushTokenFrame):
+        return False
 
+    try:
         params = dict(
             username=username,
-            token=token,
+            token=frame.token,
         )
 
         async with chat_tx() as tx:
@@ -194,92 +629,209 @@ async def is_message_unique(message_str):
 
     params = dict(hash=hashed)
 
+    # Read before awaiting, in case the filter is replaced in the meantime
+    _intro_hash_filter = intro_hash_filter
+
+    # A miss in the filter isn't enough to skip the database, since the hash
+    # might've been sent through another process since the filter was last
+    # refreshed. It does mean that only hashes newer than that need checking.
+    if _intro_hash_filter.is_ready and hashed not in _intro_hash_filter:
+        q_uniqueness = Q_UNIQUENESS_SINCE
+        params['since'] = _intro_hash_filter.covers_until
+    else:
+        q_uniqueness = Q_UNIQUENESS
+
     try:
-        async with chat_tx() as tx:
-            cursor = await tx.execute(Q_UNIQUENESS, params)
+        async with chat_tx('READ COMMITTED') as tx:
+            await tx.execute(Q_LOCK_INTRO_HASH, params)
+            cursor = await tx.execute(q_uniqueness, params)
             rows = await cursor.fetchall()
-            return bool(rows)
+
+        _intro_hash_filter.add(hashed)
+
+        return bool(rows)
     except:
         print(traceback.format_exc())
     return True
 
+async def _db_now():
+    async with chat_tx() as tx:
+        cursor = await tx.execute(Q_NOW)
+        return (await cursor.fetchone())['now']
+
+async def load_intro_hashes_forever(page_size: int = 10000):
+    global intro_hash_filter
+
+    while True:
+        try:
+            loaded_at = await _db_now()
+
+            fresh = _new_intro_hash_filter()
+
+            after = ''
+            while True:
+                params = dict(after=after, n=page_size)
+
+                async with chat_tx() as tx:
+                    cursor = await tx.execute(Q_INTRO_HASHES, params)
+                    rows = await cursor.fetchall()
+
+                for row in rows:
+                    fresh.add(row['hash'])
+
+                if len(rows) < page_size:
+                    break
+
+                after = rows[-1]['hash']
+
+            fresh.covers_until = loaded_at - _INTRO_HASH_FILTER_REFRESH_OVERLAP
+            fresh.is_ready = True
+            intro_hash_filter = fresh
+
+            while True:
+                await asyncio.sleep(INTRO_HASH_FILTER_REFRESH_SECONDS)
+
+                refreshed_at = await _db_now()
+
+                params = dict(
+                    since=loaded_at - _INTRO_HASH_FILTER_REFRESH_OVERLAP)
+
+                async with chat_tx() as tx:
+                    cursor = await tx.execute(Q_INTRO_HASHES_SINCE, params)
+                    rows = await cursor.fetchall()
+
+                for row in rows:
+                    fresh.add(row['hash'])
+
+                fresh.covers_until = (
+                    refreshed_at - _INTRO_HASH_FILTER_REFRESH_OVERLAP)
+
+                loaded_at = refreshed_at
+        except Exception:
+            print(traceback.format_exc())
+
+        intro_hash_filter.is_ready = False
+        await asyncio.sleep(5)
+
+async def get_person_ids(*uuids: str) -> list[int | None]:
+    """
+    Returns the ID of each person in `uuids`, or None for persons who don't
+    exist.
+    """
+    # Matches the canonical form which `Q_PERSON_IDS` returns
+    uuids = [uuid.lower() for uuid in uuids]
+
+    ids = {uuid: relationship_cache.get_id(uuid) for uuid in uuids}
+
+    missing = [uuid for uuid, person_id in ids.items() if person_id is None]
+
+    if missing:
+        generation = relationship_cache.generation
+
+        async with api_tx() as tx:
+            cursor = await tx.execute(Q_PERSON_IDS, dict(uuids=missing))
+            rows = await cursor.fetchall()
+
+        for row in rows:
+            ids[row['uuid']] = row['id']
+            relationship_cache.put_id(row['uuid'], row['id'], generation)
+
+    return [ids[uuid] for uuid in uuids]
+
 async def is_message_blocked(username, to_jid):
     try:
         from_username = username
         to_username = to_jid.split('@')[0]
 
+        from_id, to_id = await get_person_ids(from_username, to_username)
+
+        if from_id is None or to_id is None:
+            return False
+
+        is_skipped = relationship_cache.get_is_skipped(from_id, to_id)
+        if is_skipped is not None:
+            return is_skipped
+
+        generation = relationship_cache.generation
+
         params = dict(
-            from_username=from_username,
-            to_username=to_username,
+            from_id=from_id,
+            to_id=to_id,
         )
 
         async with api_tx() as tx:
             cursor = await tx.execute(Q_IS_SKIPPED, params)
             fetched = await cursor.fetchall()
-            return bool(fetched)
+
+        is_skipped = bool(fetched)
+
+        relationship_cache.put_is_skipped(
+            from_id,
+            to_id,
+            is_skipped,
+            generation,
+        )
+
+        return is_skipped
     except:
         print(traceback.format_exc())
         return True
 
-    return False
-
 async def set_messaged(username, to_jid):
     from_username = username
     to_username = to_jid.split('@')[0]
 
-    params = dict(
-        subject_person_id=from_username,
-        object_person_id=to_username,
-    )
-
     try:
-        async with api_tx() as tx:
-            cursor = await tx.execute(Q_SET_MESSAGED, params)
-            rows = await cursor.fetchall()
-            return bool(rows)
+        subject_id, object_id = await get_person_ids(from_username, to_username)
+
+        if subject_id is None or object_id is None:
+            return False
+
+        return await messaged_writer.write(subject_id, object_id)
     except:
         pass
 
     return False
 
-def process_auth(message_str, username):
-    if username.username is not None:
-        return
-
-    try:
-        # Create a safe XML parser
-        root = parse_xml(message_str)
+async def listen_for_relationship_changes_forever():
+    while True:
+        try:
+            async with await api_conn() as conn:
+                await conn.execute('LISTEN chat_relationship')
 
-        if root.tag != '{urn:ietf:params:xml:ns:xmpp-sasl}auth':
-            raise Exception('Not an auth message')
+                # Notifications might have been missed while we weren't
+                # listening
+                relationship_cache.clear()
+                relationship_cache.is_ready = True
 
-        base64encoded = root.text
-        decodedBytes = base64.b64decode(base64encoded)
-        decodedString = decodedBytes.decode('utf-8')
+                async for notify in conn.notifies():
+                    relationship_cache.invalidate(notify.payload)
+        except Exception:
+            print(traceback.format_exc())
 
-        auth_parts = decodedString.split('\0')
+        relationship_cache.is_ready = False
+        relationship_cache.clear()
+        await asyncio.sleep(5)
 
-        auth_username = auth_parts[1]
+def process_auth(frame: Frame, username):
+    if username.username is not None:
+        return
 
-        username.username = auth_username
-    except Exception as e:
-        pass
+    if isinstance(frame, AuthFrame):
+        username.username = frame.username
 
-async def process_duo_message(message_xml, username):
-    if await maybe_register(message_xml, username):
+async def process_duo_message(message_xml, frame: Frame, username):
+    if await maybe_register(frame, username):
         return ['<duo_registration_successful />'], []
 
-    (
-        is_message,
-        id,
-        to_jid,
-        do_check_uniqueness,
-        maybe_message_body,
-    ) = get_message_attrs(message_xml)
-
-    if not is_message:
+    if not isinstance(frame, ChatMessageFrame):
         return [], [message_xml]
 
+    id = frame.id
+    to_jid = frame.to
+    do_check_uniqueness = frame.do_check_uniqueness
+    maybe_message_body = frame.maybe_message_body
+
     if maybe_message_body and is_message_too_long(maybe_message_body):
         return [f'<duo_message_too_long id="{id}"/>'], []
 
@@ -311,62 +863,401 @@ async def process_duo_message(message_xml, username):
 
     return [], []
 
-async def process(src, dst, username):
-    try:
-        async for message in src:
-            process_auth(message, username)
-            to_src, to_dst = await process_duo_message(message, username.username)
-
-            for m in to_dst:
-                await dst.send(m)
-            for m in to_src:
-                await src.send(m)
-    except ConnectionClosedError as e:
-        print("Connection closed while processing:", e)
-    except Exception as e:
-        print("Error processing messages:", e)
-    finally:
-        await src.close()
-        await dst.close()
-        print("Connections closed in process()")
+class QueueStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.max_depth = 0
+        self.total_seconds_in_queue = 0.0
+        self.max_seconds_in_queue = 0.0
+        self.pauses = 0
+        self.sheds = 0
+
+    def pop(self) -> dict[str, int | float]:
+        stats = dict(
+            frames=self.frames,
+            max_depth=self.max_depth,
+            mean_seconds_in_queue=(
+                self.total_seconds_in_queue / self.frames
+                if self.frames else 0.0),
+            max_seconds_in_queue=self.max_seconds_in_queue,
+            pauses=self.pauses,
+            sheds=self.sheds,
+        )
 
-async def forward(src, dst):
-    try:
-        async for message in src:
-            await dst.send(message)
-    except ConnectionClosedError:
-        print("Connection closed while forwarding")
-    except Exception as e:
-        print("Error forwarding messages:", e)
-    finally:
-        await src.close()
-        await dst.close()
-        print("Connections closed in forward()")
+        self.reset()
+
+        return stats
+
+queue_stats = QueueStats()
+
+class QueueOverloaded(Exception):
+    pass
+
+class FrameQueue:
+    """
+    The frames waiting to be sent to one websocket
+    """
+    def __init__(
+        self,
+        high_watermark: int,
+        low_watermark: int,
+        shed_seconds: float,
+    ):
+        self._high_watermark = high_watermark
+        self._low_watermark = min(low_watermark, high_watermark)
+        self._shed_seconds = shed_seconds
+
+        self._frames: deque[tuple[float, str]] = deque()
+        self._not_empty = asyncio.Event()
+        self._is_closed = False
+        self._below_high_watermark = asyncio.Event()
+        self._below_high_watermark.set()
+
+    async def put(self, frame: str):
+        if not self._below_high_watermark.is_set():
+            queue_stats.pauses += 1
+            try:
+                await asyncio.wait_for(
+                    self._below_high_watermark.wait(),
+                    self._shed_seconds,
+                )
+            except asyncio.TimeoutError:
+                queue_stats.sheds += 1
+                raise QueueOverloaded()
+
+        self._frames.append((time.monotonic(), frame))
+        self._not_empty.set()
+
+        depth = len(self._frames)
+        if depth >= self._high_watermark:
+            self._below_high_watermark.clear()
+
+        queue_stats.max_depth = max(queue_stats.max_depth, depth)
+
+    def close(self):
+        """
+        Makes `get` return None once the queued frames have been taken
+        """
+        self._is_closed = True
+        self._not_empty.set()
+
+    async def get(self) -> str | None:
+        while not self._frames:
+            if self._is_closed:
+                return None
+
+            self._not_empty.clear()
+            await self._not_empty.wait()
+
+        enqueued_at, frame = self._frames.popleft()
+
+        if len(self._frames) <= self._low_watermark:
+            self._below_high_watermark.set()
+
+        seconds_in_queue = time.monotonic() - enqueued_at
+        queue_stats.frames += 1
+        queue_stats.total_seconds_in_queue += seconds_in_queue
+        queue_stats.max_seconds_in_queue = max(
+            queue_stats.max_seconds_in_queue,
+            seconds_in_queue,
+        )
+
+        return frame
+
+def _new_frame_queue():
+    return FrameQueue(
+        QUEUE_HIGH_WATERMARK,
+        QUEUE_LOW_WATERMARK,
+        QUEUE_SHED_SECONDS,
+    )
+
+async def process(src, to_src: FrameQueue, to_dst: FrameQueue, username):
+    async for message in src:
+        frame = classify_frame(message)
+        process_auth(frame, username)
+        src_messages, dst_messages = await process_duo_message(
+            message,
+            frame,
+            username.username,
+        )
+
+        for m in dst_messages:
+            await to_dst.put(m)
+        for m in src_messages:
+            await to_src.put(m)
+
+async def forward(src, to_dst: FrameQueue):
+    async for message in src:
+        await to_dst.put(message)
+
+async def send(queue: FrameQueue, dst):
+    while (frame := await queue.get()) is not None:
+        await dst.send(frame)
 
 async def proxy(local_ws, path):
     username = Username()
 
-    async with websockets.connect('ws://127.0.0.1:5442') as remote_ws:
-        l2r_task = asyncio.ensure_future(process(local_ws, remote_ws, username))
-        r2l_task = asyncio.ensure_future(forward(remote_ws, local_ws))
+    to_local = _new_frame_queue()
+    to_remote = _new_frame_queue()
+
+    async with websockets.connect(
+        UPSTREAM_URL,
+        compression=None,
+        **_WS_LIMITS,
+    ) as remote_ws:
+        receive_tasks = [
+            asyncio.ensure_future(
+                process(local_ws, to_local, to_remote, username)),
+            asyncio.ensure_future(forward(remote_ws, to_local)),
+        ]
+
+        send_tasks = [
+            asyncio.ensure_future(send(to_remote, remote_ws)),
+            asyncio.ensure_future(send(to_local, local_ws)),
+        ]
+
+        tasks = receive_tasks + send_tasks
+
+        try:
+            done, pending = await asyncio.wait(
+                tasks,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+
+            for task in done:
+                e = task.exception()
+                if isinstance(e, QueueOverloaded):
+                    print("Connection shed: queue stayed full")
+                elif isinstance(e, ConnectionClosedError):
+                    print("Connection closed while proxying:", e)
+                elif isinstance(e, ConnectionClosedOK):
+                    pass
+                elif e is not None:
+                    print("Error proxying messages:", e)
+        finally:
+            for task in receive_tasks:
+                task.cancel()
+
+            # Sends whatever was already queued before closing, so that
+            # frames like `<close/>` and receipts for stored messages aren't
+            # lost
+            to_local.close()
+            to_remote.close()
+
+            flushed, unflushed = await asyncio.wait(
+                send_tasks,
+                timeout=QUEUE_FLUSH_SECONDS,
+            )
+
+            for task in unflushed:
+                task.cancel()
+
+            for task in flushed:
+                # Retrieved so that asyncio doesn't log it. The connection is
+                # being closed anyway.
+                task.exception()
+
+            await local_ws.close()
+            await remote_ws.close()
+
+async def print_queue_stats_forever():
+    while True:
+        await asyncio.sleep(QUEUE_STATS_SECONDS)
+
+        stats = queue_stats.pop()
+        if stats['frames'] or stats['pauses']:
+            print('Chat queue stats:', stats)
+
+async def serve(stop: asyncio.Event, reuse_port: bool = False):
+    server = await websockets.serve(
+        proxy,
+        '0.0.0.0',
+        PORT,
+        subprotocols=['xmpp'],
+        reuse_port=reuse_port,
+        ping_interval=WS_PING_INTERVAL_SECONDS,
+        ping_timeout=WS_PING_TIMEOUT_SECONDS,
+        compression='deflate' if WS_PERMESSAGE_DEFLATE else None,
+        **_WS_LIMITS,
+    )
 
-        done, pending = await asyncio.wait(
-            [l2r_task, r2l_task],
-            return_when=asyncio.FIRST_COMPLETED,
-        )
+    await stop.wait()
+
+    # Stop accepting connections, so that they go to other workers, then give
+    # existing connections a chance to finish before closing them
+    server.server.close()
 
-        for task in pending:
-            task.cancel()
+    deadline = time.monotonic() + DRAIN_SECONDS
+    while server.websockets and time.monotonic() < deadline:
+        await asyncio.sleep(0.5)
 
-async def serve():
-    async with websockets.serve(proxy, '0.0.0.0', PORT, subprotocols=['xmpp']):
-        await asyncio.Future()
+    server.close()
+    await server.wait_closed()
 
+async def heartbeat_forever(heartbeats, worker_index: int):
+    while True:
+        heartbeats[worker_index] = time.time()
+        await asyncio.sleep(1)
 
-async def main():
-    await asyncio.gather(
-        serve(),
+async def main(heartbeats=None, worker_index: int | None = None):
+    stop = asyncio.Event()
+
+    loop = asyncio.get_running_loop()
+    for signum in [signal.SIGTERM, signal.SIGINT]:
+        loop.add_signal_handler(signum, stop.set)
+
+    background = [
         check_connections_forever(),
-    )
+        listen_for_relationship_changes_forever(),
+        load_intro_hashes_forever(),
+        print_queue_stats_forever(),
+    ]
+
+    if worker_index is not None:
+        background.append(heartbeat_forever(heartbeats, worker_index))
+
+    background_tasks = asyncio.gather(*background)
+
+    try:
+        await serve(stop, reuse_port=worker_index is not None)
+    finally:
+        background_tasks.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await background_tasks
+
+def _num_workers() -> int:
+    if WORKERS == 'auto':
+        return len(os.sched_getaffinity(0))
+    else:
+        return int(WORKERS)
+
+def _serve_health(heartbeats, pid_to_index: dict[int, int]) -> TCPServer:
+    class HealthCheckHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/health':
+                self.send_response(404)
+                self.end_headers()
+                return
+
+            now = time.time()
+
+            workers = {
+                index: now - heartbeats[index]
+                for index in pid_to_index.copy().values()
+            }
+
+            is_healthy = (
+                len(workers) == len(heartbeats) and
+                all(
+                    age < WORKER_HEARTBEAT_TIMEOUT_SECONDS
+                    for age in workers.values()
+                )
+            )
+
+            self.send_response(200 if is_healthy else 503)
+            self.end_headers()
+            for index, age in sorted(workers.items()):
+                self.wfile.write(
+                    f'worker {index}: last heartbeat {age:.1f}s ago\n'
+                    .encode())
+
+        def log_message(self, *args):
+            pass
+
+    httpd = TCPServer(('0.0.0.0', int(HEALTH_PORT)), HealthCheckHandler)
+
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    return httpd
+
+def supervise(num_workers: int):
+    heartbeats = multiprocessing.RawArray('d', num_workers)
+    pid_to_index: dict[int, int] = {}
+    is_stopping = False
+    kill_deadline = math.inf
+
+    httpd = _serve_health(heartbeats, pid_to_index) if HEALTH_PORT else None
+
+    def spawn(worker_index: int):
+        heartbeats[worker_index] = time.time()
+
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+            if httpd:
+                httpd.socket.close()
+
+            exit_code = 0
+            try:
+                duoloop.run(main(heartbeats, worker_index))
+            except:
+                print(traceback.format_exc())
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+
+        pid_to_index[pid] = worker_index
+
+    def stop(signum, frame):
+        nonlocal is_stopping, kill_deadline
+
+        if not is_stopping:
+            # Workers which are still draining after this are killed
+            kill_deadline = time.monotonic() + DRAIN_SECONDS + 5
+
+        is_stopping = True
+
+        for pid in pid_to_index:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for worker_index in range(num_workers):
+        spawn(worker_index)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    print(f'Started {num_workers} chat workers on port {PORT}')
+
+    while pid_to_index:
+        while pid_to_index:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+
+            worker_index = pid_to_index.pop(pid)
+
+            if not is_stopping:
+                print(f'Chat worker {worker_index} exited ({status})')
+                spawn(worker_index)
+
+        if not is_stopping:
+            now = time.time()
+            for pid, worker_index in pid_to_index.items():
+                age = now - heartbeats[worker_index]
+                if age > WORKER_HEARTBEAT_TIMEOUT_SECONDS:
+                    print(f'Chat worker {worker_index} is unresponsive')
+                    os.kill(pid, signal.SIGKILL)
+        elif time.monotonic() > kill_deadline:
+            for pid, worker_index in pid_to_index.items():
+                print(f'Chat worker {worker_index} did not drain in time')
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+            kill_deadline = math.inf
+
+        time.sleep(1)
 
-asyncio.run(main())
+if WORKERS:
+    supervise(_num_workers())
+else:
+    duoloop.run(main())
@@ -1,8 +1,129 @@
 BEGIN;
 
+-- `intro_hash` is partitioned by month so that old hashes can be dropped a
+-- partition at a time, keeping its indexes small. Hashes can't be unique across
+-- partitions, so uniqueness checks lock the hash with `pg_advisory_xact_lock`
+-- and then look in every partition.
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_class WHERE relname = 'intro_hash' AND relkind = 'r'
+    ) THEN
+        ALTER TABLE intro_hash RENAME TO intro_hash_unpartitioned;
+        ALTER TABLE intro_hash_unpartitioned
+            RENAME CONSTRAINT intro_hash_pkey
+            TO intro_hash_unpartitioned_pkey;
+    END IF;
+END $$;
+
 CREATE TABLE IF NOT EXISTS intro_hash (
-    hash TEXT PRIMARY KEY
-);
+    hash TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE IF NOT EXISTS intro_hash_default
+PARTITION OF intro_hash DEFAULT;
+
+CREATE INDEX IF NOT EXISTS duo_idx__intro_hash__hash
+ON intro_hash(hash);
+
+CREATE INDEX IF NOT EXISTS duo_idx__intro_hash__created_at
+ON intro_hash(created_at);
+
+-- Creates the partitions of `intro_hash` for this month and next month, and
+-- drops the partitions which only hold hashes older than `retention`, unless
+-- it's NULL. Called periodically by the `introhash` cron module.
+--
+-- If the partitions weren't created in time, hashes for their month will have
+-- landed in the default partition. A partition can't be created while the
+-- default one holds rows in its range, so the partition is created detached,
+-- the rows are moved into it, and then it's attached.
+CREATE OR REPLACE FUNCTION maintain_intro_hash_partitions(retention INTERVAL)
+RETURNS VOID AS $$
+DECLARE
+    this_month TIMESTAMP := date_trunc('month', NOW()::TIMESTAMP);
+    month_start TIMESTAMP;
+    partition_name TEXT;
+    partition RECORD;
+BEGIN
+    FOR i IN 0..1 LOOP
+        month_start := this_month + i * INTERVAL '1 month';
+        partition_name := 'intro_hash_' || to_char(month_start, 'YYYY_MM');
+
+        CONTINUE WHEN to_regclass(partition_name) IS NOT NULL;
+
+        -- Stops new rows landing in the default partition until the new
+        -- partition is attached
+        LOCK TABLE intro_hash_default IN EXCLUSIVE MODE;
+
+        EXECUTE format(
+            'CREATE TABLE %I (LIKE intro_hash INCLUDING DEFAULTS)',
+            partition_name
+        );
+
+        EXECUTE format(
+            'WITH moved AS ('
+            '    DELETE FROM intro_hash_default '
+            '    WHERE created_at >= %L AND created_at < %L '
+            '    RETURNING hash, created_at'
+            ') '
+            'INSERT INTO %I (hash, created_at) '
+            'SELECT hash, created_at FROM moved',
+            month_start,
+            month_start + INTERVAL '1 month',
+            partition_name
+        );
+
+        EXECUTE format(
+            'ALTER TABLE intro_hash ATTACH PARTITION %I '
+            'FOR VALUES FROM (%L) TO (%L)',
+            partition_name,
+            month_start,
+            month_start + INTERVAL '1 month'
+        );
+    END LOOP;
+
+    FOR partition IN
+        SELECT
+            child.relname
+        FROM
+            pg_inherits
+        JOIN
+            pg_class AS parent ON pg_inherits.inhparent = parent.oid
+        JOIN
+            pg_class AS child ON pg_inherits.inhrelid = child.oid
+        WHERE
+            parent.relname = 'intro_hash'
+        AND
+            child.relname ~ '^intro_hash_[0-9]{4}_[0-9]{2}$'
+        AND
+            to_timestamp(
+                substring(child.relname FROM '[0-9]{4}_[0-9]{2}$'),
+                'YYYY_MM'
+            )::TIMESTAMP + INTERVAL '1 month' < NOW()::TIMESTAMP - retention
+    LOOP
+        EXECUTE format('DROP TABLE %I', partition.relname);
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT maintain_intro_hash_partitions(NULL);
+
+-- The unpartitioned table didn't record when hashes were created, so migrated
+-- hashes are given the time of the migration. They're therefore kept for up
+-- to one retention period after the migration, rather than after they were
+-- first seen, and are then dropped along with the month's partition.
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_class WHERE relname = 'intro_hash_unpartitioned'
+    ) THEN
+        INSERT INTO intro_hash (hash)
+        SELECT hash FROM intro_hash_unpartitioned;
+
+        DROP TABLE intro_hash_unpartitioned;
+    END IF;
+END $$;
 
 CREATE TABLE IF NOT EXISTS duo_last_notification (
     username TEXT NOT NULL,
@@ -19,6 +140,22 @@ CREATE TABLE IF NOT EXISTS duo_push_token (
     PRIMARY KEY (username)
 );
 
+-- Tells cron's notification scheduler whose unread messages changed
+CREATE OR REPLACE FUNCTION duo_trigger_fn_notify_inbox()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('duo_inbox', NEW.luser);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER duo_trigger_notify_inbox
+AFTER INSERT OR UPDATE OF timestamp, unread_count
+ON inbox
+FOR EACH ROW
+WHEN (NEW.unread_count > 0)
+EXECUTE FUNCTION duo_trigger_fn_notify_inbox();
+
 CREATE INDEX IF NOT EXISTS duo_idx__inbox__timestamp__unread_count
 ON inbox(timestamp, unread_count)
 WHERE unread_count > 0;
@@ -1,11 +1,16 @@
+from service.cron.emailoutbox import drain_email_outbox_forever
 from service.cron.expiredrecords import delete_expired_records_forever
+from service.cron.introhash import maintain_intro_hash_partitions_forever
 from service.cron.autodeactivate2 import autodeactivate2_forever
 from service.cron.notifications import send_notifications_forever
 from service.cron.photocleaner import clean_photos_forever
+from service.cron.searchbounds import refresh_search_bounds_forever
+from service.cron.searchprewarm import prewarm_search_cache_forever
 import asyncio
 from http.server import SimpleHTTPRequestHandler
 from socketserver import TCPServer
 from database.asyncdatabase import check_connections_forever
+import duoloop
 
 class HealthCheckHandler(SimpleHTTPRequestHandler):
     def do_GET(self):
@@ -31,16 +36,24 @@ async def main():
         # Fetched: 0.1k, returned: 2k
         delete_expired_records_forever(),
 
+        drain_email_outbox_forever(),
+
+        maintain_intro_hash_partitions_forever(),
+
         # Fetched: 0.1k, returned: 100k
         clean_photos_forever(),
 
         # Fetched: 9k, returned: 70k
         send_notifications_forever(),
 
+        refresh_search_bounds_forever(),
+
+        prewarm_search_cache_forever(),
+
         check_connections_forever(),
 
         http_server(),
     )
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    duoloop.run(main())
@@ -4,6 +4,7 @@ from service.cron.autodeactivate2.template import emailtemplate
 from service.cron.util import print_stacktrace, MAX_RANDOM_START_DELAY
 from smtp import aws_smtp
 import asyncio
+import sessioncache
 import os
 import random
 
@@ -19,18 +20,22 @@ AUTODEACTIVATE2_POLL_SECONDS = int(os.environ.get(
 
 print('Hello from cron module: autodeactivate2')
 
-def maybe_send_email(email: str):
-    if email.lower().endswith('@example.com'):
-        return
+def send_emails(emails: list[str]):
+    emails = [e for e in emails if not e.lower().endswith('@example.com')]
 
-    send_args = dict(
-        to=email,
-        subject="Your profile is invisible 👻",
-        body=emailtemplate()
-    )
+    for email in emails:
+        print('autodeactivate2: sending deactivation email to', email)
+
+    body = emailtemplate()
 
-    print('autodeactivate2: sending deactivation email to', email)
-    aws_smtp.send(**send_args)
+    aws_smtp.send_many([
+        dict(
+            to=email,
+            subject="Your profile is invisible 👻",
+            body=body,
+        )
+        for email in emails
+    ])
 
 async def autodeactivate2_once():
     params = dict(polling_interval_seconds=AUTODEACTIVATE2_POLL_SECONDS)
@@ -48,6 +53,11 @@ async def autodeactivate2_once():
         cur_deactivated = await tx.execute(Q_DEACTIVATE, params)
         rows_deactivated = await cur_deactivated.fetchall()
 
+    await asyncio.to_thread(
+        sessioncache.invalidate,
+        person_ids=[p['id'] for p in rows_deactivated],
+    )
+
     for p in rows_deactivated:
         if DRY_RUN:
             print(
@@ -57,8 +67,10 @@ async def autodeactivate2_once():
         else:
             print(f'  - autodeactive2: deactivated {p}')
 
-    for p in rows_deactivated:
-        maybe_send_email(p['email'])
+    await asyncio.to_thread(
+        send_emails,
+        [p['email'] for p in rows_deactivated],
+    )
 
 async def autodeactivate2_forever():
     await asyncio.sleep(random.randint(0, MAX_RANDOM_START_DELAY))
@@ -0,0 +1,137 @@
+from database.asyncdatabase import api_conn, api_tx
+from service.cron.emailoutbox.sql import *
+from service.cron.util import print_stacktrace, MAX_RANDOM_START_DELAY
+from smtp import aws_smtp
+import asyncio
+import os
+import random
+import traceback
+
+# Committed emails wake the drainer through NOTIFY, so this only bounds how long
+# retries, and emails whose notifications were missed, wait
+EMAIL_OUTBOX_POLL_SECONDS = int(os.environ.get(
+    'DUO_CRON_EMAIL_OUTBOX_POLL_SECONDS',
+    str(10), # 10 seconds
+))
+
+EMAIL_OUTBOX_BATCH_SIZE = int(os.environ.get(
+    'DUO_CRON_EMAIL_OUTBOX_BATCH_SIZE',
+    '100',
+))
+
+# Emails are dead-lettered after failing this many times
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.environ.get(
+    'DUO_CRON_EMAIL_OUTBOX_MAX_ATTEMPTS',
+    '8',
+))
+
+# The delay before the first retry, which doubles after each failure
+EMAIL_OUTBOX_RETRY_SECONDS = int(os.environ.get(
+    'DUO_CRON_EMAIL_OUTBOX_RETRY_SECONDS',
+    str(30), # 30 seconds
+))
+
+EMAIL_OUTBOX_LEASE_SECONDS = 60 * 5 # 5 minutes
+
+print('Hello from cron module: emailoutbox')
+
+_wakeup = asyncio.Event()
+
+async def drain_email_outbox_once() -> int:
+    """
+    Sends one batch of due emails, returning the number of emails claimed
+    """
+    params = dict(
+        lease_seconds=EMAIL_OUTBOX_LEASE_SECONDS,
+        batch_size=EMAIL_OUTBOX_BATCH_SIZE,
+    )
+
+    async with api_tx('READ COMMITTED') as tx:
+        cur = await tx.execute(Q_DELETE_EXPIRED_EMAILS)
+        expired = await cur.fetchall()
+
+        cur = await tx.execute(Q_CLAIM_EMAILS, params)
+        rows = await cur.fetchall()
+
+    for row in expired:
+        print('emailoutbox: dropped expired email', row['id'], row['to_addr'])
+
+    if not rows:
+        return 0
+
+    results = await asyncio.to_thread(
+        aws_smtp.send_many,
+        [
+            dict(
+                to=row['to_addr'],
+                subject=row['subject'],
+                body=row['body'],
+                from_addr=row['from_addr'],
+            )
+            for row in rows
+        ],
+    )
+
+    sent_ids = [row['id'] for row, sent in zip(rows, results) if sent]
+    failed_ids = [row['id'] for row, sent in zip(rows, results) if not sent]
+
+    params = dict(
+        ids=failed_ids,
+        retry_seconds=EMAIL_OUTBOX_RETRY_SECONDS,
+        max_attempts=EMAIL_OUTBOX_MAX_ATTEMPTS,
+    )
+
+    async with api_tx() as tx:
+        await tx.execute(Q_DELETE_SENT_EMAILS, dict(ids=sent_ids))
+
+        cur = await tx.execute(Q_RESCHEDULE_FAILED_EMAILS, params)
+        rescheduled = await cur.fetchall()
+
+    for row in rescheduled:
+        if row['is_dead_lettered']:
+            print('emailoutbox: dead-lettered email', row['id'], row['to_addr'])
+        else:
+            print('emailoutbox: will retry email', row['id'], row['to_addr'])
+
+    return len(rows)
+
+async def drain_email_outbox():
+    while await drain_email_outbox_once() >= EMAIL_OUTBOX_BATCH_SIZE:
+        pass
+
+async def listen_for_emails_forever():
+    while True:
+        try:
+            async with await api_conn() as conn:
+                await conn.execute('LISTEN email_outbox')
+
+                # Emails might have been committed while we weren't listening
+                _wakeup.set()
+
+                async for _ in conn.notifies():
+                    _wakeup.set()
+        except Exception:
+            print(traceback.format_exc())
+
+        await asyncio.sleep(5)
+
+async def drain_email_outbox_forever():
+    await asyncio.sleep(random.randint(0, MAX_RANDOM_START_DELAY))
+
+    listener = asyncio.create_task(listen_for_emails_forever())
+
+    try:
+        while True:
+            _wakeup.clear()
+
+            await print_stacktrace(drain_email_outbox)
+
+            try:
+                await asyncio.wait_for(
+                    _wakeup.wait(),
+                    timeout=EMAIL_OUTBOX_POLL_SECONDS,
+                )
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        listener.cancel()
@@ -0,0 +1,83 @@
+# Emails like OTPs are useless once they expire, and their bodies shouldn't be
+# kept around
+Q_DELETE_EXPIRED_EMAILS = """
+DELETE FROM
+    email_outbox
+WHERE
+    expires_at <= NOW()
+AND
+    dead_lettered_at IS NULL
+RETURNING
+    id,
+    to_addr
+"""
+
+# Claimed emails are leased rather than locked for the duration of the send, so
+# that no transaction stays open while talking to the SMTP server. If cron dies
+# mid-send, the emails are retried once their lease expires.
+Q_CLAIM_EMAILS = """
+UPDATE
+    email_outbox
+SET
+    attempts = attempts + 1,
+    next_attempt_at = NOW() + make_interval(secs => %(lease_seconds)s)
+WHERE
+    id IN (
+        SELECT
+            id
+        FROM
+            email_outbox
+        WHERE
+            dead_lettered_at IS NULL
+        AND
+            next_attempt_at <= NOW()
+        AND
+            (expires_at IS NULL OR expires_at > NOW())
+        ORDER BY
+            next_attempt_at
+        LIMIT
+            %(batch_size)s
+        FOR UPDATE SKIP LOCKED
+    )
+RETURNING
+    id,
+    to_addr,
+    from_addr,
+    subject,
+    body,
+    attempts
+"""
+
+Q_DELETE_SENT_EMAILS = """
+DELETE FROM
+    email_outbox
+WHERE
+    id = ANY(%(ids)s::BIGINT[])
+"""
+
+Q_RESCHEDULE_FAILED_EMAILS = """
+UPDATE
+    email_outbox
+SET
+    next_attempt_at = NOW() + make_interval(
+        secs => %(retry_seconds)s * 2 ^ LEAST(attempts - 1, 16)
+    ),
+    dead_lettered_at = CASE
+        WHEN attempts >= %(max_attempts)s
+        THEN NOW()
+        ELSE NULL
+    END,
+    -- Dead letters are kept to show what failed, not to be resent, so their
+    -- bodies, which might hold OTPs, are dropped
+    body = CASE
+        WHEN attempts >= %(max_attempts)s
+        THEN ''
+        ELSE body
+    END
+WHERE
+    id = ANY(%(ids)s::BIGINT[])
+RETURNING
+    id,
+    to_addr,
+    dead_lettered_at IS NOT NULL AS is_dead_lettered
+"""
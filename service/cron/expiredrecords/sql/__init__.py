@@ -47,6 +47,13 @@ WITH q1 AS (
         op.email = q5.email
     RETURNING
         1
+), q7 AS (
+    DELETE FROM
+        email_outbox
+    WHERE
+        dead_lettered_at < NOW() - INTERVAL '1 month'
+    RETURNING
+        1
 )
 SELECT
     SUM(n) AS count
@@ -56,6 +63,7 @@ FROM (
     SELECT 1 AS n FROM q3 UNION ALL
     SELECT 1 AS n FROM q4 UNION ALL
     SELECT 1 AS n FROM q5 UNION ALL
-    SELECT 0 AS n FROM q6
+    SELECT 0 AS n FROM q6 UNION ALL
+    SELECT 1 AS n FROM q7
 ) AS t(n)
 """
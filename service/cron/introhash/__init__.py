@@ -0,0 +1,32 @@
+from database.asyncdatabase import chat_tx
+from service.cron.introhash.sql import *
+from service.cron.util import print_stacktrace, MAX_RANDOM_START_DELAY
+import asyncio
+import os
+import random
+
+INTRO_HASH_POLL_SECONDS = int(os.environ.get(
+    'DUO_CRON_INTRO_HASH_POLL_SECONDS',
+    str(60 * 60), # 1 hour
+))
+
+# Intros are only checked for uniqueness against intros sent within this many
+# days
+INTRO_HASH_RETENTION_DAYS = int(os.environ.get(
+    'DUO_CRON_INTRO_HASH_RETENTION_DAYS',
+    str(365),
+))
+
+print('Hello from cron module: introhash')
+
+async def maintain_intro_hash_partitions_once():
+    params = dict(retention_days=INTRO_HASH_RETENTION_DAYS)
+
+    async with chat_tx() as tx:
+        await tx.execute(Q_MAINTAIN_INTRO_HASH_PARTITIONS, params)
+
+async def maintain_intro_hash_partitions_forever():
+    await asyncio.sleep(random.randint(0, MAX_RANDOM_START_DELAY))
+    while True:
+        await print_stacktrace(maintain_intro_hash_partitions_once)
+        await asyncio.sleep(INTRO_HASH_POLL_SECONDS)
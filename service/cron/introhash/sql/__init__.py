@@ -0,0 +1,5 @@
+Q_MAINTAIN_INTRO_HASH_PARTITIONS = """
+SELECT maintain_intro_hash_partitions(
+    make_interval(days => %(retention_days)s)
+)
+"""
@@ -1,11 +1,18 @@
-from database.asyncdatabase import api_tx, chat_tx
+from database.asyncdatabase import api_tx, chat_conn, chat_tx
 from dataclasses import dataclass
 from service.cron.notifications.sql import (
+    Q_INBOX_STATE,
     Q_NOTIFICATION_SETTINGS,
-    Q_UNREAD_INBOX,
-    Q_UPDATE_LAST_CHAT_NOTIFICATION_TIME,
-    Q_UPDATE_LAST_INTRO_NOTIFICATION_TIME,
-    Q_DELETE_MOBILE_TOKEN,
+    Q_UNREAD_USERNAMES,
+    Q_CLAIM_NOTIFICATIONS,
+    Q_UNCLAIM_NOTIFICATIONS,
+    Q_DELETE_MOBILE_TOKENS,
+)
+from service.cron.notifications.expo import (
+    SEND_BATCH_SIZE,
+    ExpoPushError,
+    expo_client,
+    is_device_not_registered,
 )
 from service.cron.notifications.template import (
     big_part,
@@ -13,15 +20,18 @@ from service.cron.notifications.template import (
 )
 from service.cron.util import (
     MAX_RANDOM_START_DELAY,
+    RateLimiter,
     join_lists_of_dicts,
     print_stacktrace,
+    retry_with_backoff,
 )
 from smtp import aws_smtp
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
+import heapq
 import os
 import random
-import urllib.request
-import json
+import time
 import traceback
 
 EMAIL_POLL_SECONDS = int(os.environ.get(
@@ -29,8 +39,78 @@ EMAIL_POLL_SECONDS = int(os.environ.get(
     str(10), # 10 seconds
 ))
 
+# The schedule is kept up to date by notifications from the inbox table. It's
+# rebuilt from a full scan this often anyway, to pick up changes which don't
+# touch the inbox, such as to people's notification settings.
+NOTIFICATION_RESCAN_SECONDS = int(os.environ.get(
+    'DUO_CRON_NOTIFICATION_RESCAN_SECONDS',
+    str(60 * 60), # 1 hour
+))
+
+# People are only notified about messages sent longer than this ago, and only
+# if they've been inactive since the message was sent
+NOTIFICATION_DELAY_SECONDS = 60 * 10 # 10 minutes
+
+# The number of notifications which are sent at once. Sending is blocking, so
+# each runs on its own thread.
+NOTIFICATION_CONCURRENCY = int(os.environ.get(
+    'DUO_CRON_NOTIFICATION_CONCURRENCY',
+    '20',
+))
+
+# Per-channel rate limits. Zero means no limit. The defaults match Expo's limit
+# per project and SES's default sending rate.
+MOBILE_NOTIFICATIONS_PER_SECOND = float(os.environ.get(
+    'DUO_CRON_MOBILE_NOTIFICATIONS_PER_SECOND',
+    '600',
+))
+
+EMAIL_NOTIFICATIONS_PER_SECOND = float(os.environ.get(
+    'DUO_CRON_EMAIL_NOTIFICATIONS_PER_SECOND',
+    '14',
+))
+
+NOTIFICATION_MAX_ATTEMPTS = int(os.environ.get(
+    'DUO_CRON_NOTIFICATION_MAX_ATTEMPTS',
+    '3',
+))
+
+NOTIFICATION_RETRY_SECONDS = float(os.environ.get(
+    'DUO_CRON_NOTIFICATION_RETRY_SECONDS',
+    '1',
+))
+
+# Expo suggests waiting 15 minutes before fetching a push ticket's receipt, and
+# discards receipts after 24 hours
+PUSH_RECEIPT_DELAY_SECONDS = int(os.environ.get(
+    'DUO_CRON_PUSH_RECEIPT_DELAY_SECONDS',
+    str(60 * 15), # 15 minutes
+))
+
+PUSH_RECEIPT_EXPIRY_SECONDS = 60 * 60 * 24
+
 print('Hello from cron module: notifications')
 
+_executor = ThreadPoolExecutor(
+    max_workers=max(1, NOTIFICATION_CONCURRENCY),
+    thread_name_prefix='notifications',
+)
+
+_mobile_rate_limiter = RateLimiter(MOBILE_NOTIFICATIONS_PER_SECOND)
+
+_email_rate_limiter = RateLimiter(EMAIL_NOTIFICATIONS_PER_SECOND)
+
+@dataclass
+class PendingReceipt:
+    ticket_id: str
+    username: str
+    token: str
+    sent_at: float
+
+# Push tickets whose receipts haven't been checked yet. They're kept in memory,
+# so a restart forgets them; their tokens will be pruned after later sends.
+_pending_receipts: list[PendingReceipt] = []
+
 @dataclass
 class PersonNotification:
     person_uuid: int
@@ -46,6 +126,168 @@ class PersonNotification:
     intros_drift_seconds: int
     token: str | None
 
+@dataclass
+class InboxState:
+    person_uuid: str
+    last_intro_seconds: int
+    last_chat_seconds: int
+    has_intro: bool
+    has_chat: bool
+    last_intro_notification_seconds: int
+    last_chat_notification_seconds: int
+    last_seen_seconds: int
+    token: str | None
+    name: str
+    email: str
+    chats_drift_seconds: int
+    intros_drift_seconds: int
+
+    def _is_unnotified(
+        self,
+        has_message: bool,
+        message_seconds: int,
+        notification_seconds: int,
+    ):
+        return (
+            has_message and
+            # only notify users we haven't already notified
+            message_seconds > notification_seconds and
+            # only notify users about messages sent after their last activity
+            self.last_seen_seconds < message_seconds
+        )
+
+    def _due_seconds(
+        self,
+        has_message: bool,
+        message_seconds: int,
+        notification_seconds: int,
+        drift_seconds: int,
+    ) -> int | None:
+        is_due_eventually = (
+            self._is_unnotified(
+                has_message,
+                message_seconds,
+                notification_seconds,
+            ) and
+            drift_seconds >= 0 and
+            notification_seconds + drift_seconds < message_seconds
+        )
+
+        if is_due_eventually:
+            return message_seconds + NOTIFICATION_DELAY_SECONDS + 1
+        else:
+            return None
+
+    def next_due_seconds(self) -> int | None:
+        """
+        The time at which this person should be notified, unless something
+        changes beforehand, or None if they shouldn't be notified
+        """
+        due = [
+            self._due_seconds(
+                self.has_intro,
+                self.last_intro_seconds,
+                self.last_intro_notification_seconds,
+                self.intros_drift_seconds,
+            ),
+            self._due_seconds(
+                self.has_chat,
+                self.last_chat_seconds,
+                self.last_chat_notification_seconds,
+                self.chats_drift_seconds,
+            ),
+        ]
+
+        return min((d for d in due if d is not None), default=None)
+
+    def to_notification(self, now_seconds: int) -> PersonNotification:
+        def is_pending(has_message, message_seconds, notification_seconds):
+            return (
+                self._is_unnotified(
+                    has_message,
+                    message_seconds,
+                    notification_seconds,
+                ) and
+                message_seconds + NOTIFICATION_DELAY_SECONDS < now_seconds
+            )
+
+        return PersonNotification(
+            person_uuid=self.person_uuid,
+            last_intro_notification_seconds=self.last_intro_notification_seconds,
+            last_chat_notification_seconds=self.last_chat_notification_seconds,
+            last_intro_seconds=self.last_intro_seconds,
+            last_chat_seconds=self.last_chat_seconds,
+            has_intro=is_pending(
+                self.has_intro,
+                self.last_intro_seconds,
+                self.last_intro_notification_seconds,
+            ),
+            has_chat=is_pending(
+                self.has_chat,
+                self.last_chat_seconds,
+                self.last_chat_notification_seconds,
+            ),
+            name=self.name,
+            email=self.email,
+            chats_drift_seconds=self.chats_drift_seconds,
+            intros_drift_seconds=self.intros_drift_seconds,
+            token=self.token,
+        )
+
+class NotificationScheduler:
+    """
+    A priority queue of the people who might need notifying, keyed on when
+    they'll next be eligible. People whose inboxes changed are marked dirty, so
+    that their place in the queue is recomputed on the next round.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[int, str]] = []
+
+        # Superseded heap entries are left in place, and skipped when popped
+        self._due_seconds: dict[str, int] = {}
+
+        self._dirty: set[str] = set()
+
+        self.needs_rescan = True
+
+    def __len__(self):
+        return len(self._due_seconds)
+
+    def mark_dirty(self, username: str):
+        self._dirty.add(username)
+
+    def take_dirty(self) -> set[str]:
+        dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    def schedule(self, username: str, due_seconds: int | None):
+        if due_seconds is None:
+            self._due_seconds.pop(username, None)
+            return
+
+        self._due_seconds[username] = due_seconds
+        heapq.heappush(self._heap, (due_seconds, username))
+
+    def pop_due(self, now_seconds: int) -> set[str]:
+        due = set()
+
+        while self._heap and self._heap[0][0] <= now_seconds:
+            due_seconds, username = heapq.heappop(self._heap)
+
+            if self._due_seconds.get(username) == due_seconds:
+                del self._due_seconds[username]
+                due.add(username)
+
+        # Compacts the heap if it's mostly superseded entries
+        if len(self._heap) > 2 * len(self._due_seconds) + 1000:
+            self._heap = [(d, u) for u, d in self._due_seconds.items()]
+            heapq.heapify(self._heap)
+
+        return due
+
+scheduler = NotificationScheduler()
+
 def do_send_notification(row: PersonNotification):
     email = row.email
     has_intro = row.has_intro
@@ -76,11 +318,17 @@ def do_send_email_notification(row: PersonNotification):
 
     return do_send_notification(row) and not is_example
 
-async def delete_mobile_token(row: PersonNotification):
-    params = dict(username=row.person_uuid)
+async def delete_mobile_tokens(username_tokens: list[tuple[str, str]]):
+    if not username_tokens:
+        return
+
+    params = dict(
+        usernames=[username for username, _ in username_tokens],
+        tokens=[token for _, token in username_tokens],
+    )
 
     async with chat_tx() as tx:
-        await tx.execute(Q_DELETE_MOBILE_TOKEN, params)
+        await tx.execute(Q_DELETE_MOBILE_TOKENS, params)
 
 def send_email_notification(row: PersonNotification):
     if not do_send_email_notification(row):
@@ -97,13 +345,14 @@ def send_email_notification(row: PersonNotification):
         )
     )
 
-    aws_smtp.send(**send_args)
+    if not aws_smtp.send(**send_args):
+        raise RuntimeError('Email notification failed')
 
-def send_mobile_notification(row: PersonNotification):
+def mobile_message(row: PersonNotification) -> dict:
     if not row.token:
         raise ValueError('Token not present')
 
-    message = dict(
+    return dict(
         to=row.token,
         sound='default',
         title='You have a new message 😍',
@@ -111,82 +360,345 @@ def send_mobile_notification(row: PersonNotification):
         priority='high',
     )
 
-    headers = {
-        'Accept': 'application/json',
-        'Accept-Encoding': 'gzip, deflate',
-        'Content-Type': 'application/json',
-    }
-
-    req = urllib.request.Request(
-        url='https://exp.host/--/api/v2/push/send?useFcmV1=true',
-        data=json.dumps(message).encode('utf-8'),
-        headers=headers,
-        method='POST'
+async def _run_with_retries(
+    rate_limiter: RateLimiter,
+    cost: int,
+    fun,
+    *args,
+    is_retryable=lambda e: True,
+):
+    async def attempt():
+        await rate_limiter.wait(cost)
+        return await asyncio.get_running_loop().run_in_executor(
+            _executor,
+            fun,
+            *args,
+        )
+
+    return await retry_with_backoff(
+        attempt,
+        max_attempts=NOTIFICATION_MAX_ATTEMPTS,
+        base_delay_seconds=NOTIFICATION_RETRY_SECONDS,
+        is_retryable=is_retryable,
     )
 
-    with urllib.request.urlopen(req) as response:
-        response_data = response.read().decode('utf-8')
+def _is_retryable_push_error(e: Exception):
+    # A batch which Expo might have accepted isn't resent, since its recipients
+    # would be notified twice
+    return isinstance(e, ExpoPushError) and e.is_retryable
 
-    try:
-        parsed_data = json.loads(response_data)
-        assert parsed_data["data"]["status"] == "ok"
-        return True
-    except:
-        print(traceback.format_exc())
+async def send_email_notification_with_retries(row: PersonNotification):
+    print('Sending email notification:', str(row))
 
-    return False
+    await _run_with_retries(
+        _email_rate_limiter,
+        1,
+        send_email_notification,
+        row,
+    )
 
-async def send_notification(row: PersonNotification):
-    if not row.token:
-        print('Sending email notification:', str(row))
-        return send_email_notification(row)
+async def send_mobile_notifications(
+    rows: list[PersonNotification],
+    sent_rows: list[PersonNotification],
+) -> list[PersonNotification]:
+    """
+    Sends push notifications to `rows` in batches, returning the rows whose
+    notifications were rejected, so they can be emailed instead. Rows are
+    appended to `sent_rows` as soon as they're sent, in case a later step
+    raises. Tokens are only deleted once Expo reports `DeviceNotRegistered`
+    for them, either in a push ticket or, later, in a push receipt.
+    """
+    failed_rows = []
+    unregistered_rows = []
+
+    for i in range(0, len(rows), SEND_BATCH_SIZE):
+        batch = rows[i:i + SEND_BATCH_SIZE]
+
+        for row in batch:
+            print('Sending mobile notification:', str(row))
+
+        try:
+            tickets = await _run_with_retries(
+                _mobile_rate_limiter,
+                len(batch),
+                expo_client.send,
+                [mobile_message(row) for row in batch],
+                is_retryable=_is_retryable_push_error,
+            )
+        except Exception as e:
+            print(traceback.format_exc())
+
+            # If Expo might have accepted the batch, it's treated as sent,
+            # rather than risking notifying everyone in it twice
+            if _is_retryable_push_error(e):
+                failed_rows.extend(batch)
+            else:
+                sent_rows.extend(batch)
+
+            continue
+
+        sent_at = time.monotonic()
+
+        for row, ticket in zip(batch, tickets):
+            if ticket.get('status') == 'ok':
+                sent_rows.append(row)
+                _pending_receipts.append(PendingReceipt(
+                    ticket_id=ticket['id'],
+                    username=row.person_uuid,
+                    token=row.token,
+                    sent_at=sent_at,
+                ))
+            else:
+                print('Mobile notification failed:', row.person_uuid, ticket)
+                failed_rows.append(row)
+
+                if is_device_not_registered(ticket):
+                    unregistered_rows.append(row)
+
+    await delete_mobile_tokens(
+        [(row.person_uuid, row.token) for row in unregistered_rows])
+
+    return failed_rows
+
+async def check_push_receipts_once():
+    """
+    Fetches the receipts of push tickets which are old enough to have them,
+    and deletes the tokens of devices which turned out to be unregistered.
+    Tickets whose receipts aren't ready yet are checked again later.
+    """
+    global _pending_receipts
+
+    now = time.monotonic()
+
+    due = [
+        p for p in _pending_receipts
+        if p.sent_at + PUSH_RECEIPT_DELAY_SECONDS <= now]
+
+    if not due:
+        return
 
-    print('Sending mobile notification:', str(row))
-    if not send_mobile_notification(row):
-        print('Mobile notification failed; sending email')
-        await delete_mobile_token(row)
-        return send_email_notification(row)
+    receipts = await _run_with_retries(
+        _mobile_rate_limiter,
+        0,
+        expo_client.get_receipts,
+        [p.ticket_id for p in due],
+    )
 
-async def update_last_notification_time(row: PersonNotification):
-    params = dict(username=row.person_uuid)
+    unregistered = [
+        (p.username, p.token)
+        for p in due
+        if is_device_not_registered(receipts.get(p.ticket_id, {}))
+    ]
+
+    await delete_mobile_tokens(unregistered)
+
+    # Expo keeps receipts for a day, so there's no use waiting any longer
+    _pending_receipts = [
+        p for p in _pending_receipts
+        if p.ticket_id not in receipts
+        and p.sent_at + PUSH_RECEIPT_EXPIRY_SECONDS > now
+    ]
+
+async def claim_notifications(rows: list[PersonNotification]):
+    if not rows:
+        return
+
+    params = dict(
+        now_seconds=int(time.time()),
+        usernames=[row.person_uuid for row in rows],
+        has_intros=[row.has_intro for row in rows],
+        has_chats=[row.has_chat for row in rows],
+    )
 
     async with chat_tx() as tx:
-        if row.has_intro:
-            await tx.execute(Q_UPDATE_LAST_INTRO_NOTIFICATION_TIME, params)
-        if row.has_chat:
-            await tx.execute(Q_UPDATE_LAST_CHAT_NOTIFICATION_TIME, params)
+        await tx.execute(Q_CLAIM_NOTIFICATIONS, params)
 
-async def maybe_send_notification(row: PersonNotification):
-    if not do_send_notification(row):
+async def unclaim_notifications(rows: list[PersonNotification]):
+    if not rows:
         return
 
-    await send_notification(row)
-    await update_last_notification_time(row)
+    params = dict(
+        usernames=[row.person_uuid for row in rows],
+        has_intros=[row.has_intro for row in rows],
+        has_chats=[row.has_chat for row in rows],
+        intro_seconds=[row.last_intro_notification_seconds for row in rows],
+        chat_seconds=[row.last_chat_notification_seconds for row in rows],
+    )
+
+    async with chat_tx() as tx:
+        await tx.execute(Q_UNCLAIM_NOTIFICATIONS, params)
+
+async def send_email_notifications(
+    rows: list[PersonNotification],
+    sent_rows: list[PersonNotification],
+):
+    """
+    Sends email notifications to `rows` concurrently, appending the rows which
+    were sent to `sent_rows`
+    """
+    semaphore = asyncio.Semaphore(max(1, NOTIFICATION_CONCURRENCY))
+
+    async def send(row: PersonNotification):
+        async with semaphore:
+            try:
+                await send_email_notification_with_retries(row)
+                sent_rows.append(row)
+            except Exception:
+                print(traceback.format_exc())
+
+    await asyncio.gather(*[send(row) for row in rows])
+
+async def send_notifications(person_notifications: list[PersonNotification]):
+    rows = [row for row in person_notifications if do_send_notification(row)]
+
+    # Each person's last notification time is recorded for the whole round
+    # before anything is sent, so that cron dying mid-round can't cause
+    # duplicate notifications. Every notification which isn't confirmed sent
+    # is unrecorded afterwards, even if sending raised, so it's retried next
+    # round.
+    await claim_notifications(rows)
+
+    sent_rows: list[PersonNotification] = []
+
+    try:
+        mobile_rows = [row for row in rows if row.token]
+        email_rows = [row for row in rows if not row.token]
+
+        failed_mobile_rows = await send_mobile_notifications(
+            mobile_rows,
+            sent_rows,
+        )
+
+        if failed_mobile_rows:
+            print('Mobile notifications failed; sending emails')
+
+        await send_email_notifications(
+            email_rows + failed_mobile_rows,
+            sent_rows,
+        )
+    finally:
+        sent_ids = {id(row) for row in sent_rows}
+        unsent_rows = [row for row in rows if id(row) not in sent_ids]
+
+        await retry_with_backoff(
+            lambda: unclaim_notifications(unsent_rows),
+            max_attempts=NOTIFICATION_MAX_ATTEMPTS,
+            base_delay_seconds=NOTIFICATION_RETRY_SECONDS,
+        )
+
+async def fetch_inbox_states(usernames: set[str]) -> list[InboxState]:
+    if not usernames:
+        return []
 
-async def send_notifications_once():
     async with chat_tx() as tx:
-        cur_unread_inbox = await tx.execute(Q_UNREAD_INBOX)
-        rows_unread_inbox = await cur_unread_inbox.fetchall()
+        cur_inbox_state = await tx.execute(
+            Q_INBOX_STATE,
+            params=dict(usernames=list(usernames)),
+        )
+        rows_inbox_state = await cur_inbox_state.fetchall()
 
     async with api_tx() as tx:
         cur_notification_settings = await tx.execute(
             Q_NOTIFICATION_SETTINGS,
-            params=dict(ids=[r['person_uuid'] for r in rows_unread_inbox])
+            params=dict(ids=[r['person_uuid'] for r in rows_inbox_state])
         )
         rows_notification_settings = await cur_notification_settings.fetchall()
 
     joined = join_lists_of_dicts(
-        rows_unread_inbox,
+        rows_inbox_state,
         rows_notification_settings,
         'person_uuid',
     )
-    person_notifications = [PersonNotification(**j) for j in joined]
 
-    for row in person_notifications:
-        await maybe_send_notification(row)
+    return [InboxState(**j) for j in joined]
+
+async def send_notifications_once():
+    """
+    Looks only at people whose inboxes changed since the last round, or who are
+    due a notification, so a round's cost follows the rate of new messages
+    rather than the number of people with unread messages
+    """
+    if scheduler.needs_rescan:
+        scheduler.needs_rescan = False
+
+        async with chat_tx() as tx:
+            cur_unread_usernames = await tx.execute(Q_UNREAD_USERNAMES)
+            rows_unread_usernames = await cur_unread_usernames.fetchall()
+
+        for row in rows_unread_usernames:
+            scheduler.mark_dirty(row['username'])
+
+    now_seconds = int(time.time())
+
+    usernames = scheduler.take_dirty() | scheduler.pop_due(now_seconds)
+
+    try:
+        inbox_states = await fetch_inbox_states(usernames)
+    except:
+        # They'll be looked at again next round
+        for username in usernames:
+            scheduler.mark_dirty(username)
+        raise
+
+    # People missing from `inbox_states` have read their messages, or can't be
+    # notified, so they're dropped from the schedule
+    for username in usernames:
+        scheduler.schedule(username, None)
+
+    person_notifications = []
+
+    for inbox_state in inbox_states:
+        person_notification = inbox_state.to_notification(now_seconds)
+
+        if do_send_notification(person_notification):
+            person_notifications.append(person_notification)
+
+            # Checked again next round. By then, the person's last
+            # notification time will have been updated, unless sending failed,
+            # in which case it's retried.
+            scheduler.schedule(inbox_state.person_uuid, now_seconds)
+        else:
+            scheduler.schedule(
+                inbox_state.person_uuid,
+                inbox_state.next_due_seconds(),
+            )
+
+    await send_notifications(person_notifications)
+
+async def listen_for_inbox_changes_forever():
+    while True:
+        try:
+            async with await chat_conn() as conn:
+                await conn.execute('LISTEN duo_inbox')
+
+                # Changes might have been missed while we weren't listening
+                scheduler.needs_rescan = True
+
+                async for notify in conn.notifies():
+                    scheduler.mark_dirty(notify.payload)
+        except Exception:
+            print(traceback.format_exc())
+
+        await asyncio.sleep(5)
+
+async def request_rescans_forever():
+    while True:
+        await asyncio.sleep(NOTIFICATION_RESCAN_SECONDS)
+        scheduler.needs_rescan = True
 
 async def send_notifications_forever():
     await asyncio.sleep(random.randint(0, MAX_RANDOM_START_DELAY))
-    while True:
-        await print_stacktrace(send_notifications_once)
-        await asyncio.sleep(EMAIL_POLL_SECONDS)
+
+    background_tasks = [
+        asyncio.create_task(listen_for_inbox_changes_forever()),
+        asyncio.create_task(request_rescans_forever()),
+    ]
+
+    try:
+        while True:
+            await print_stacktrace(send_notifications_once)
+            await print_stacktrace(check_push_receipts_once)
+            await asyncio.sleep(EMAIL_POLL_SECONDS)
+    finally:
+        for task in background_tasks:
+            task.cancel()
@@ -0,0 +1,159 @@
+from http.client import (
+    HTTPConnection,
+    HTTPException,
+    HTTPSConnection,
+    RemoteDisconnected,
+)
+import gzip
+import json
+import os
+import threading
+import urllib.parse
+
+EXPO_PUSH_URL = os.environ.get('DUO_EXPO_PUSH_URL', 'https://exp.host')
+
+# Expo's limits on the number of messages per send request and the number of
+# ticket ids per receipts request
+SEND_BATCH_SIZE = 100
+RECEIPTS_BATCH_SIZE = 1000
+
+# Expo asks for these to be retried with backoff
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+class ExpoPushError(Exception):
+    """
+    `is_retryable` is only set when Expo can't have acted on the request,
+    because sending push notifications isn't idempotent
+    """
+    def __init__(self, message: str, is_retryable: bool = False):
+        super().__init__(message)
+        self.is_retryable = is_retryable
+
+def is_device_not_registered(ticket_or_receipt: dict) -> bool:
+    return (
+        ticket_or_receipt.get('status') == 'error' and
+        (ticket_or_receipt.get('details') or {}).get('error') ==
+            'DeviceNotRegistered'
+    )
+
+class ExpoPushClient:
+    """
+    A blocking client for Expo's push API which keeps one connection alive
+    between requests. It's safe to share between threads, though their
+    requests are serialized on that connection.
+    """
+
+    def __init__(self, url: str, timeout_seconds: float = 10):
+        parsed = urllib.parse.urlsplit(url)
+
+        self._connection_class = (
+            HTTPSConnection if parsed.scheme == 'https' else HTTPConnection)
+        self._host = parsed.netloc
+        self._base_path = parsed.path.rstrip('/')
+        self._timeout_seconds = timeout_seconds
+
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _request(self, path: str, body: bytes):
+        headers = {
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip',
+            'Content-Type': 'application/json',
+        }
+
+        with self._lock:
+            # The server might've closed an idle connection, in which case the
+            # request is retried once on a fresh one. Any other failure might
+            # have happened after Expo received the request, so it isn't.
+            is_reused = self._connection is not None
+
+            while True:
+                if self._connection is None:
+                    self._connection = self._connection_class(
+                        self._host,
+                        timeout=self._timeout_seconds,
+                    )
+
+                    try:
+                        self._connection.connect()
+                    except OSError as e:
+                        self._connection = None
+                        raise ExpoPushError(str(e), is_retryable=True) from e
+
+                try:
+                    self._connection.request(
+                        'POST',
+                        self._base_path + path,
+                        body=body,
+                        headers=headers,
+                    )
+                    response = self._connection.getresponse()
+                    data = response.read()
+                    break
+                except (RemoteDisconnected, BrokenPipeError) as e:
+                    self._connection.close()
+                    self._connection = None
+
+                    if not is_reused:
+                        raise ExpoPushError(str(e)) from e
+
+                    is_reused = False
+                except (HTTPException, OSError) as e:
+                    self._connection.close()
+                    self._connection = None
+
+                    raise ExpoPushError(str(e)) from e
+
+        if response.getheader('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+
+        if response.status != 200:
+            raise ExpoPushError(
+                f'{response.status}: {data[:1000]!r}',
+                is_retryable=response.status in RETRYABLE_STATUSES,
+            )
+
+        return json.loads(data)
+
+    def send(self, messages: list[dict]) -> list[dict]:
+        """
+        Sends `messages` in batches of `SEND_BATCH_SIZE`, returning one push
+        ticket per message, in the same order.
+        """
+        tickets = []
+
+        for i in range(0, len(messages), SEND_BATCH_SIZE):
+            batch = messages[i:i + SEND_BATCH_SIZE]
+
+            batch_tickets = self._request(
+                '/--/api/v2/push/send?useFcmV1=true',
+                json.dumps(batch).encode('utf-8'),
+            )['data']
+
+            if len(batch_tickets) != len(batch):
+                raise ExpoPushError(
+                    f'Expected {len(batch)} tickets, got {len(batch_tickets)}')
+
+            tickets.extend(batch_tickets)
+
+        return tickets
+
+    def get_receipts(self, ticket_ids: list[str]) -> dict[str, dict]:
+        """
+        Returns the push receipts for `ticket_ids`, keyed by ticket id. Ids
+        whose receipts aren't ready yet, or have expired, are missing.
+        """
+        receipts = {}
+
+        for i in range(0, len(ticket_ids), RECEIPTS_BATCH_SIZE):
+            batch = ticket_ids[i:i + RECEIPTS_BATCH_SIZE]
+
+            receipts.update(self._request(
+                '/--/api/v2/push/getReceipts',
+                json.dumps(dict(ids=batch)).encode('utf-8'),
+            )['data'])
+
+        return receipts
+
+expo_client = ExpoPushClient(EXPO_PUSH_URL)
@@ -1,108 +1,59 @@
-Q_UNREAD_INBOX = """
-WITH ten_days_ago AS (
-    SELECT
-        (SELECT (EXTRACT(EPOCH FROM (
-            NOW() - INTERVAL '10 days')))::bigint) AS seconds,
-        (SELECT (EXTRACT(EPOCH FROM (
-            NOW() - INTERVAL '10 days')) * 1000000)::bigint) AS microseconds
-), ten_minutes_ago AS (
-    SELECT
-        (SELECT (EXTRACT(EPOCH FROM (
-            NOW() - INTERVAL '10 minutes')))::bigint) AS seconds,
-        (SELECT (EXTRACT(EPOCH FROM (
-            NOW() - INTERVAL '10 minutes')) * 1000000)::bigint) AS microseconds
-), inbox_first_pass AS (
+# Everyone who might be due a notification. It's only used to (re)build the
+# schedule; afterwards, the `duo_inbox` notifications say who to look at.
+Q_UNREAD_USERNAMES = """
+SELECT DISTINCT
+    luser AS username
+FROM
+    inbox
+WHERE
+    unread_count > 0
+AND
+    timestamp > (EXTRACT(EPOCH FROM (NOW() - INTERVAL '10 days')) * 1000000)::bigint
+"""
+
+Q_INBOX_STATE = """
+WITH inbox_state AS (
     SELECT
         luser AS username,
         MAX(CASE WHEN box = 'inbox' THEN timestamp ELSE 0 END) / 1000000 AS last_intro_seconds,
         MAX(CASE WHEN box = 'chats' THEN timestamp ELSE 0 END) / 1000000 AS last_chat_seconds,
-        BOOL_OR(CASE WHEN box = 'inbox' THEN TRUE ELSE FALSE END) AS has_intro,
-        BOOL_OR(CASE WHEN box = 'chats' THEN TRUE ELSE FALSE END) AS has_chat
-    FROM inbox
+        BOOL_OR(box = 'inbox') AS has_intro,
+        BOOL_OR(box = 'chats') AS has_chat
+    FROM
+        inbox
     WHERE
+        luser = ANY(%(usernames)s::TEXT[])
+    AND
         unread_count > 0
     AND
-        timestamp > (SELECT microseconds FROM ten_days_ago)
+        timestamp > (EXTRACT(EPOCH FROM (NOW() - INTERVAL '10 days')) * 1000000)::bigint
     GROUP BY
         luser
-), inbox_second_pass AS (
-    SELECT
-        inbox_first_pass.username AS person_uuid,
-        inbox_first_pass.last_intro_seconds,
-        inbox_first_pass.last_chat_seconds,
-        COALESCE(duo_last_notification.intro_seconds, 0) AS last_intro_notification_seconds,
-        COALESCE(duo_last_notification.chat_seconds, 0) AS last_chat_notification_seconds,
-        (
-                inbox_first_pass.has_intro
-            AND
-                -- only notify users we haven't already notified
-                inbox_first_pass.last_intro_seconds >
-                    COALESCE(duo_last_notification.intro_seconds, 0)
-            AND
-                -- only notify users about messages sent longer than ten minutes
-                -- ago
-                inbox_first_pass.last_intro_seconds <
-                    (SELECT seconds FROM ten_minutes_ago)
-            AND
-                -- only notify users about messages sent after their last
-                -- activity
-                COALESCE(last.seconds, 0) < inbox_first_pass.last_intro_seconds
-            AND
-                -- only notify users whose last activity was longer than ten
-                -- minutes ago
-                COALESCE(last.seconds, 0) <
-                    (SELECT seconds FROM ten_minutes_ago)
-        ) AS has_intro,
-        (
-                inbox_first_pass.has_chat
-            AND
-                -- only notify users we haven't already notified
-                inbox_first_pass.last_chat_seconds >
-                    COALESCE(duo_last_notification.chat_seconds, 0)
-            AND
-                -- only notify users about messages sent longer than ten minutes
-                -- ago
-                inbox_first_pass.last_chat_seconds <
-                    (SELECT seconds FROM ten_minutes_ago)
-            AND
-                -- only notify users about messages sent after their last
-                -- activity
-                COALESCE(last.seconds, 0) < inbox_first_pass.last_chat_seconds
-            AND
-                -- only notify users whose last activity was longer than ten
-                -- minutes ago
-                COALESCE(last.seconds, 0) <
-                    (SELECT seconds FROM ten_minutes_ago)
-        ) AS has_chat
-    FROM inbox_first_pass
-    LEFT JOIN
-        last
-    ON
-        last.username = inbox_first_pass.username
-    LEFT JOIN
-        duo_last_notification
-    ON
-        duo_last_notification.username = inbox_first_pass.username
 )
 SELECT
-    inbox_second_pass.person_uuid,
-    last_intro_seconds,
-    last_chat_seconds,
-    last_intro_notification_seconds,
-    last_chat_notification_seconds,
-    has_intro,
-    has_chat,
-    token
+    inbox_state.username AS person_uuid,
+    inbox_state.last_intro_seconds,
+    inbox_state.last_chat_seconds,
+    inbox_state.has_intro,
+    inbox_state.has_chat,
+    COALESCE(duo_last_notification.intro_seconds, 0) AS last_intro_notification_seconds,
+    COALESCE(duo_last_notification.chat_seconds, 0) AS last_chat_notification_seconds,
+    COALESCE(last.seconds, 0) AS last_seen_seconds,
+    duo_push_token.token
 FROM
-    inbox_second_pass
+    inbox_state
+LEFT JOIN
+    last
+ON
+    last.username = inbox_state.username
+LEFT JOIN
+    duo_last_notification
+ON
+    duo_last_notification.username = inbox_state.username
 LEFT JOIN
     duo_push_token
 ON
-    duo_push_token.username = inbox_second_pass.person_uuid
-WHERE
-    has_intro
-OR
-    has_chat
+    duo_push_token.username = inbox_state.username
 """
 
 Q_NOTIFICATION_SETTINGS = """
@@ -151,20 +102,71 @@ AND
     activated
 """
 
-Q_UPDATE_LAST_INTRO_NOTIFICATION_TIME = """
-INSERT INTO duo_last_notification (username, intro_seconds)
-VALUES (%(username)s, extract(epoch from now())::int)
+# Records a whole round's notifications as sent, in one statement. GREATEST
+# leaves the time of whichever kind of notification isn't being sent alone.
+Q_CLAIM_NOTIFICATIONS = """
+INSERT INTO duo_last_notification (
+    username,
+    intro_seconds,
+    chat_seconds
+)
+SELECT
+    username,
+    CASE WHEN has_intro THEN %(now_seconds)s::INT ELSE 0 END,
+    CASE WHEN has_chat  THEN %(now_seconds)s::INT ELSE 0 END
+FROM
+    UNNEST(
+        %(usernames)s::TEXT[],
+        %(has_intros)s::BOOLEAN[],
+        %(has_chats)s::BOOLEAN[]
+    ) AS t(username, has_intro, has_chat)
 ON CONFLICT (username) DO UPDATE SET
-    intro_seconds = extract(epoch from now())::int
+    intro_seconds = GREATEST(
+        duo_last_notification.intro_seconds,
+        EXCLUDED.intro_seconds
+    ),
+    chat_seconds = GREATEST(
+        duo_last_notification.chat_seconds,
+        EXCLUDED.chat_seconds
+    )
 """
 
-Q_UPDATE_LAST_CHAT_NOTIFICATION_TIME = """
-INSERT INTO duo_last_notification (username, chat_seconds)
-VALUES (%(username)s, extract(epoch from now())::int)
-ON CONFLICT (username) DO UPDATE SET
-    chat_seconds = extract(epoch from now())::int
+# Restores the times which `Q_CLAIM_NOTIFICATIONS` overwrote, for notifications
+# which couldn't be sent, so that they're tried again
+Q_UNCLAIM_NOTIFICATIONS = """
+UPDATE
+    duo_last_notification
+SET
+    intro_seconds = CASE
+        WHEN t.has_intro
+        THEN t.intro_seconds
+        ELSE duo_last_notification.intro_seconds
+    END,
+    chat_seconds = CASE
+        WHEN t.has_chat
+        THEN t.chat_seconds
+        ELSE duo_last_notification.chat_seconds
+    END
+FROM
+    UNNEST(
+        %(usernames)s::TEXT[],
+        %(has_intros)s::BOOLEAN[],
+        %(has_chats)s::BOOLEAN[],
+        %(intro_seconds)s::INT[],
+        %(chat_seconds)s::INT[]
+    ) AS t(username, has_intro, has_chat, intro_seconds, chat_seconds)
+WHERE
+    duo_last_notification.username = t.username
 """
 
-Q_DELETE_MOBILE_TOKEN = """
-DELETE FROM duo_push_token WHERE username = %(username)s
+Q_DELETE_MOBILE_TOKENS = """
+DELETE FROM
+    duo_push_token
+USING
+    UNNEST(%(usernames)s::TEXT[], %(tokens)s::TEXT[]) AS t(username, token)
+WHERE
+    duo_push_token.username = t.username
+AND
+    -- The user might've registered a new token since
+    duo_push_token.token = t.token
 """
@@ -1,12 +1,19 @@
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch
 from service.cron.notifications import (
+    InboxState,
+    NotificationScheduler,
     PersonNotification,
-    send_mobile_notification,
-    send_notification,
+    do_send_notification,
+    send_notifications,
 )
+from service.cron.notifications.expo import ExpoPushClient
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import asyncio
+import dataclasses
 import json
+import threading
+import time
 
 person_notification = PersonNotification(
     person_uuid='2',
@@ -15,7 +22,7 @@ person_notification = PersonNotification(
     has_intro=True,
     has_chat=True,
     last_intro_seconds=1693786124,
-    last_chat_seconds=100,
+    last_chat_seconds=1693786124,
     name='jk',
     email='user.1@gmail.com',
     chats_drift_seconds=0,
@@ -23,56 +30,303 @@ person_notification = PersonNotification(
     token='asdf',
 )
 
-class TestSendNotification(unittest.TestCase):
+class ExpoStandIn(BaseHTTPRequestHandler):
+    """
+    Accepts every message, except those to tokens starting with
+    'unregistered', which Expo would reject with `DeviceNotRegistered`.
+    """
 
-    @patch('service.cron.notifications.delete_mobile_token')
-    @patch('service.cron.notifications.send_mobile_notification')
-    @patch('service.cron.notifications.send_email_notification')
-    def test_mobile_send_when_token_present(
-        self,
-        mock_delete_mobile_token,
-        mock_send_mobile_notification,
-        mock_send_email_notification,
-    ):
+    protocol_version = 'HTTP/1.1'
 
-        # Call the send_notification function
-        asyncio.run(send_notification(person_notification))
+    def setup(self):
+        super().setup()
+        self.server.num_connections += 1
 
-        # Assert that send_mobile_notification was called
-        mock_send_mobile_notification.assert_called_once_with(person_notification)
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+
+        self.server.requests.append((self.path, body))
+
+        time.sleep(self.server.delay_seconds)
+
+        if self.server.status != 200:
+            self.send_response(self.server.status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if self.path.startswith('/--/api/v2/push/send'):
+            data = [
+                dict(
+                    status='error',
+                    message='Not registered',
+                    details=dict(error='DeviceNotRegistered'),
+                )
+                if message['to'].startswith('unregistered')
+                else dict(status='ok', id=f"ticket-{message['to']}")
+                for message in body
+            ]
+        else:
+            data = {
+                ticket_id: dict(status='ok')
+                for ticket_id in body['ids']
+            }
+
+        response = json.dumps(dict(data=data)).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+class TestSendNotifications(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ExpoStandIn)
+        self.server.requests = []
+        self.server.num_connections = 0
+        self.server.delay_seconds = 0
+        self.server.status = 200
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.client = ExpoPushClient(
+            f'http://127.0.0.1:{self.server.server_address[1]}')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_batches_on_one_connection(self):
+        rows = [
+            dataclasses.replace(
+                person_notification,
+                person_uuid=str(i),
+                token=f'token-{i}',
+            )
+            for i in range(250)
+        ]
+
+        with \
+                patch('service.cron.notifications.expo_client', self.client), \
+                patch('service.cron.notifications.send_email_notification') \
+                    as mock_send_email_notification, \
+                patch('service.cron.notifications.delete_mobile_tokens') \
+                    as mock_delete_mobile_tokens, \
+                patch('service.cron.notifications.claim_notifications') \
+                    as mock_claim_notifications, \
+                patch('service.cron.notifications.unclaim_notifications') \
+                    as mock_unclaim_notifications:
+            asyncio.run(send_notifications(rows))
+
+        self.assertEqual(
+            [len(body) for _, body in self.server.requests],
+            [100, 100, 50])
+        self.assertEqual(self.server.num_connections, 1)
 
-        # Assert that send_email_notification was not called
         mock_send_email_notification.assert_not_called()
+        mock_delete_mobile_tokens.assert_called_once_with([])
+        mock_claim_notifications.assert_called_once_with(rows)
+        mock_unclaim_notifications.assert_called_once_with([])
+
+    def test_email_when_device_not_registered(self):
+        registered = person_notification
+        unregistered = dataclasses.replace(
+            person_notification,
+            person_uuid='3',
+            token='unregistered-token',
+        )
+
+        with \
+                patch('service.cron.notifications.expo_client', self.client), \
+                patch('service.cron.notifications.send_email_notification') \
+                    as mock_send_email_notification, \
+                patch('service.cron.notifications.delete_mobile_tokens') \
+                    as mock_delete_mobile_tokens, \
+                patch('service.cron.notifications.claim_notifications'), \
+                patch('service.cron.notifications.unclaim_notifications'):
+            asyncio.run(send_notifications([registered, unregistered]))
+
+        mock_send_email_notification.assert_called_once_with(unregistered)
+        mock_delete_mobile_tokens.assert_called_once_with(
+            [('3', 'unregistered-token')])
+
+    def test_unclaim_failed_emails(self):
+        sent = dataclasses.replace(person_notification, token=None)
+        failed = dataclasses.replace(
+            person_notification,
+            person_uuid='3',
+            token=None,
+        )
+
+        def send_email_notification(row):
+            if row is failed:
+                raise RuntimeError('Email notification failed')
+
+        with \
+                patch('service.cron.notifications.NOTIFICATION_RETRY_SECONDS', 0), \
+                patch(
+                    'service.cron.notifications.send_email_notification',
+                    side_effect=send_email_notification,
+                ), \
+                patch('service.cron.notifications.claim_notifications') \
+                    as mock_claim_notifications, \
+                patch('service.cron.notifications.unclaim_notifications') \
+                    as mock_unclaim_notifications:
+            asyncio.run(send_notifications([sent, failed]))
+
+        mock_claim_notifications.assert_called_once_with([sent, failed])
+        mock_unclaim_notifications.assert_called_once_with([failed])
+
+    def test_unclaim_when_round_raises(self):
+        mobile = person_notification
+        email = dataclasses.replace(
+            person_notification,
+            person_uuid='3',
+            token=None,
+        )
+
+        with \
+                patch('service.cron.notifications.expo_client', self.client), \
+                patch('service.cron.notifications.send_email_notification') \
+                    as mock_send_email_notification, \
+                patch(
+                    'service.cron.notifications.delete_mobile_tokens',
+                    side_effect=RuntimeError('Chat DB unavailable'),
+                ), \
+                patch('service.cron.notifications.claim_notifications'), \
+                patch('service.cron.notifications.unclaim_notifications') \
+                    as mock_unclaim_notifications:
+            with self.assertRaises(RuntimeError):
+                asyncio.run(send_notifications([mobile, email]))
+
+        # The push went out before the round failed, but the email didn't
+        mock_send_email_notification.assert_not_called()
+        mock_unclaim_notifications.assert_called_once_with([email])
+
+    def test_retry_only_when_not_sent(self):
+        rows = [person_notification]
+
+        # Expo asks for 503s to be retried, so they're resent, and then
+        # emailed once the retries are exhausted
+        self.server.status = 503
+
+        with \
+                patch('service.cron.notifications.NOTIFICATION_RETRY_SECONDS', 0), \
+                patch('service.cron.notifications.expo_client', self.client), \
+                patch('service.cron.notifications.send_email_notification') \
+                    as mock_send_email_notification, \
+                patch('service.cron.notifications.delete_mobile_tokens'), \
+                patch('service.cron.notifications.claim_notifications'), \
+                patch('service.cron.notifications.unclaim_notifications'):
+            asyncio.run(send_notifications(rows))
+
+        self.assertEqual(len(self.server.requests), 3)
+        mock_send_email_notification.assert_called_once_with(
+            person_notification)
+
+        # Timeouts might've happened after Expo accepted the batch, so it's
+        # neither resent nor emailed
+        self.server.requests.clear()
+        self.server.status = 200
+        self.server.delay_seconds = 0.5
+
+        client = ExpoPushClient(
+            f'http://127.0.0.1:{self.server.server_address[1]}',
+            timeout_seconds=0.1,
+        )
+
+        with \
+                patch('service.cron.notifications.NOTIFICATION_RETRY_SECONDS', 0), \
+                patch('service.cron.notifications.expo_client', client), \
+                patch('service.cron.notifications.send_email_notification') \
+                    as mock_send_email_notification, \
+                patch('service.cron.notifications.delete_mobile_tokens'), \
+                patch('service.cron.notifications.claim_notifications'), \
+                patch('service.cron.notifications.unclaim_notifications'):
+            asyncio.run(send_notifications(rows))
+
+        self.assertEqual(len(self.server.requests), 1)
+        mock_send_email_notification.assert_not_called()
+
+    def test_get_receipts(self):
+        receipts = self.client.get_receipts(
+            [f'ticket-{i}' for i in range(1500)])
+
+        self.assertEqual(len(receipts), 1500)
+        self.assertEqual(
+            [len(body['ids']) for _, body in self.server.requests],
+            [1000, 500])
+
+class TestNotificationScheduler(unittest.TestCase):
 
-        mock_delete_mobile_token.assert_not_called()
+    def test_pop_due(self):
+        scheduler = NotificationScheduler()
 
+        scheduler.schedule('1', 100)
+        scheduler.schedule('2', 200)
+        scheduler.schedule('3', 300)
 
-class TestSendMobileNotification(unittest.TestCase):
+        # Rescheduling supersedes the earlier entry
+        scheduler.schedule('1', 250)
 
-    @patch('urllib.request.urlopen')
-    def test_send_mobile_notification_success(self, mock_urlopen):
-        # Set up the mock response to simulate a successful notification
-        mock_urlopen.return_value.__enter__.return_value.read.return_value = \
-            json.dumps({'data': {'status': 'ok'}}).encode('utf-8')
+        # Unscheduling removes the person altogether
+        scheduler.schedule('3', None)
 
-        # Call the send_mobile_notification function
-        result = send_mobile_notification(person_notification)
+        self.assertEqual(scheduler.pop_due(150), set())
+        self.assertEqual(scheduler.pop_due(260), {'1', '2'})
+        self.assertEqual(scheduler.pop_due(1000), set())
+        self.assertEqual(len(scheduler), 0)
 
-        # Assert that the function returned True
-        self.assertTrue(result)
+class TestInboxState(unittest.TestCase):
 
-    @patch('urllib.request.urlopen')
-    def test_send_mobile_notification_failure(self, mock_urlopen):
-        # Set up the mock response to simulate a failed notification
-        mock_urlopen.return_value.__enter__.return_value.read.return_value = \
-            json.dumps({'data': {'status': 'error'}}).encode('utf-8')
+    inbox_state = InboxState(
+        person_uuid='2',
+        last_intro_seconds=1000,
+        last_chat_seconds=0,
+        has_intro=True,
+        has_chat=False,
+        last_intro_notification_seconds=0,
+        last_chat_notification_seconds=0,
+        last_seen_seconds=500,
+        token=None,
+        name='jk',
+        email='user.1@gmail.com',
+        chats_drift_seconds=0,
+        intros_drift_seconds=0,
+    )
 
-        # Call the send_mobile_notification function
-        result = send_mobile_notification(person_notification)
+    def test_due_ten_minutes_after_message(self):
+        due_seconds = self.inbox_state.next_due_seconds()
 
-        # Assert that the function returned False
-        self.assertFalse(result)
+        self.assertEqual(due_seconds, 1000 + 600 + 1)
+        self.assertFalse(do_send_notification(
+            self.inbox_state.to_notification(due_seconds - 1)))
+        self.assertTrue(do_send_notification(
+            self.inbox_state.to_notification(due_seconds)))
 
+    def test_not_due(self):
+        for inbox_state in [
+            # Seen since the message was sent
+            dataclasses.replace(self.inbox_state, last_seen_seconds=1000),
+            # Already notified
+            dataclasses.replace(
+                self.inbox_state,
+                last_intro_notification_seconds=1000,
+            ),
+            # Notified too recently, given the person's settings
+            dataclasses.replace(
+                self.inbox_state,
+                last_intro_notification_seconds=900,
+                intros_drift_seconds=86400,
+            ),
+            # Never notified, given the person's settings
+            dataclasses.replace(self.inbox_state, intros_drift_seconds=-1),
+        ]:
+            self.assertIsNone(inbox_state.next_due_seconds())
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,54 @@
+from database.asyncdatabase import api_tx
+from service.cron.searchbounds.sql import *
+from service.cron.util import print_stacktrace, MAX_RANDOM_START_DELAY
+import asyncio
+import os
+import random
+
+# The bounds only change when the date does, so this just needs to be frequent
+# enough that they're refreshed soon after midnight
+SEARCH_BOUNDS_POLL_SECONDS = int(os.environ.get(
+    'DUO_CRON_SEARCH_BOUNDS_POLL_SECONDS',
+    str(60 * 60), # 1 hour
+))
+
+SEARCH_BOUNDS_BATCH_SIZE = int(os.environ.get(
+    'DUO_CRON_SEARCH_BOUNDS_BATCH_SIZE',
+    str(1000),
+))
+
+print('Hello from cron module: searchbounds')
+
+async def refresh_search_bounds_once():
+    """
+    Moves each person's `search_earliest_date_of_birth` and
+    `search_latest_date_of_birth` forward with the date. Done in batches, in
+    separate transactions, to avoid holding locks on many `person` rows at once.
+    """
+    after_person_id = 0
+    total = 0
+
+    while True:
+        params = dict(
+            after_person_id=after_person_id,
+            batch_size=SEARCH_BOUNDS_BATCH_SIZE,
+        )
+
+        async with api_tx('READ COMMITTED') as tx:
+            cur = await tx.execute(Q_REFRESH_SEARCH_PREFERENCE_BOUNDS, params)
+            row = await cur.fetchone()
+
+        if row['last_person_id'] is None:
+            break
+
+        after_person_id = row['last_person_id']
+        total += row['count']
+
+    if total:
+        print(f'Refreshed search bounds of {total} person(s)')
+
+async def refresh_search_bounds_forever():
+    await asyncio.sleep(random.randint(0, MAX_RANDOM_START_DELAY))
+    while True:
+        await print_stacktrace(refresh_search_bounds_once)
+        await asyncio.sleep(SEARCH_BOUNDS_POLL_SECONDS)
@@ -0,0 +1,17 @@
+Q_REFRESH_SEARCH_PREFERENCE_BOUNDS = """
+WITH batch AS (
+    SELECT
+        id
+    FROM
+        person
+    WHERE
+        id > %(after_person_id)s
+    ORDER BY
+        id
+    LIMIT
+        %(batch_size)s
+)
+SELECT
+    (SELECT MAX(id) FROM batch) AS last_person_id,
+    refresh_search_preference_bounds(ARRAY(SELECT id FROM batch)) AS count
+"""
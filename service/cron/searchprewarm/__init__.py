@@ -0,0 +1,155 @@
+from database.asyncdatabase import api_tx, chat_tx
+from service.cron.searchprewarm.sql import *
+from service.cron.util import print_stacktrace, MAX_RANDOM_START_DELAY
+from searchsql import (
+    Q_MARK_SEARCH_CACHE_PREWARMED,
+    Q_UNCACHED_SEARCH_1,
+    Q_UNCACHED_SEARCH_2,
+)
+from datetime import datetime, timezone
+import asyncio
+import os
+import random
+import time
+
+# Shared with the API, which serves prewarmed caches younger than this. 0
+# disables prewarming.
+SEARCH_CACHE_MAX_AGE_SECONDS = int(os.environ.get(
+    'DUO_SEARCH_CACHE_MAX_AGE_SECONDS',
+    '0',
+))
+
+SEARCH_PREWARM_POLL_SECONDS = int(os.environ.get(
+    'DUO_CRON_SEARCH_PREWARM_POLL_SECONDS',
+    str(60 * 10), # 10 minutes
+))
+
+# Prewarming only runs between these hours (UTC), so that it doesn't compete
+# with searches at peak times. The defaults allow it at any time.
+SEARCH_PREWARM_START_HOUR = int(os.environ.get(
+    'DUO_CRON_SEARCH_PREWARM_START_HOUR',
+    '0',
+))
+
+SEARCH_PREWARM_END_HOUR = int(os.environ.get(
+    'DUO_CRON_SEARCH_PREWARM_END_HOUR',
+    '24',
+))
+
+# Searchers who were last seen within this long are likely to search again
+# soon...
+SEARCH_PREWARM_ACTIVE_WITHIN_SECONDS = int(os.environ.get(
+    'DUO_CRON_SEARCH_PREWARM_ACTIVE_WITHIN_SECONDS',
+    str(60 * 60 * 24 * 3), # 3 days
+))
+
+# ...but those seen more recently than this might be paging through their
+# current results, which prewarming would replace
+SEARCH_PREWARM_IDLE_FOR_SECONDS = int(os.environ.get(
+    'DUO_CRON_SEARCH_PREWARM_IDLE_FOR_SECONDS',
+    str(60 * 60), # 1 hour
+))
+
+SEARCH_PREWARM_MAX_SEARCHERS = int(os.environ.get(
+    'DUO_CRON_SEARCH_PREWARM_MAX_SEARCHERS',
+    str(1000),
+))
+
+SEARCH_PREWARM_CONCURRENCY = int(os.environ.get(
+    'DUO_CRON_SEARCH_PREWARM_CONCURRENCY',
+    str(2),
+))
+
+# No new searches are started once a run has taken this long
+SEARCH_PREWARM_BUDGET_SECONDS = int(os.environ.get(
+    'DUO_CRON_SEARCH_PREWARM_BUDGET_SECONDS',
+    str(60 * 2), # 2 minutes
+))
+
+print('Hello from cron module: searchprewarm')
+
+def is_prewarm_hour(hour: int):
+    start, end = SEARCH_PREWARM_START_HOUR, SEARCH_PREWARM_END_HOUR
+
+    if start <= end:
+        return start <= hour < end
+    else:
+        # The window wraps around midnight, e.g. 22 to 6
+        return hour >= start or hour < end
+
+async def prewarm_search_cache(searcher_person_id: int):
+    params_1 = dict(
+        searcher_person_id=searcher_person_id,
+    )
+
+    params_2 = dict(
+        searcher_person_id=searcher_person_id,
+        n=0,
+        o=0,
+    )
+
+    async with api_tx('READ COMMITTED') as tx:
+        await tx.execute(Q_UNCACHED_SEARCH_1, params_1)
+        await tx.execute(Q_UNCACHED_SEARCH_2, params_2)
+        await tx.execute(Q_MARK_SEARCH_CACHE_PREWARMED, params_1)
+
+async def prewarm_search_cache_once():
+    if SEARCH_CACHE_MAX_AGE_SECONDS <= 0:
+        return
+
+    if not is_prewarm_hour(datetime.now(timezone.utc).hour):
+        return
+
+    deadline = time.monotonic() + SEARCH_PREWARM_BUDGET_SECONDS
+
+    params = dict(
+        active_within_seconds=SEARCH_PREWARM_ACTIVE_WITHIN_SECONDS,
+        idle_for_seconds=SEARCH_PREWARM_IDLE_FOR_SECONDS,
+        max_searchers=SEARCH_PREWARM_MAX_SEARCHERS,
+    )
+
+    async with chat_tx('READ COMMITTED') as tx:
+        cur = await tx.execute(Q_RECENTLY_ACTIVE, params)
+        rows = await cur.fetchall()
+
+    params = dict(
+        person_uuids=[r['person_uuid'] for r in rows],
+        max_age_seconds=SEARCH_CACHE_MAX_AGE_SECONDS,
+    )
+
+    async with api_tx('READ COMMITTED') as tx:
+        cur = await tx.execute(Q_PREWARM_CANDIDATES, params)
+        rows = await cur.fetchall()
+
+    semaphore = asyncio.Semaphore(SEARCH_PREWARM_CONCURRENCY)
+
+    async def prewarm(searcher_person_id: int):
+        async with semaphore:
+            if time.monotonic() > deadline:
+                return False
+
+            await prewarm_search_cache(searcher_person_id)
+
+            return True
+
+    results = await asyncio.gather(
+        *[prewarm(r['person_id']) for r in rows],
+        return_exceptions=True,
+    )
+
+    num_prewarmed = sum(r is True for r in results)
+    num_failed = sum(isinstance(r, Exception) for r in results)
+    num_skipped = sum(r is False for r in results)
+
+    if rows:
+        print(
+            f'searchprewarm: prewarmed {num_prewarmed}, '
+            f'failed {num_failed}, '
+            f'out of time for {num_skipped}'
+        )
+
+async def prewarm_search_cache_forever():
+    await asyncio.sleep(random.randint(0, MAX_RANDOM_START_DELAY))
+    while True:
+        await print_stacktrace(prewarm_search_cache_once)
+        await asyncio.sleep(SEARCH_PREWARM_POLL_SECONDS)
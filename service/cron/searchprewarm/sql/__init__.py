@@ -0,0 +1,47 @@
+Q_RECENTLY_ACTIVE = """
+SELECT
+    username AS person_uuid
+FROM
+    last
+GROUP BY
+    username
+HAVING
+    MAX(seconds) > EXTRACT(EPOCH FROM NOW()) - %(active_within_seconds)s
+AND
+    MAX(seconds) < EXTRACT(EPOCH FROM NOW()) - %(idle_for_seconds)s
+ORDER BY
+    MAX(seconds) DESC
+LIMIT
+    %(max_searchers)s
+"""
+
+Q_PREWARM_CANDIDATES = """
+WITH unnested_uuid AS (
+    SELECT
+        uuid_or_null(uuid) AS uuid,
+        position
+    FROM
+        UNNEST(%(person_uuids)s::TEXT[]) WITH ORDINALITY AS t(uuid, position)
+)
+SELECT
+    person.id AS person_id
+FROM
+    unnested_uuid
+JOIN
+    person
+ON
+    person.uuid = unnested_uuid.uuid
+LEFT JOIN
+    search_cache
+ON
+    search_cache.searcher_person_id = person.id
+WHERE
+    person.activated
+AND (
+        search_cache.searcher_person_id IS NULL
+    OR
+        search_cache.cached_at < NOW() - INTERVAL '1 second' * %(max_age_seconds)s
+)
+ORDER BY
+    unnested_uuid.position
+"""
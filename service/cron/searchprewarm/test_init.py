@@ -0,0 +1,27 @@
+import unittest
+from unittest.mock import patch
+from service.cron.searchprewarm import is_prewarm_hour
+
+class TestIsPrewarmHour(unittest.TestCase):
+
+    @patch('service.cron.searchprewarm.SEARCH_PREWARM_START_HOUR', 0)
+    @patch('service.cron.searchprewarm.SEARCH_PREWARM_END_HOUR', 24)
+    def test_always(self):
+        self.assertTrue(all(is_prewarm_hour(h) for h in range(24)))
+
+    @patch('service.cron.searchprewarm.SEARCH_PREWARM_START_HOUR', 2)
+    @patch('service.cron.searchprewarm.SEARCH_PREWARM_END_HOUR', 6)
+    def test_window(self):
+        self.assertEqual(
+            [h for h in range(24) if is_prewarm_hour(h)],
+            [2, 3, 4, 5])
+
+    @patch('service.cron.searchprewarm.SEARCH_PREWARM_START_HOUR', 22)
+    @patch('service.cron.searchprewarm.SEARCH_PREWARM_END_HOUR', 3)
+    def test_window_wraps_around_midnight(self):
+        self.assertEqual(
+            [h for h in range(24) if is_prewarm_hour(h)],
+            [0, 1, 2, 22, 23])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,7 @@
+import asyncio
 import os
+import random
+import time
 import traceback
 
 def join_lists_of_dicts(list1, list2, join_key):
@@ -15,6 +18,56 @@ async def print_stacktrace(fun):
     except:
         print(traceback.format_exc())
 
+class RateLimiter:
+    """
+    Spaces out the coroutines awaiting `wait` so that, on average, no more than
+    `per_second` units of work proceed each second. Each caller states how many
+    units it's about to use. A `per_second` of zero or less means there's no
+    limit.
+    """
+
+    def __init__(self, per_second: float):
+        self._interval = 1 / per_second if per_second > 0 else 0
+        self._next = 0.0
+
+    async def wait(self, units: int = 1):
+        if not self._interval:
+            return
+
+        now = time.monotonic()
+
+        # Each caller reserves the next free slot before sleeping, so callers
+        # proceed in the order they arrived
+        slot = max(self._next, now)
+        self._next = slot + self._interval * units
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+async def retry_with_backoff(
+    fun,
+    max_attempts: int,
+    base_delay_seconds: float,
+    is_retryable=lambda e: True,
+):
+    """
+    Awaits `fun()` until it returns without raising, up to `max_attempts`
+    times. Exceptions for which `is_retryable` returns False are raised
+    straight away. The delay before each retry doubles, with jitter so that
+    many failed calls don't all retry at once.
+    """
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return await fun()
+        except Exception as e:
+            if attempt >= max_attempts or not is_retryable(e):
+                raise
+
+            print(traceback.format_exc())
+
+            delay = base_delay_seconds * 2 ** (attempt - 1)
+            await asyncio.sleep(random.uniform(delay / 2, delay))
+
 MAX_RANDOM_START_DELAY = int(os.environ.get(
     'DUO_CRON_MAX_RANDOM_START_DELAY',
     15,
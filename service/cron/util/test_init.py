@@ -4,6 +4,9 @@ from service.cron.notifications import (
     do_send_email_notification,
     join_lists_of_dicts,
 )
+from service.cron.util import RateLimiter, retry_with_backoff
+import asyncio
+import time
 
 class TestJoinListsOfDicts(unittest.TestCase):
 
@@ -181,5 +184,55 @@ class TestDoSend(unittest.TestCase):
 
         self.assertFalse(do_send_email_notification(real_notification))
 
+class TestRateLimiter(unittest.TestCase):
+
+    def test_spaces_out_callers(self):
+        rate_limiter = RateLimiter(per_second=100)
+
+        async def wait_many():
+            start = time.monotonic()
+            await asyncio.gather(*[rate_limiter.wait() for _ in range(11)])
+            return time.monotonic() - start
+
+        self.assertGreaterEqual(asyncio.run(wait_many()), 0.09)
+
+    def test_no_limit(self):
+        rate_limiter = RateLimiter(per_second=0)
+
+        async def wait_many():
+            start = time.monotonic()
+            await asyncio.gather(*[rate_limiter.wait() for _ in range(1000)])
+            return time.monotonic() - start
+
+        self.assertLess(asyncio.run(wait_many()), 0.05)
+
+class TestRetryWithBackoff(unittest.TestCase):
+
+    def test_retries_until_success(self):
+        attempts = []
+
+        async def flaky():
+            attempts.append(None)
+            if len(attempts) < 3:
+                raise ConnectionError()
+            return 'ok'
+
+        result = asyncio.run(retry_with_backoff(flaky, 3, 0.001))
+
+        self.assertEqual(result, 'ok')
+        self.assertEqual(len(attempts), 3)
+
+    def test_gives_up(self):
+        attempts = []
+
+        async def broken():
+            attempts.append(None)
+            raise ConnectionError()
+
+        with self.assertRaises(ConnectionError):
+            asyncio.run(retry_with_backoff(broken, 2, 0.001))
+
+        self.assertEqual(len(attempts), 2)
+
 if __name__ == '__main__':
     unittest.main()
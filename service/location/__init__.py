@@ -61,6 +61,6 @@ def get_search_locations(q: Optional[str]):
         search_string=normalized_whitespace,
     )
 
-    with api_tx('READ COMMITTED') as tx:
+    with api_tx('READ COMMITTED', read_only=True) as tx:
         tx.execute(Q_SEARCH_LOCATIONS, params)
         return [row['long_friendly'] for row in tx.fetchall()]
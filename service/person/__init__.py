@@ -11,16 +11,14 @@ import boto3
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from service.person.sql import *
 from service.person.template import otp_template, report_template
-import traceback
-import threading
 import re
-from smtp import aws_smtp
 from flask import request
 from dataclasses import dataclass
 import psycopg
 from functools import lru_cache
 import random
 from antispam import check_and_update_bad_domains, normalize_email
+import sessioncache
 
 @dataclass
 class EmailEntry:
@@ -69,6 +67,9 @@ s3 = boto3.resource(
 
 bucket = s3.Bucket(R2_BUCKET_NAME)
 
+# OTPs expire after 10 minutes, so there's no point sending them any later
+OTP_EMAIL_MAX_AGE_SECONDS = 60 * 10
+
 def init_db():
     pass
 
@@ -87,30 +88,50 @@ class CropSize:
     top: int
     left: int
 
-def _send_report(
+def _enqueue_email(
+    tx: psycopg.Cursor,
+    to: str,
+    subject: str,
+    body: str,
+    from_addr: str | None = None,
+    max_age_seconds: int | None = None,
+):
+    """
+    Queues an email to be sent by cron once `tx` commits. It's dropped if it
+    can't be sent within `max_age_seconds`, unless that's None.
+    """
+    params = dict(
+        to_addr=to,
+        from_addr=from_addr,
+        subject=subject,
+        body=body,
+        max_age_seconds=max_age_seconds,
+    )
+
+    tx.execute(Q_INSERT_EMAIL_OUTBOX, params)
+
+def _enqueue_report(
+    tx: psycopg.Cursor,
     report_reason: str,
     report_obj: Any,
     last_messages: list[dict],
-    **kwargs: Any,
 ):
     subject_person_id = report_obj[0]['id']
     object_person_id  = report_obj[1]['id']
 
     report_email = sample_email(REPORT_EMAILS)
 
-    try:
-        aws_smtp.send(
-            to=report_email,
-            subject=f"Report: {subject_person_id} - {object_person_id}",
-            body=report_template(
-                report_obj=report_obj,
-                report_reason=report_reason,
-                last_messages=last_messages,
-            ),
-            from_addr=PRIMARY_REPORT_EMAIL,
-        )
-    except:
-        print(traceback.format_exc())
+    _enqueue_email(
+        tx,
+        to=report_email,
+        subject=f"Report: {subject_person_id} - {object_person_id}",
+        body=report_template(
+            report_obj=report_obj,
+            report_reason=report_reason,
+            last_messages=last_messages,
+        ),
+        from_addr=PRIMARY_REPORT_EMAIL,
+    )
 
 def process_image(
     image: Image.Image,
@@ -262,14 +283,16 @@ def delete_answer(req: t.DeleteAnswer, s: t.SessionInfo):
     with api_tx() as tx:
         tx.execute(Q_UPDATE_ANSWER, params)
 
-def _send_otp(email: str, otp: str):
+def _enqueue_otp(tx: psycopg.Cursor, email: str, otp: str):
     if email.endswith('@example.com'):
         return
 
-    aws_smtp.send(
+    _enqueue_email(
+        tx,
         to=email,
         subject="Sign in to Duolicious",
-        body=otp_template(otp)
+        body=otp_template(otp),
+        max_age_seconds=OTP_EMAIL_MAX_AGE_SECONDS,
     )
 
 def post_request_otp(req: t.PostRequestOtp):
@@ -291,13 +314,11 @@ def post_request_otp(req: t.PostRequestOtp):
     with api_tx() as tx:
         rows = tx.execute(Q_INSERT_DUO_SESSION, params).fetchall()
 
-    try:
-        row, *_ = rows
-        otp = row['otp']
-    except:
-        return 'Banned', 403
+        for row in rows[:1]:
+            _enqueue_otp(tx, email, row['otp'])
 
-    _send_otp(email, otp)
+    if not rows:
+        return 'Banned', 403
 
     return dict(session_token=session_token)
 
@@ -313,13 +334,11 @@ def post_resend_otp(s: t.SessionInfo):
     with api_tx() as tx:
         rows = tx.execute(Q_UPDATE_OTP, params).fetchall()
 
-    try:
-        row, *_ = rows
-        otp = row['otp']
-    except:
-        return 'Banned', 403
+        for row in rows[:1]:
+            _enqueue_otp(tx, s.email, row['otp'])
 
-    _send_otp(s.email, otp)
+    if not rows:
+        return 'Banned', 403
 
 def post_check_otp(req: t.PostCheckOtp, s: t.SessionInfo):
     params = dict(
@@ -334,6 +353,8 @@ def post_check_otp(req: t.PostCheckOtp, s: t.SessionInfo):
         if not row:
             return 'Invalid OTP', 401
 
+    sessioncache.invalidate(session_token_hashes=[s.session_token_hash])
+
     params = dict(person_uuid=row['person_uuid'])
 
     with chat_tx() as tx:
@@ -352,6 +373,8 @@ def post_sign_out(s: t.SessionInfo):
     with api_tx('READ COMMITTED') as tx:
         tx.execute(Q_DELETE_DUO_SESSION, params)
 
+    sessioncache.invalidate(session_token_hashes=[s.session_token_hash])
+
 def post_check_session_token(s: t.SessionInfo):
     params = dict(person_id=s.person_id)
 
@@ -537,6 +560,8 @@ def post_finish_onboarding(s: t.SessionInfo):
     with api_tx() as tx:
         row = tx.execute(Q_FINISH_ONBOARDING, params=api_params).fetchone()
 
+    sessioncache.invalidate(session_token_hashes=[s.session_token_hash])
+
     chat_params = dict(
         person_id=row['person_id'],
         person_uuid=row['person_uuid'],
@@ -588,7 +613,7 @@ def get_prospect_profile(s: t.SessionInfo, prospect_uuid):
         prospect_uuid=prospect_uuid,
     )
 
-    with api_tx('READ COMMITTED') as tx:
+    with api_tx('READ COMMITTED', read_only=True) as tx:
         row = tx.execute(Q_SELECT_PROSPECT_PROFILE, params).fetchone()
         if not row:
             return '', 404
@@ -621,23 +646,23 @@ def post_skip_by_uuid(req: t.PostSkip, s: t.SessionInfo, prospect_uuid: str):
         report_reason=req.report_reason or '',
     )
 
-    with api_tx() as tx:
-        tx.execute(Q_INSERT_SKIPPED, params=params)
-
     if req.report_reason:
         with chat_tx() as tx:
             last_messages = tx.execute(Q_LAST_MESSAGES, params=params).fetchall()
 
-        with api_tx() as tx:
+    # The report's email is queued in the same transaction as the report
+    with api_tx() as tx:
+        tx.execute(Q_INSERT_SKIPPED, params=params)
+
+        if req.report_reason:
             report_obj = tx.execute(Q_MAKE_REPORT, params=params).fetchall()
 
-        threading.Thread(
-            target=_send_report,
-            kwargs=params | dict(
+            _enqueue_report(
+                tx,
+                report_reason=req.report_reason,
                 report_obj=report_obj,
                 last_messages=last_messages,
             )
-        ).start()
 
 def post_unskip(s: t.SessionInfo, prospect_person_id: int):
     params = dict(
@@ -673,7 +698,7 @@ def get_compare_personalities(
         topic=db_topic,
     )
 
-    with api_tx('READ COMMITTED') as tx:
+    with api_tx('READ COMMITTED', read_only=True) as tx:
         return tx.execute(Q_SELECT_PERSONALITY, params).fetchall()
 
 def get_compare_answers(
@@ -712,7 +737,7 @@ def get_compare_answers(
         o=o,
     )
 
-    with api_tx('READ COMMITTED') as tx:
+    with api_tx('READ COMMITTED', read_only=True) as tx:
         return tx.execute(Q_ANSWER_COMPARISON, params).fetchall()
 
 def post_inbox_info(req: t.PostInboxInfo, s: t.SessionInfo):
@@ -741,6 +766,8 @@ def delete_or_ban_account(
 
         tx.executemany(Q_DELETE_ACCOUNT, params_seq=rows)
 
+    sessioncache.invalidate(person_ids=[row['person_id'] for row in rows])
+
     with chat_tx() as tx:
         tx.executemany(Q_DELETE_XMPP, params_seq=rows)
 
@@ -752,6 +779,8 @@ def post_deactivate(s: t.SessionInfo):
     with api_tx() as tx:
         tx.execute(Q_POST_DEACTIVATE, params)
 
+    sessioncache.invalidate(person_ids=[s.person_id])
+
 def get_profile_info(s: t.SessionInfo):
     params = dict(person_id=s.person_id)
 
@@ -1271,6 +1300,7 @@ def post_search_filter(req: t.PostSearchFilter, s: t.SessionInfo):
 
         tx.execute(q1, params)
         tx.execute(q2, params)
+        tx.execute(Q_DELETE_PREWARMED_SEARCH_CACHE, params)
 
 def post_search_filter_answer(req: t.PostSearchFilterAnswer, s: t.SessionInfo):
     max_search_filter_answers = 20
@@ -1378,8 +1408,10 @@ def post_search_filter_answer(req: t.PostSearchFilterAnswer, s: t.SessionInfo):
         answer = tx.execute(q, params).fetchone().get('j')
         if answer is None:
             return dict(error=error), 400
-        else:
-            return dict(answer=answer)
+
+        tx.execute(Q_DELETE_PREWARMED_SEARCH_CACHE, params)
+
+        return dict(answer=answer)
 
 def get_search_clubs(s: t.SessionInfo, q: str):
     if not re.match(t.CLUB_PATTERN, q) or not len(q) <= t.CLUB_MAX_LEN:
@@ -1390,7 +1422,7 @@ def get_search_clubs(s: t.SessionInfo, q: str):
         search_string=q,
     )
 
-    with api_tx('READ COMMITTED') as tx:
+    with api_tx('READ COMMITTED', read_only=True) as tx:
         return tx.execute(Q_SEARCH_CLUBS, params).fetchall()
 
 def post_join_club(req: t.PostJoinClub, s: t.SessionInfo):
@@ -1445,7 +1477,7 @@ def get_update_notifications(email: str, type: str, frequency: str):
 
 @lru_cache()
 def get_stats(ttl_hash=None):
-    with api_tx('READ COMMITTED') as tx:
+    with api_tx('READ COMMITTED', read_only=True) as tx:
         return tx.execute(Q_STATS).fetchone()
 
 def get_admin_ban_link(token: str):
@@ -485,25 +485,7 @@ WITH onboardee_country AS (
                     ST_DWithin(
                         prospect.coordinates,
                         (SELECT coordinates FROM new_person),
-                        (
-                            SELECT
-                                COALESCE(
-                                    (
-                                        SELECT
-                                            1000 * distance
-                                        FROM
-                                            person
-                                        JOIN
-                                            search_preference_distance
-                                        ON
-                                            person.id = person_id
-                                        WHERE
-                                            person.id = prospect.id
-                                        LIMIT 1
-                                    ),
-                                    1e9
-                                )
-                        )
+                        prospect.search_max_distance_meters
                     )
                 AND
                    -- The prospect meets the new_person's age preference
@@ -525,26 +507,10 @@ WITH onboardee_country AS (
                         LIMIT 1
                     )
                 AND
-                   -- The new_person meets the prospect's age preference
-                   EXISTS (
-                        SELECT 1
-                        FROM search_preference_age AS preference
-                        WHERE
-                            preference.person_id = prospect.id
-                        AND
-                            (SELECT date_of_birth FROM new_person) <= (
-                                CURRENT_DATE -
-                                INTERVAL '1 year' *
-                                COALESCE(preference.min_age, 0)
-                            )
-                        AND
-                            (SELECT date_of_birth FROM new_person) > (
-                                CURRENT_DATE -
-                                INTERVAL '1 year' *
-                                (COALESCE(preference.max_age, 999) + 1)
-                            )
-                        LIMIT 1
-                    )
+                    -- The new_person meets the prospect's age preference
+                    (SELECT date_of_birth FROM new_person) BETWEEN
+                        prospect.search_earliest_date_of_birth AND
+                        prospect.search_latest_date_of_birth
             ), points AS (
                 SELECT * FROM evaluated_midpoint
                 UNION
@@ -729,6 +695,14 @@ WITH prospect_person_id AS (
         person
     WHERE
         uuid = %(prospect_uuid)s
+), relationship AS (
+    SELECT
+        *
+    FROM
+        person_relationships(
+            %(person_id)s,
+            ARRAY(SELECT id FROM prospect_person_id)
+        )
 ), prospect AS (
     SELECT
         *,
@@ -754,24 +728,10 @@ WITH prospect_person_id AS (
         OR
             (SELECT id FROM prospect_person_id) = %(person_id)s
         OR
-            EXISTS (
-                SELECT 1
-                FROM messaged
-                WHERE
-                    messaged.subject_person_id = (SELECT id FROM prospect_person_id)
-                AND
-                    messaged.object_person_id = %(person_id)s
-            )
+            (SELECT other_messaged_person FROM relationship)
     )
     AND
-        NOT EXISTS (
-            SELECT 1
-            FROM skipped
-            WHERE
-                subject_person_id = (SELECT id FROM prospect_person_id) AND
-                object_person_id  = %(person_id)s
-            LIMIT 1
-        )
+        NOT (SELECT other_skipped_person FROM relationship)
     LIMIT
         1
 ), negative_dot_prod AS (
@@ -851,12 +811,9 @@ WITH prospect_person_id AS (
     WHERE star_sign.name != 'Unanswered'
 ), is_skipped AS (
     SELECT
-        EXISTS (
-            SELECT 1
-            FROM skipped
-            WHERE
-                subject_person_id = %(person_id)s AND
-                object_person_id  = (SELECT id FROM prospect_person_id)
+        COALESCE(
+            (SELECT person_skipped_other FROM relationship),
+            FALSE
         ) AS j
 ), clubs AS (
     SELECT
@@ -969,13 +926,21 @@ WITH object_person_id AS (
         %(report_reason)s
     ) ON CONFLICT DO NOTHING
 ), q2 AS (
-    DELETE FROM search_cache
+    UPDATE search_cache
+    SET
+        prospect_person_ids = ARRAY_REPLACE(
+            prospect_person_ids,
+            CASE
+                WHEN searcher_person_id = %(subject_person_id)s
+                THEN (SELECT id FROM object_person_id)
+                ELSE %(subject_person_id)s
+            END,
+            NULL
+        )
     WHERE
-        searcher_person_id = %(subject_person_id)s AND
-        prospect_person_id = (SELECT id FROM object_person_id)
+        searcher_person_id = %(subject_person_id)s
     OR
-        searcher_person_id = (SELECT id FROM object_person_id) AND
-        prospect_person_id = %(subject_person_id)s
+        searcher_person_id = (SELECT id FROM object_person_id)
 )
 SELECT 1
 """
@@ -1048,7 +1013,30 @@ OFFSET %(o)s
 """
 
 Q_INBOX_INFO = """
-WITH person_info AS (
+WITH id_table AS MATERIALIZED (
+    SELECT id, uuid
+    FROM person
+    WHERE uuid = ANY(%(prospect_person_uuids)s::uuid[])
+
+    UNION
+
+    SELECT
+        id,
+        uuid
+    FROM
+        person
+    JOIN
+        messaged
+    ON
+        messaged.subject_person_id = %(person_id)s
+    AND
+        messaged.object_person_id = person.id
+    OR
+        messaged.subject_person_id = person.id
+    AND
+        messaged.object_person_id = %(person_id)s
+    WHERE %(prospect_person_uuids)s::uuid[] = array[]::uuid[]
+), person_info AS (
     SELECT
         id_table.id AS person_id,
         id_table.uuid AS person_uuid,
@@ -1056,85 +1044,23 @@ WITH person_info AS (
         COALESCE(prospect.activated, FALSE) AS is_prospect_activated,
         prospect.name AS name,
         prospect.personality AS personality,
-        EXISTS (
-            SELECT
-                1
-            FROM
-                messaged
-            WHERE
-                subject_person_id = %(person_id)s
-            AND
-                object_person_id = id_table.id
-            LIMIT 1
-        ) AS person_messaged_prospect,
-        EXISTS (
-            SELECT
-                1
-            FROM
-                messaged
-            WHERE
-                subject_person_id = id_table.id
-            AND
-                object_person_id = %(person_id)s
-            LIMIT 1
-        ) AS prospect_messaged_person,
-        EXISTS (
-            SELECT
-                1
-            FROM
-                skipped
-            WHERE
-                subject_person_id = %(person_id)s
-            AND
-                object_person_id = id_table.id
-            LIMIT 1
-        ) AS person_skipped_prospect,
-        EXISTS (
-            SELECT
-                1
-            FROM
-                skipped
-            WHERE
-                subject_person_id = id_table.id
-            AND
-                object_person_id = %(person_id)s
-            LIMIT 1
-        ) AS prospect_skipped_person
+        relationship.person_messaged_other AS person_messaged_prospect,
+        relationship.other_messaged_person AS prospect_messaged_person,
+        relationship.person_skipped_other AS person_skipped_prospect,
+        relationship.other_skipped_person AS prospect_skipped_person
     FROM
-        (
-            SELECT id, uuid
-            FROM person
-            WHERE uuid = ANY(%(prospect_person_uuids)s::uuid[])
-
-            UNION
-
-            SELECT
-                id,
-                uuid
-            FROM
-                person
-            JOIN
-                messaged
-            ON
-                messaged.subject_person_id = %(person_id)s
-            AND
-                messaged.object_person_id = person.id
-            OR
-                messaged.subject_person_id = person.id
-            AND
-                messaged.object_person_id = %(person_id)s
-            WHERE %(prospect_person_uuids)s::uuid[] = array[]::uuid[]
-        ) AS id_table
+        id_table
     LEFT JOIN
         person AS prospect
     ON
         prospect.id = id_table.id
-    LEFT JOIN
-        skipped
+    JOIN
+        person_relationships(
+            %(person_id)s,
+            ARRAY(SELECT id FROM id_table)
+        ) AS relationship
     ON
-        subject_person_id = prospect.id
-    AND
-        object_person_id = %(person_id)s
+        relationship.other_person_id = id_table.id
 )
 SELECT
     person_id,
@@ -2151,3 +2077,28 @@ ON
 WHERE
     banned_person_admin_token.token = %(token)s
 """
+
+# Prewarmed search results may no longer match the person's search filters
+Q_DELETE_PREWARMED_SEARCH_CACHE = """
+DELETE FROM search_cache
+WHERE
+    searcher_person_id = %(person_id)s
+AND
+    is_prewarmed
+"""
+
+Q_INSERT_EMAIL_OUTBOX = """
+INSERT INTO email_outbox (
+    to_addr,
+    from_addr,
+    subject,
+    body,
+    expires_at
+) VALUES (
+    %(to_addr)s,
+    %(from_addr)s,
+    %(subject)s,
+    %(body)s,
+    NOW() + make_interval(secs => %(max_age_seconds)s::FLOAT8)
+)
+"""
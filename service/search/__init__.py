@@ -2,6 +2,52 @@ import duotypes as t
 from database import api_tx
 from typing import Tuple, Optional
 from service.search.sql import *
+import os
+
+# One of:
+#   * 'postgres' - Exact ordering of everyone within distance, in Postgres
+#   * 'ann'      - Approximate ordering via the HNSW index on `personality`
+#   * 'numpy'    - Exact ordering in memory. See `service.search.engine`
+SEARCH_ENGINE = os.environ.get('DUO_SEARCH_ENGINE', 'postgres')
+
+if SEARCH_ENGINE == 'numpy':
+    from service.search.engine import get_engine
+elif SEARCH_ENGINE not in ['postgres', 'ann']:
+    raise ValueError(f'Invalid DUO_SEARCH_ENGINE: {SEARCH_ENGINE}')
+
+# How many of the best matches the ANN first pass considers, before the
+# remaining filters and the usual ordering are applied
+ANN_CANDIDATES = int(os.environ.get('DUO_SEARCH_ANN_CANDIDATES', '2000'))
+
+# Higher values improve recall at the cost of latency
+ANN_EF_SEARCH = int(os.environ.get('DUO_SEARCH_ANN_EF_SEARCH', '100'))
+ANN_MAX_SCAN_TUPLES = int(os.environ.get(
+    'DUO_SEARCH_ANN_MAX_SCAN_TUPLES',
+    '20000',
+))
+
+# Searchers with fewer prospects than this within distance get an exact search,
+# which is cheap for them and loses nothing to approximation
+ANN_MIN_CANDIDATES = int(os.environ.get(
+    'DUO_SEARCH_ANN_MIN_CANDIDATES',
+    '5000',
+))
+
+# Uncached searches are answered from a cache prewarmed by the
+# `searchprewarm` cron module if it's younger than this. 0 disables it.
+SEARCH_CACHE_MAX_AGE_SECONDS = int(os.environ.get(
+    'DUO_SEARCH_CACHE_MAX_AGE_SECONDS',
+    '0',
+))
+
+def init_db():
+    with api_tx() as tx:
+        if SEARCH_ENGINE == 'ann':
+            # Building the index over every person can take a while
+            tx.execute('SET LOCAL statement_timeout = 300000') # 5 minutes
+            tx.execute(Q_CREATE_ANN_INDEX)
+        else:
+            tx.execute(Q_DROP_ANN_INDEX)
 
 def _quiz_search_results(searcher_person_id: int):
     params = dict(
@@ -12,7 +58,48 @@ def _quiz_search_results(searcher_person_id: int):
         return tx.execute(Q_QUIZ_SEARCH, params).fetchall()
 
 
+def _has_many_candidates(tx, searcher_person_id: int):
+    params = dict(
+        searcher_person_id=searcher_person_id,
+        ann_min_candidates=ANN_MIN_CANDIDATES,
+    )
+
+    row = tx.execute(Q_UNCACHED_SEARCH_ANN_CANDIDATE_COUNT, params).fetchone()
+
+    return row['count'] >= ANN_MIN_CANDIDATES
+
+
+def _prewarmed_search_results(searcher_person_id: int, no: Tuple[int, int]):
+    n, o = no
+
+    params = dict(
+        searcher_person_id=searcher_person_id,
+        max_age_seconds=SEARCH_CACHE_MAX_AGE_SECONDS,
+        n=n,
+        o=o,
+    )
+
+    with api_tx('READ COMMITTED') as tx:
+        if not tx.execute(Q_CLAIM_PREWARMED_SEARCH_CACHE, params).fetchone():
+            return None
+
+        return tx.execute(Q_CACHED_SEARCH, params).fetchall()
+
+
 def _uncached_search_results(searcher_person_id: int, no: Tuple[int, int]):
+    if SEARCH_CACHE_MAX_AGE_SECONDS > 0:
+        results = _prewarmed_search_results(searcher_person_id, no)
+
+        if results is not None:
+            return results
+
+    # Falls back to Postgres while the engine is still loading, or if the
+    # searcher isn't in its index yet
+    prospect_person_ids = (
+        get_engine().search(searcher_person_id)
+        if SEARCH_ENGINE == 'numpy'
+        else None)
+
     with api_tx('READ COMMITTED') as tx:
         params_1 = dict(
             searcher_person_id=searcher_person_id,
@@ -27,6 +114,23 @@ def _uncached_search_results(searcher_person_id: int, no: Tuple[int, int]):
             o=o,
         )
 
+        if prospect_person_ids is not None:
+            params_2 |= dict(prospect_person_ids=prospect_person_ids)
+
+            return tx.execute(Q_UNCACHED_SEARCH_2_FROM_IDS, params_2).fetchall()
+
+        if SEARCH_ENGINE == 'ann' and _has_many_candidates(tx, searcher_person_id):
+            params_ann = dict(
+                ef_search=str(ANN_EF_SEARCH),
+                max_scan_tuples=str(ANN_MAX_SCAN_TUPLES),
+            )
+
+            tx.execute(Q_SET_ANN_SETTINGS, params_ann)
+
+            params_2 |= dict(ann_candidates=ANN_CANDIDATES)
+
+            return tx.execute(Q_UNCACHED_SEARCH_2_ANN, params_2).fetchall()
+
         return tx.execute(Q_UNCACHED_SEARCH_2, params_2).fetchall()
 
 
@@ -0,0 +1,334 @@
+"""
+An in-memory index of every activated person's personality vector, location,
+gender, age and mutual search preferences, held in contiguous NumPy arrays.
+
+The first pass of an uncached search (the mutual gender, distance and age
+filters, the 50% match cut-off, and the ordering) is done here in one
+vectorized pass. Postgres only has to hydrate the resulting IDs. The index is
+kept current by the `search_engine` notifications sent by triggers in
+init.sql.
+
+Each API worker holds its own copy of the index, so this is opt-in via
+`DUO_SEARCH_ENGINE=numpy`.
+"""
+
+from database import api_conn
+from datetime import date
+from service.search.sql import Q_SEARCH_ENGINE_PERSONS
+import numpy as np
+import os
+import threading
+import time
+import traceback
+
+# Matches the cut-off in `Q_UNCACHED_SEARCH_2`
+FIRST_PASS_LIMIT = 500
+
+# Persons who signed up before this ID are exempt from the 50% match cut-off
+# when searching for each other
+_PRE_CUT_OFF_PERSON_ID = 10630
+
+_EARTH_RADIUS_METERS = 6371008.8
+
+_PERSONALITY_DIMENSIONS = 47
+
+_NO_AGE_PREFERENCE = np.iinfo(np.int16).max
+
+_INITIAL_CAPACITY = 1024
+
+# Pooled connections time out statements after 5 seconds, which isn't long
+# enough to load every person when the index is first built
+FULL_REFRESH_TIMEOUT_SECONDS = int(os.environ.get(
+    'DUO_SEARCH_ENGINE_FULL_REFRESH_TIMEOUT_SECONDS',
+    str(60 * 5), # 5 minutes
+))
+
+def _unit_vector(latitude: float, longitude: float):
+    lat, lon = np.radians(latitude), np.radians(longitude)
+    return np.array([
+        np.cos(lat) * np.cos(lon),
+        np.cos(lat) * np.sin(lon),
+        np.sin(lat),
+    ])
+
+def _cos_max_angle(distance_meters: float):
+    # Two points are within `distance_meters` of each other when the cosine of
+    # the angle between them is at least this. This treats the Earth as a
+    # sphere, whereas ST_DWithin uses a spheroid, so results can differ by a
+    # fraction of a percent of the distance.
+    return np.cos(min(np.pi, distance_meters / _EARTH_RADIUS_METERS))
+
+def _gender_mask(gender_ids: list[int]):
+    return sum(1 << gender_id for gender_id in set(gender_ids))
+
+def _ages(dob_year, dob_month_day, today: date):
+    return (
+        today.year - dob_year -
+        (dob_month_day > today.month * 100 + today.day)
+    )
+
+class SearchEngine:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slot_by_id: dict[int, int] = {}
+        self._free_slots: list[int] = []
+        self._club_members: dict[str, set[int]] = {}
+        self._clubs_by_id: dict[int, list[str]] = {}
+
+        self._size = 0
+        self._allocate(_INITIAL_CAPACITY)
+
+        self.is_ready = False
+
+    def _allocate(self, capacity: int):
+        def grow(old, shape, dtype):
+            new = np.zeros(shape, dtype=dtype)
+            if old is not None:
+                new[:len(old)] = old
+            return new
+
+        get = lambda name: getattr(self, name, None)
+
+        self._alive = grow(get('_alive'), capacity, np.bool_)
+        self._id = grow(get('_id'), capacity, np.int32)
+        self._personality = grow(
+            get('_personality'),
+            (capacity, _PERSONALITY_DIMENSIONS),
+            np.float32)
+        self._position = grow(get('_position'), (capacity, 3), np.float64)
+        self._cos_max_angle = grow(get('_cos_max_angle'), capacity, np.float64)
+        self._gender_id = grow(get('_gender_id'), capacity, np.int64)
+        self._gender_mask = grow(get('_gender_mask'), capacity, np.int64)
+        self._dob_year = grow(get('_dob_year'), capacity, np.int16)
+        self._dob_month_day = grow(get('_dob_month_day'), capacity, np.int16)
+        self._min_age = grow(get('_min_age'), capacity, np.int16)
+        self._max_age = grow(get('_max_age'), capacity, np.int16)
+        self._has_profile_picture_id = grow(
+            get('_has_profile_picture_id'),
+            capacity,
+            np.int16)
+
+        self._capacity = capacity
+
+    def _slot(self, person_id: int):
+        slot = self._slot_by_id.get(person_id)
+        if slot is not None:
+            return slot
+
+        if self._free_slots:
+            slot = self._free_slots.pop()
+        else:
+            if self._size == self._capacity:
+                self._allocate(2 * self._capacity)
+            slot = self._size
+            self._size += 1
+
+        self._slot_by_id[person_id] = slot
+
+        return slot
+
+    def _remove(self, person_id: int):
+        for club in self._clubs_by_id.pop(person_id, []):
+            members = self._club_members.get(club, set())
+            members.discard(person_id)
+            if not members:
+                self._club_members.pop(club, None)
+
+        slot = self._slot_by_id.pop(person_id, None)
+        if slot is not None:
+            self._alive[slot] = False
+            self._free_slots.append(slot)
+
+    def _upsert(self, row):
+        person_id = row['id']
+
+        self._remove(person_id)
+
+        slot = self._slot(person_id)
+
+        self._alive[slot] = True
+        self._id[slot] = person_id
+        self._personality[slot] = row['personality']
+        self._position[slot] = _unit_vector(row['latitude'], row['longitude'])
+        self._cos_max_angle[slot] = _cos_max_angle(
+            float(row['distance_preference']))
+        self._gender_id[slot] = row['gender_id']
+        self._gender_mask[slot] = _gender_mask(row['gender_preference'])
+        self._dob_year[slot] = row['date_of_birth'].year
+        self._dob_month_day[slot] = (
+            row['date_of_birth'].month * 100 + row['date_of_birth'].day)
+        self._min_age[slot] = (
+            row['min_age'] if row['has_age_preference']
+            else _NO_AGE_PREFERENCE)
+        self._max_age[slot] = min(row['max_age'], _NO_AGE_PREFERENCE)
+        self._has_profile_picture_id[slot] = row['has_profile_picture_id']
+
+        self._clubs_by_id[person_id] = row['clubs']
+        for club in row['clubs']:
+            self._club_members.setdefault(club, set()).add(person_id)
+
+    def refresh(self, conn, person_ids: list[int] | None = None):
+        """
+        Reloads `person_ids` from the database, or everyone when it's None.
+        """
+        params = dict(person_ids=person_ids)
+
+        if person_ids is None:
+            with conn.transaction():
+                conn.execute(
+                    'SET LOCAL statement_timeout = '
+                    f'{FULL_REFRESH_TIMEOUT_SECONDS * 1000}')
+
+                rows = conn.execute(Q_SEARCH_ENGINE_PERSONS, params).fetchall()
+        else:
+            rows = conn.execute(Q_SEARCH_ENGINE_PERSONS, params).fetchall()
+
+        if person_ids is None:
+            # Built off to the side, so searches aren't blocked while it loads
+            fresh = SearchEngine()
+            for row in rows:
+                fresh._upsert(row)
+
+            with self._lock:
+                self.__dict__.update(
+                    (k, v) for k, v in fresh.__dict__.items() if k != '_lock')
+                self.is_ready = True
+        else:
+            with self._lock:
+                for person_id in person_ids:
+                    self._remove(person_id)
+                for row in rows:
+                    self._upsert(row)
+
+    def search(self, searcher_person_id: int) -> list[int] | None:
+        """
+        Returns the IDs of the first pass of prospects for
+        `searcher_person_id`, in the same order as `Q_UNCACHED_SEARCH_2`'s
+        first pass, or None if the searcher isn't in the index.
+        """
+        today = date.today()
+
+        with self._lock:
+            if not self.is_ready:
+                return None
+
+            s = self._slot_by_id.get(searcher_person_id)
+            if s is None:
+                return None
+
+            n = self._size
+
+            ids = self._id[:n]
+            personality = self._personality[:n]
+
+            dot = personality @ self._personality[s]
+
+            searcher_age = _ages(
+                int(self._dob_year[s]),
+                int(self._dob_month_day[s]),
+                today)
+            prospect_ages = _ages(
+                self._dob_year[:n].astype(np.int32),
+                self._dob_month_day[:n],
+                today)
+
+            cos_angle = self._position[:n] @ self._position[s]
+
+            mask = (
+                self._alive[:n] &
+                (ids != searcher_person_id) &
+
+                # Mutual gender preferences
+                (((self._gender_mask[s] >> self._gender_id[:n]) & 1) == 1) &
+                (((self._gender_mask[:n] >> self._gender_id[s]) & 1) == 1) &
+
+                # Mutual distance preferences
+                (cos_angle >= self._cos_max_angle[:n]) &
+                (cos_angle >= self._cos_max_angle[s]) &
+
+                # Mutual age preferences
+                (prospect_ages >= self._min_age[s]) &
+                (prospect_ages <= self._max_age[s]) &
+                (searcher_age >= self._min_age[:n]) &
+                (searcher_age <= self._max_age[:n]) &
+
+                # The users have at least a 50% match, or both users signed
+                # up before the introduction of the 50% cut-off
+                (
+                    (dot > -1e-5) |
+                    (
+                        (ids < _PRE_CUT_OFF_PERSON_ID) &
+                        (searcher_person_id < _PRE_CUT_OFF_PERSON_ID)
+                    )
+                )
+            )
+
+            candidates = np.flatnonzero(mask)
+
+            mutual_club_ids = set().union(*(
+                self._club_members.get(club, set())
+                for club in self._clubs_by_id.get(searcher_person_id, [])
+            ))
+            has_mutual_club = np.isin(
+                ids[candidates],
+                np.fromiter(mutual_club_ids, dtype=np.int32))
+
+            # If this is changed, other queries will need changing too
+            order = np.lexsort((
+                -dot[candidates],
+                ~has_mutual_club,
+                self._has_profile_picture_id[candidates],
+            ))
+
+            return ids[candidates[order[:FIRST_PASS_LIMIT]]].tolist()
+
+def _listen_forever(engine: SearchEngine, batch_seconds: float):
+    while True:
+        try:
+            with api_conn() as conn:
+                conn.execute('LISTEN search_engine')
+
+                # Loaded after LISTENing so that no change can slip between
+                # the load and the first notification
+                engine.refresh(conn)
+
+                while True:
+                    person_ids = {
+                        int(notify.payload)
+                        for notify in conn.notifies(timeout=batch_seconds)
+                    }
+
+                    if person_ids:
+                        engine.refresh(conn, sorted(person_ids))
+        except:
+            print(traceback.format_exc())
+
+        engine.is_ready = False
+        time.sleep(5)
+
+_engine: SearchEngine | None = None
+_engine_lock = threading.Lock()
+
+def get_engine(batch_seconds: float = 1.0) -> SearchEngine:
+    """
+    Returns this process's engine, starting it if needed. It's started lazily
+    so that each gunicorn worker builds its index after forking.
+    """
+    global _engine
+
+    if _engine is not None:
+        return _engine
+
+    with _engine_lock:
+        if _engine is None:
+            engine = SearchEngine()
+
+            threading.Thread(
+                target=_listen_forever,
+                args=(engine, batch_seconds),
+                daemon=True,
+            ).start()
+
+            _engine = engine
+
+    return _engine
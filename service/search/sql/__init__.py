@@ -1,31 +1,37 @@
-Q_UNCACHED_SEARCH_1 = """
-DELETE FROM search_cache
-WHERE searcher_person_id = %(searcher_person_id)s
-"""
+from searchsql import (
+    Q_MARK_SEARCH_CACHE_PREWARMED,
+    Q_UNCACHED_SEARCH_1,
+    Q_UNCACHED_SEARCH_2,
+)
+
+def _replace_once(query: str, old: str, new: str) -> str:
+    """
+    Like `str.replace`, but fails if `old` doesn't occur in `query` exactly
+    once, so that derived queries can't silently drift from their base query
+    """
+    count = query.count(old)
+
+    if count != 1:
+        raise ValueError(f'Expected one occurrence, found {count}: {old!r}')
+
+    return query.replace(old, new)
+
+def _suffix_once(query: str, start: str) -> str:
+    """
+    Returns `query` from `start` onward, failing unless `start` occurs in
+    `query` exactly once
+    """
+    _replace_once(query, start, start)
+
+    return query[query.index(start):]
 
-Q_UNCACHED_SEARCH_2 = """
+# Used by `service.search.engine`, which has already applied the mutual
+# gender, distance, age and 50% match filters to pick, and order, the first
+# pass of up to 500 prospects
+Q_UNCACHED_SEARCH_2_FROM_IDS = """
 WITH searcher AS MATERIALIZED (
     SELECT
-        coordinates,
-        personality,
-        gender_id,
-        COALESCE(
-            (
-                SELECT
-                    1000 * distance
-                FROM
-                    person
-                JOIN
-                    search_preference_distance
-                ON
-                    person.id = person_id
-                WHERE
-                    person.id = %(searcher_person_id)s
-                LIMIT 1
-            ),
-            1e9
-        ) AS distance_preference,
-        date_of_birth
+        personality
     FROM
         person
     WHERE
@@ -82,10 +88,27 @@ WITH searcher AS MATERIALIZED (
         ) AS has_mutual_club
 
     FROM
+        UNNEST(%(prospect_person_ids)s::INT[]) AS prospect_person_id
+
+    JOIN
         person AS prospect
+    ON
+        prospect.id = prospect_person_id
 
     WHERE
         prospect.activated
+), """ + _suffix_once(Q_UNCACHED_SEARCH_2, 'prospects_second_pass AS (')
+
+Q_UNCACHED_SEARCH_ANN_CANDIDATE_COUNT = """
+SELECT
+    COUNT(*) AS count
+FROM (
+    SELECT
+        1
+    FROM
+        person AS prospect
+    WHERE
+        prospect.activated
     AND
         prospect.gender_id IN (
             SELECT
@@ -98,440 +121,163 @@ WITH searcher AS MATERIALIZED (
     AND
         ST_DWithin(
             prospect.coordinates,
-            (SELECT coordinates FROM searcher),
-            (SELECT distance_preference FROM searcher)
-        )
-    AND
-        prospect.id != %(searcher_person_id)s
-    AND
-        -- The searcher meets the prospect's gender preference
-        EXISTS (
-            SELECT 1
-            FROM search_preference_gender AS preference
-            WHERE
-                preference.person_id = prospect.id AND
-                preference.gender_id = (SELECT gender_id FROM searcher)
-            LIMIT 1
-        )
-    AND
-        -- The searcher meets the prospect's location preference
-        ST_DWithin(
-            prospect.coordinates,
-            (SELECT coordinates FROM searcher),
+            (SELECT coordinates FROM person WHERE id = %(searcher_person_id)s),
             (
-                SELECT
-                    COALESCE(
-                        (
-                            SELECT
-                                1000 * distance
-                            FROM
-                                person
-                            JOIN
-                                search_preference_distance
-                            ON
-                                person.id = person_id
-                            WHERE
-                                person.id = prospect.id
-                            LIMIT 1
-                        ),
-                        1e9
-                    )
+                SELECT search_max_distance_meters
+                FROM person
+                WHERE id = %(searcher_person_id)s
             )
         )
-    AND
-       -- The prospect meets the searcher's age preference
-       EXISTS (
-            SELECT 1
-            FROM search_preference_age AS preference
-            WHERE
-                preference.person_id = %(searcher_person_id)s
-            AND
-                prospect.date_of_birth <= (
-                    CURRENT_DATE -
-                    INTERVAL '1 year' *
-                    COALESCE(preference.min_age, 0)
-                )
-            AND
-                prospect.date_of_birth > (
-                    CURRENT_DATE -
-                    INTERVAL '1 year' *
-                    (COALESCE(preference.max_age, 999) + 1)
-                )
-            LIMIT 1
-        )
-    AND
-       -- The searcher meets the prospect's age preference
-       EXISTS (
-            SELECT 1
-            FROM search_preference_age AS preference
-            WHERE
-                preference.person_id = prospect.id
-            AND
-                (SELECT date_of_birth FROM searcher) <= (
-                    CURRENT_DATE -
-                    INTERVAL '1 year' *
-                    COALESCE(preference.min_age, 0)
-                )
-            AND
-                (SELECT date_of_birth FROM searcher) > (
-                    CURRENT_DATE -
-                    INTERVAL '1 year' *
-                    (COALESCE(preference.max_age, 999) + 1)
-                )
-            LIMIT 1
-        )
-    AND (
-            -- The users have at least a 50%% match
-            (personality <#> (SELECT personality FROM searcher)) < 1e-5
-        OR
-            -- Both users signed up before the introduction of the 50%% cut-off
-            prospect.id < 10630 AND %(searcher_person_id)s < 10630
-    )
+    LIMIT
+        %(ann_min_candidates)s
+) AS candidate
+"""
 
-    ORDER BY
-        -- If this is changed, other queries will need changing too
-        has_profile_picture_id,
-        has_mutual_club DESC,
-        negative_dot_prod
+Q_SET_ANN_SETTINGS = """
+SELECT
+    set_config('hnsw.ef_search', %(ef_search)s, true),
+    set_config('hnsw.iterative_scan', 'relaxed_order', true),
+    set_config('hnsw.max_scan_tuples', %(max_scan_tuples)s, true)
+"""
 
-    LIMIT
-        500
-), prospects_second_pass AS (
+# Like `Q_UNCACHED_SEARCH_2`, except that the first pass only considers the
+# `ann_candidates` best matches found by walking the HNSW index on
+# `person.personality`, rather than every person within distance
+Q_UNCACHED_SEARCH_2_ANN = _replace_once(
+    Q_UNCACHED_SEARCH_2,
+    """), prospects_first_pass AS (""",
+    """), ann_candidates AS MATERIALIZED (
     SELECT
-        prospect_person_id,
-        prospect_uuid,
-        (
-            SELECT uuid
-            FROM photo
-            WHERE
-                person_id = prospect_person_id
-            ORDER BY
-                position
-            LIMIT 1
-        ) AS profile_photo_uuid,
-        has_mutual_club,
-        name,
-        CASE WHEN show_my_age THEN age ELSE NULL END AS age,
-        CLAMP(0, 99, 100 * (1 - negative_dot_prod) / 2) AS match_percentage,
-        personality
+        id
     FROM
-        prospects_first_pass AS prospect
+        person AS prospect
     WHERE
-        EXISTS (
-            SELECT 1
-            FROM search_preference_orientation AS preference
-            WHERE
-                preference.person_id      = %(searcher_person_id)s AND
-                preference.orientation_id = prospect.orientation_id
-            LIMIT 1
-        )
-    AND
-        EXISTS (
-            SELECT 1
-            FROM search_preference_ethnicity AS preference
-            WHERE
-                preference.person_id      = %(searcher_person_id)s AND
-                preference.ethnicity_id   = prospect.ethnicity_id
-            LIMIT 1
-        )
-    AND
-       EXISTS (
-            SELECT 1
-            FROM search_preference_height_cm AS preference
-            WHERE
-                preference.person_id = %(searcher_person_id)s AND
-                COALESCE(preference.min_height_cm, 0)   <= COALESCE(prospect.height_cm, 0) AND
-                COALESCE(preference.max_height_cm, 999) >= COALESCE(prospect.height_cm, 999)
-            LIMIT 1
-        )
-    AND
-       EXISTS (
-            SELECT 1
-            FROM search_preference_has_profile_picture AS preference
-            WHERE
-                preference.person_id              = %(searcher_person_id)s AND
-                preference.has_profile_picture_id = prospect.has_profile_picture_id
-            LIMIT 1
-        )
-    AND
-       EXISTS (
-            SELECT 1
-            FROM search_preference_looking_for AS preference
-            WHERE
-                preference.person_id      = %(searcher_person_id)s AND
-                preference.looking_for_id = prospect.looking_for_id
-            LIMIT 1
-        )
-    AND
-       EXISTS (
-            SELECT 1
-            FROM search_preference_smoking AS preference
-            WHERE
-                preference.person_id  = %(searcher_person_id)s AND
-                preference.smoking_id = prospect.smoking_id
-            LIMIT 1
-        )
-    AND
-       EXISTS (
-            SELECT 1
-            FROM search_preference_drinking AS preference
-            WHERE
-                preference.person_id  = %(searcher_person_id)s AND
-                preference.drinking_id = prospect.drinking_id
-            LIMIT 1
-        )
-    AND
-       EXISTS (
-            SELECT 1
-            FROM search_preference_drugs AS preference
-            WHERE
-                preference.person_id = %(searcher_person_id)s AND
-                preference.drugs_id  = prospect.drugs_id
-            LIMIT 1
-        )
-    AND
-       EXISTS (
-            SELECT 1
-            FROM search_preference_long_distance AS preference
-            WHERE
-                preference.person_id         = %(searcher_person_id)s AND
-                preference.long_distance_id  = prospect.long_distance_id
-            LIMIT 1
-        )
-    AND
-       EXISTS (
-            SELECT 1
-            FROM search_preference_relationship_status AS preference
-            WHERE
-                preference.person_id               = %(searcher_person_id)s AND
-                preference.relationship_status_id  = prospect.relationship_status_id
-            LIMIT 1
-        )
-    AND
-       EXISTS (
-            SELECT 1
-            FROM search_preference_has_kids AS preference
-            WHERE
-                preference.person_id   = %(searcher_person_id)s AND
-                preference.has_kids_id = prospect.has_kids_id
-            LIMIT 1
-        )
-    AND
-       EXISTS (
-            SELECT 1
-            FROM search_preference_wants_kids AS preference
-            WHERE
-                preference.person_id     = %(searcher_person_id)s AND
-                preference.wants_kids_id = prospect.wants_kids_id
-            LIMIT 1
-        )
-    AND
-       EXISTS (
-            SELECT 1
-            FROM search_preference_exercise AS preference
-            WHERE
-                preference.person_id   = %(searcher_person_id)s AND
-                preference.exercise_id = prospect.exercise_id
-            LIMIT 1
-        )
-    AND
-       EXISTS (
-            SELECT 1
-            FROM search_preference_religion AS preference
-            WHERE
-                preference.person_id   = %(searcher_person_id)s AND
-                preference.religion_id = prospect.religion_id
-            LIMIT 1
-        )
-    AND
-       EXISTS (
-            SELECT 1
-            FROM search_preference_star_sign AS preference
-            WHERE
-                preference.person_id    = %(searcher_person_id)s AND
-                preference.star_sign_id = prospect.star_sign_id
-            LIMIT 1
-        )
-    AND
-       EXISTS (
-            (
-                SELECT 1 WHERE NOT prospect.hide_me_from_strangers
-            ) UNION ALL (
-                SELECT 1
-                FROM messaged
-                WHERE
-                    messaged.subject_person_id = prospect_person_id AND
-                    messaged.object_person_id = %(searcher_person_id)s AND
-                    prospect.hide_me_from_strangers
-                LIMIT 1
-            )
-            LIMIT 1
-        )
+        prospect.activated
     AND
-        -- The prospect did not skip the searcher
-        NOT EXISTS (
-            SELECT 1
+        prospect.gender_id IN (
+            SELECT
+                gender_id
             FROM
-                skipped
+                search_preference_gender AS preference
             WHERE
-                subject_person_id = prospect_person_id AND
-                object_person_id  = %(searcher_person_id)s
-            LIMIT 1
-        )
-    AND
-        -- The searcher did not skip the prospect, or the searcher wishes to
-        -- view skipped prospects
-        NOT EXISTS (
-            SELECT 1
-            FROM search_preference_skipped AS preference
-            JOIN skipped
-            ON
-                preference.person_id      = %(searcher_person_id)s AND
-                preference.skipped_id     = 2 AND
-                skipped.subject_person_id = %(searcher_person_id)s AND
-                skipped.object_person_id  = prospect_person_id
-            LIMIT 1
+                person_id = %(searcher_person_id)s
         )
     AND
-       NOT EXISTS (
-            SELECT 1
-            FROM search_preference_messaged AS preference
-            JOIN messaged
-            ON
-                preference.person_id       = %(searcher_person_id)s AND
-                preference.messaged_id     = 2 AND
-                messaged.subject_person_id = %(searcher_person_id)s AND
-                messaged.object_person_id  = prospect_person_id
-            LIMIT 1
+        ST_DWithin(
+            prospect.coordinates,
+            (SELECT coordinates FROM searcher),
+            (SELECT distance_preference FROM searcher)
         )
+    ORDER BY
+        personality <#> (SELECT personality FROM searcher)
+    LIMIT
+        %(ann_candidates)s
+), prospects_first_pass AS (""",
+)
+
+Q_UNCACHED_SEARCH_2_ANN = _replace_once(
+    Q_UNCACHED_SEARCH_2_ANN,
+    """    FROM
+        person AS prospect
+
+    WHERE
+        prospect.activated
+""",
+    """    FROM
+        person AS prospect
+
+    WHERE
+        prospect.id IN (SELECT id FROM ann_candidates)
     AND
-        -- NOT EXISTS an answer contrary to the searcher's preference...
-        NOT EXISTS (
-            SELECT 1
-            FROM (
-                SELECT *
-                FROM search_preference_answer
-                WHERE person_id = %(searcher_person_id)s) AS pref
-            LEFT JOIN
-                answer ans
-            ON
-                ans.person_id = prospect_person_id AND
-                ans.question_id = pref.question_id
-            WHERE
-                -- Contrary because the answer exists and is wrong
-                ans.answer IS NOT NULL AND
-                ans.answer != pref.answer
-            OR
-                -- Contrary because the answer doesn't exist but should
-                ans.answer IS NULL AND
-                pref.accept_unanswered = FALSE
-            LIMIT 1
-        )
-), updated_search_cache AS (
-    INSERT INTO search_cache (
-        searcher_person_id,
-        position,
-        prospect_person_id,
-        prospect_uuid,
-        profile_photo_uuid,
-        has_mutual_club,
-        name,
-        age,
-        match_percentage,
-        personality
-    )
-    SELECT
-        %(searcher_person_id)s,
-        ROW_NUMBER() OVER (
-            ORDER BY
-                -- If this is changed, other queries will need changing too
-                (profile_photo_uuid IS NOT NULL) DESC,
-                has_mutual_club DESC,
-                match_percentage DESC
-        ) AS position,
-        prospect_person_id,
-        prospect_uuid,
-        profile_photo_uuid,
-        has_mutual_club,
-        name,
-        age,
-        match_percentage,
-        personality
-    FROM
-        prospects_second_pass
-    RETURNING *
+        prospect.activated
+""",
 )
-SELECT
-    prospect_person_id,
-    prospect_uuid,
-    profile_photo_uuid,
-    name,
-    age,
-    match_percentage,
-    EXISTS (
-        SELECT
-            1
-        FROM
-            messaged
-        WHERE
-            subject_person_id = %(searcher_person_id)s
-        AND
-            object_person_id = prospect_person_id
-    ) AS person_messaged_prospect,
-    EXISTS (
-        SELECT
-            1
-        FROM
-            messaged
-        WHERE
-            subject_person_id = prospect_person_id
-        AND
-            object_person_id = %(searcher_person_id)s
-    ) AS prospect_messaged_person
-FROM
-    updated_search_cache
-ORDER BY
-    position
-LIMIT
-    %(n)s
+
+# Only created when DUO_SEARCH_ENGINE=ann, so that other deployments don't
+# pay to maintain it on every personality update. HNSW rather than IVFFlat
+# because it needs no training data, doesn't lose recall as people sign up,
+# and supports iterative scans, which let search filters be applied during the
+# index walk.
+Q_CREATE_ANN_INDEX = """
+CREATE INDEX IF NOT EXISTS idx__person__activated__personality
+    ON person
+    USING hnsw(personality vector_ip_ops)
+    WHERE activated
+"""
+
+Q_DROP_ANN_INDEX = """
+DROP INDEX IF EXISTS idx__person__activated__personality
+"""
+
+
+# Each prewarmed cache is served at most once, so that a searcher who searches
+# again to refresh their results gets a fresh search
+Q_CLAIM_PREWARMED_SEARCH_CACHE = """
+UPDATE
+    search_cache
+SET
+    is_prewarmed = FALSE
+WHERE
+    searcher_person_id = %(searcher_person_id)s
+AND
+    is_prewarmed
+AND
+    cached_at > NOW() - INTERVAL '1 second' * %(max_age_seconds)s
+RETURNING
+    1
 """
 
 Q_CACHED_SEARCH = """
+WITH page AS (
+    SELECT
+        page.prospect_person_id,
+        page.score,
+        page.position
+    FROM
+        search_cache,
+        UNNEST(
+            prospect_person_ids[%(o)s + 1 : %(o)s + %(n)s],
+            scores[%(o)s + 1 : %(o)s + %(n)s]
+        ) WITH ORDINALITY AS page(prospect_person_id, score, position)
+    WHERE
+        searcher_person_id = %(searcher_person_id)s
+)
 SELECT
-    prospect_person_id,
-    prospect_uuid,
-    profile_photo_uuid,
-    name,
-    age,
-    match_percentage,
-    EXISTS (
-        SELECT
-            1
-        FROM
-            messaged
+    prospect.id AS prospect_person_id,
+    prospect.uuid AS prospect_uuid,
+    (
+        SELECT uuid
+        FROM photo
         WHERE
-            subject_person_id = %(searcher_person_id)s
-        AND
-            object_person_id = prospect_person_id
-    ) AS person_messaged_prospect,
-    EXISTS (
-        SELECT
-            1
-        FROM
-            messaged
-        WHERE
-            subject_person_id = prospect_person_id
-        AND
-            object_person_id = %(searcher_person_id)s
-    ) AS prospect_messaged_person
+            person_id = prospect.id
+        ORDER BY
+            position
+        LIMIT 1
+    ) AS profile_photo_uuid,
+    prospect.name,
+    CASE
+        WHEN prospect.show_my_age
+        THEN EXTRACT(YEAR FROM AGE(prospect.date_of_birth))::SMALLINT
+        ELSE NULL
+    END AS age,
+    (page.score %% 100)::SMALLINT AS match_percentage,
+    relationship.person_messaged_other AS person_messaged_prospect,
+    relationship.other_messaged_person AS prospect_messaged_person
 FROM
-    search_cache
-WHERE
-    searcher_person_id = %(searcher_person_id)s AND
-    position >  %(o)s AND
-    position <= %(o)s + %(n)s
+    page
+JOIN
+    person AS prospect
+ON
+    prospect.id = page.prospect_person_id
+JOIN
+    person_relationships(
+        %(searcher_person_id)s,
+        ARRAY(SELECT prospect_person_id FROM page)
+    ) AS relationship
+ON
+    relationship.other_person_id = page.prospect_person_id
 ORDER BY
-    position
+    page.position
 """
 
 Q_QUIZ_SEARCH = """
@@ -543,27 +289,99 @@ WITH searcher AS (
     WHERE
         person.id = %(searcher_person_id)s
     LIMIT 1
+), best AS (
+    SELECT
+        prospect.id,
+        CLAMP(
+            0,
+            99,
+            100 * (
+                1 - (prospect.personality <#> (SELECT personality FROM searcher))
+            ) / 2
+        )::SMALLINT AS match_percentage
+    FROM
+        search_cache,
+        UNNEST(prospect_person_ids, scores) AS cached(prospect_person_id, score)
+    JOIN
+        person AS prospect
+    ON
+        prospect.id = cached.prospect_person_id
+    WHERE
+        searcher_person_id = %(searcher_person_id)s
+    ORDER BY
+        -- If this is changed, other queries will need changing too
+        cached.score / 100 DESC,
+        match_percentage DESC
+    LIMIT
+        1
 )
 SELECT
-    prospect_person_id,
-    prospect_uuid,
-    profile_photo_uuid,
-    name,
-    age,
-    CLAMP(
-        0,
-        99,
-        100 * (1 - (personality <#> (SELECT personality FROM searcher))) / 2
-    )::SMALLINT AS match_percentage
+    prospect.id AS prospect_person_id,
+    prospect.uuid AS prospect_uuid,
+    (
+        SELECT uuid
+        FROM photo
+        WHERE
+            person_id = prospect.id
+        ORDER BY
+            position
+        LIMIT 1
+    ) AS profile_photo_uuid,
+    prospect.name,
+    CASE
+        WHEN prospect.show_my_age
+        THEN EXTRACT(YEAR FROM AGE(prospect.date_of_birth))::SMALLINT
+        ELSE NULL
+    END AS age,
+    best.match_percentage
 FROM
-    search_cache
+    best
+JOIN
+    person AS prospect
+ON
+    prospect.id = best.id
+"""
+
+Q_SEARCH_ENGINE_PERSONS = """
+SELECT
+    person.id,
+    person.personality::REAL[] AS personality,
+    ST_Y(person.coordinates::GEOMETRY) AS latitude,
+    ST_X(person.coordinates::GEOMETRY) AS longitude,
+    person.gender_id,
+    person.date_of_birth,
+    person.has_profile_picture_id,
+    COALESCE(1000 * search_preference_distance.distance, 1e9)
+        AS distance_preference,
+    search_preference_age.person_id IS NOT NULL AS has_age_preference,
+    COALESCE(search_preference_age.min_age, 0) AS min_age,
+    COALESCE(search_preference_age.max_age, 999) AS max_age,
+    ARRAY(
+        SELECT gender_id
+        FROM search_preference_gender
+        WHERE person_id = person.id
+    ) AS gender_preference,
+    ARRAY(
+        SELECT club_name
+        FROM person_club
+        WHERE person_id = person.id
+    ) AS clubs
+FROM
+    person
+LEFT JOIN
+    search_preference_distance
+ON
+    search_preference_distance.person_id = person.id
+LEFT JOIN
+    search_preference_age
+ON
+    search_preference_age.person_id = person.id
 WHERE
-    searcher_person_id = %(searcher_person_id)s
-ORDER BY
-    -- If this is changed, other queries will need changing too
-    (profile_photo_uuid IS NOT NULL) DESC,
-    has_mutual_club DESC,
-    match_percentage DESC
-LIMIT
-    1
+    person.activated
+AND
+    (
+        %(person_ids)s::INT[] IS NULL
+    OR
+        person.id = ANY(%(person_ids)s::INT[])
+    )
 """
@@ -0,0 +1,92 @@
+import unittest
+from datetime import date
+from service.search.engine import SearchEngine
+import numpy as np
+
+def _row(person_id: int, **kwargs):
+    personality = np.zeros(47, dtype=np.float32)
+    personality[0] = 1
+
+    return dict(
+        id=person_id,
+        personality=personality.tolist(),
+        latitude=0.0,
+        longitude=0.0,
+        gender_id=1,
+        date_of_birth=date(1990, 1, 1),
+        has_profile_picture_id=1,
+        distance_preference=1e9,
+        has_age_preference=True,
+        min_age=0,
+        max_age=999,
+        gender_preference=[1],
+        clubs=[],
+    ) | kwargs
+
+def _engine(*rows):
+    engine = SearchEngine()
+    for row in rows:
+        engine._upsert(row)
+    engine.is_ready = True
+    return engine
+
+class Test(unittest.TestCase):
+    def test_mutual_filters(self):
+        engine = _engine(
+            _row(20000),
+            _row(20001),
+            # Searcher doesn't want this gender
+            _row(20002, gender_id=2),
+            # Prospect doesn't want the searcher's gender
+            _row(20003, gender_preference=[2]),
+            # Too far away for the prospect
+            _row(20004, latitude=1.0, distance_preference=100_000),
+            # Too young for the searcher's preference below
+            _row(20005, date_of_birth=date(2020, 1, 1)),
+            # Prospect has no age preference at all
+            _row(20006, has_age_preference=False),
+            # Less than a 50% match
+            _row(20007, personality=[-1.0] + [0.0] * 46),
+        )
+        engine._upsert(_row(20000, min_age=18))
+
+        self.assertEqual(engine.search(20000), [20001])
+
+    def test_pre_cut_off_persons_ignore_match(self):
+        engine = _engine(
+            _row(1),
+            _row(2, personality=[-1.0] + [0.0] * 46),
+        )
+
+        self.assertEqual(engine.search(1), [2])
+
+    def test_order(self):
+        engine = _engine(
+            _row(20000, clubs=['chess']),
+            _row(20001, personality=[0.5] + [0.0] * 46),
+            _row(20002, personality=[0.9] + [0.0] * 46),
+            _row(20003, personality=[0.1] + [0.0] * 46, clubs=['chess']),
+            _row(20004, has_profile_picture_id=2),
+        )
+
+        self.assertEqual(
+            engine.search(20000),
+            [20003, 20002, 20001, 20004])
+
+    def test_remove(self):
+        engine = _engine(_row(20000), _row(20001), _row(20002))
+
+        engine._remove(20001)
+
+        self.assertEqual(engine.search(20000), [20002])
+        self.assertEqual(engine.search(20001), None)
+
+    def test_not_ready(self):
+        engine = _engine(_row(20000), _row(20001))
+        engine.is_ready = False
+
+        self.assertEqual(engine.search(20000), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,358 @@
+"""
+A two-tier cache of `duo_session` lookups, in front of `require_auth`.
+
+The first tier is an in-process TTL LRU. The second tier is a Redis shared by
+every API worker, usually the same one `flask_limiter` uses. Both are off
+unless configured:
+
+  * DUO_SESSION_CACHE_LOCAL_TTL_SECONDS enables the in-process tier.
+  * DUO_SESSION_CACHE_REDIS_URL enables the Redis tier. Invalidations are also
+    published through it, so that every process drops them from its
+    in-process tier. Without it, the in-process TTL bounds how long other
+    workers might keep using an invalidated session.
+
+Entries never outlive their session's `session_expiry`, so sessions deleted by
+`Q_DELETE_EXPIRED_RECORDS` need no invalidation. Anything else which changes or
+deletes a `duo_session` row must call `invalidate`.
+
+`invalidate` leaves short-lived tombstones in both tiers, which `put` respects.
+Otherwise, a request which read a session before it was invalidated, but
+cached it afterwards, would bring it back for up to the TTL.
+"""
+
+from collections import OrderedDict
+from typing import Iterable
+import json
+import os
+import threading
+import time
+import traceback
+
+LOCAL_TTL_SECONDS = float(os.environ.get(
+    'DUO_SESSION_CACHE_LOCAL_TTL_SECONDS',
+    '0',
+))
+
+LOCAL_MAX_SIZE = int(os.environ.get(
+    'DUO_SESSION_CACHE_LOCAL_MAX_SIZE',
+    '10000',
+))
+
+REDIS_URL = os.environ.get('DUO_SESSION_CACHE_REDIS_URL', '')
+
+REDIS_TTL_SECONDS = int(os.environ.get(
+    'DUO_SESSION_CACHE_REDIS_TTL_SECONDS',
+    '300',
+))
+
+# Should exceed the time between a request reading a `duo_session` row and
+# caching it
+TOMBSTONE_SECONDS = int(os.environ.get(
+    'DUO_SESSION_CACHE_TOMBSTONE_SECONDS',
+    '30',
+))
+
+_INVALIDATION_CHANNEL = 'duo-session-cache-invalidation'
+
+if REDIS_URL:
+    import redis
+
+def _session_key(session_token_hash: str):
+    return f'duo-session:{session_token_hash}'
+
+def _person_key(person_id: int):
+    return f'duo-session-person:{person_id}'
+
+def _session_tombstone_key(session_token_hash: str):
+    return f'duo-session-tombstone:{session_token_hash}'
+
+def _person_tombstone_key(person_id: int):
+    return f'duo-session-person-tombstone:{person_id}'
+
+def _tombstone_keys(session_token_hash: str, person_id: int | None):
+    keys = [_session_tombstone_key(session_token_hash)]
+
+    if person_id is not None:
+        keys.append(_person_tombstone_key(person_id))
+
+    return keys
+
+class LocalCache:
+    def __init__(
+        self,
+        ttl_seconds: float,
+        max_size: int,
+        tombstone_seconds: float = TOMBSTONE_SECONDS,
+    ):
+        self._ttl_seconds = ttl_seconds
+        self._max_size = max_size
+        self._tombstone_seconds = tombstone_seconds
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._hashes_by_person_id: dict[int, set[str]] = {}
+
+        # Expiry times, keyed by `_tombstone_keys`. Every tombstone lives for
+        # the same time, so they're also in order of expiry.
+        self._tombstones: OrderedDict[str, float] = OrderedDict()
+
+    def _prune_tombstones(self):
+        now = time.monotonic()
+
+        while self._tombstones:
+            key, expires_at = next(iter(self._tombstones.items()))
+            if expires_at > now:
+                break
+            del self._tombstones[key]
+
+    def _add_tombstone(self, key: str):
+        self._tombstones.pop(key, None)
+        self._tombstones[key] = time.monotonic() + self._tombstone_seconds
+
+    def _remove(self, session_token_hash: str):
+        entry = self._entries.pop(session_token_hash, None)
+        if entry is None:
+            return
+
+        _, row = entry
+
+        hashes = self._hashes_by_person_id.get(row['person_id'])
+        if hashes is not None:
+            hashes.discard(session_token_hash)
+            if not hashes:
+                del self._hashes_by_person_id[row['person_id']]
+
+    def get(self, session_token_hash: str) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(session_token_hash)
+            if entry is None:
+                return None
+
+            expires_at, row = entry
+            if expires_at <= time.monotonic():
+                self._remove(session_token_hash)
+                return None
+
+            self._entries.move_to_end(session_token_hash)
+
+            return row
+
+    def put(self, session_token_hash: str, row: dict, ttl_seconds: float):
+        ttl_seconds = min(ttl_seconds, self._ttl_seconds)
+        if ttl_seconds <= 0 or self._max_size <= 0:
+            return
+
+        with self._lock:
+            self._prune_tombstones()
+
+            tombstone_keys = _tombstone_keys(
+                session_token_hash,
+                row['person_id'],
+            )
+            if any(k in self._tombstones for k in tombstone_keys):
+                return
+
+            self._remove(session_token_hash)
+
+            self._entries[session_token_hash] = (
+                time.monotonic() + ttl_seconds,
+                row,
+            )
+
+            if row['person_id'] is not None:
+                self._hashes_by_person_id.setdefault(
+                    row['person_id'],
+                    set(),
+                ).add(session_token_hash)
+
+            while len(self._entries) > self._max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(
+        self,
+        session_token_hashes: list[str],
+        person_ids: list[int],
+    ):
+        with self._lock:
+            self._prune_tombstones()
+
+            for person_id in person_ids:
+                self._add_tombstone(_person_tombstone_key(person_id))
+
+                for h in list(self._hashes_by_person_id.get(person_id, [])):
+                    self._remove(h)
+
+            for h in session_token_hashes:
+                self._add_tombstone(_session_tombstone_key(h))
+
+                self._remove(h)
+
+    def clear(self):
+        # Tombstones are kept, since they might still be needed
+        with self._lock:
+            self._entries.clear()
+            self._hashes_by_person_id.clear()
+
+_local = LocalCache(LOCAL_TTL_SECONDS, LOCAL_MAX_SIZE)
+
+_redis = (
+    redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    if REDIS_URL else None)
+
+def _listen_forever():
+    while True:
+        try:
+            pubsub = _redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(_INVALIDATION_CHANNEL)
+
+            # Invalidations might have been missed while we weren't subscribed
+            _local.clear()
+
+            for message in pubsub.listen():
+                payload = json.loads(message['data'])
+                _local.invalidate(
+                    payload['session_token_hashes'],
+                    payload['person_ids'],
+                )
+        except:
+            print(traceback.format_exc())
+
+        _local.clear()
+        time.sleep(5)
+
+_listener_started = False
+_listener_lock = threading.Lock()
+
+def _start_listener():
+    """
+    Starts this process's invalidation listener if needed. It's started lazily
+    so that each gunicorn worker subscribes after forking.
+    """
+    global _listener_started
+
+    if _listener_started or _redis is None or LOCAL_TTL_SECONDS <= 0:
+        return
+
+    with _listener_lock:
+        if not _listener_started:
+            threading.Thread(target=_listen_forever, daemon=True).start()
+            _listener_started = True
+
+def get(session_token_hash: str) -> dict | None:
+    _start_listener()
+
+    row = _local.get(session_token_hash)
+    if row is not None or _redis is None:
+        return row
+
+    try:
+        with _redis.pipeline() as pipe:
+            pipe.get(_session_key(session_token_hash))
+            pipe.pttl(_session_key(session_token_hash))
+            value, pttl = pipe.execute()
+    except redis.RedisError:
+        print(traceback.format_exc())
+        return None
+
+    if value is None:
+        return None
+
+    row = json.loads(value)
+
+    _local.put(session_token_hash, row, pttl / 1000)
+
+    return row
+
+def put(session_token_hash: str, row: dict, session_ttl_seconds: float):
+    """
+    Caches `row` for no longer than `session_ttl_seconds`, which should be the
+    time remaining until the session's `session_expiry`.
+    """
+    _local.put(session_token_hash, row, session_ttl_seconds)
+
+    if _redis is None:
+        return
+
+    ttl_seconds = int(min(session_ttl_seconds, REDIS_TTL_SECONDS))
+    if ttl_seconds <= 0:
+        return
+
+    tombstone_keys = _tombstone_keys(session_token_hash, row['person_id'])
+
+    try:
+        with _redis.pipeline() as pipe:
+            # The write is aborted if `invalidate` adds a tombstone between
+            # checking for them and writing
+            pipe.watch(*tombstone_keys)
+
+            if pipe.exists(*tombstone_keys):
+                return
+
+            pipe.multi()
+
+            pipe.set(
+                _session_key(session_token_hash),
+                json.dumps(row),
+                ex=ttl_seconds,
+            )
+
+            if row['person_id'] is not None:
+                pipe.sadd(_person_key(row['person_id']), session_token_hash)
+                pipe.expire(_person_key(row['person_id']), REDIS_TTL_SECONDS)
+
+            pipe.execute()
+    except redis.WatchError:
+        pass
+    except redis.RedisError:
+        print(traceback.format_exc())
+
+def invalidate(
+    session_token_hashes: Iterable[str] = (),
+    person_ids: Iterable[int] = (),
+):
+    """
+    Drops the given sessions, and every session belonging to the given persons,
+    from both tiers. Call this after the transaction which changed them has
+    committed.
+    """
+    session_token_hashes = list(session_token_hashes)
+    person_ids = list(person_ids)
+
+    _local.invalidate(session_token_hashes, person_ids)
+
+    if _redis is None or not (session_token_hashes or person_ids):
+        return
+
+    try:
+        with _redis.pipeline() as pipe:
+            for person_id in person_ids:
+                pipe.smembers(_person_key(person_id))
+            person_hashes = pipe.execute()
+
+        all_hashes = set(session_token_hashes).union(*person_hashes)
+
+        with _redis.pipeline() as pipe:
+            for h in session_token_hashes:
+                pipe.set(_session_tombstone_key(h), 1, ex=TOMBSTONE_SECONDS)
+
+            for person_id in person_ids:
+                pipe.set(
+                    _person_tombstone_key(person_id),
+                    1,
+                    ex=TOMBSTONE_SECONDS,
+                )
+
+            pipe.delete(
+                *[_session_key(h) for h in all_hashes],
+                *[_person_key(person_id) for person_id in person_ids],
+            )
+            pipe.publish(
+                _INVALIDATION_CHANNEL,
+                json.dumps(dict(
+                    session_token_hashes=session_token_hashes,
+                    person_ids=person_ids,
+                )),
+            )
+            pipe.execute()
+    except redis.RedisError:
+        print(traceback.format_exc())
@@ -0,0 +1,104 @@
+import unittest
+from sessioncache import LocalCache
+import time
+
+def _row(person_id: int | None):
+    return dict(
+        person_id=person_id,
+        person_uuid=None,
+        email='user@example.com',
+        signed_in=True,
+    )
+
+class Test(unittest.TestCase):
+    def test_get_and_put(self):
+        cache = LocalCache(ttl_seconds=60, max_size=10)
+
+        self.assertIsNone(cache.get('a'))
+
+        cache.put('a', _row(1), ttl_seconds=3600)
+
+        self.assertEqual(cache.get('a'), _row(1))
+
+    def test_expiry(self):
+        cache = LocalCache(ttl_seconds=60, max_size=10)
+
+        # The session expires before the cache's TTL elapses
+        cache.put('a', _row(1), ttl_seconds=0.01)
+        time.sleep(0.02)
+
+        self.assertIsNone(cache.get('a'))
+
+        # Already expired sessions aren't cached at all
+        cache.put('b', _row(1), ttl_seconds=-1)
+
+        self.assertIsNone(cache.get('b'))
+
+    def test_disabled(self):
+        cache = LocalCache(ttl_seconds=0, max_size=10)
+
+        cache.put('a', _row(1), ttl_seconds=3600)
+
+        self.assertIsNone(cache.get('a'))
+
+    def test_lru_eviction(self):
+        cache = LocalCache(ttl_seconds=60, max_size=2)
+
+        cache.put('a', _row(1), ttl_seconds=3600)
+        cache.put('b', _row(2), ttl_seconds=3600)
+
+        # Makes 'b' the least recently used
+        cache.get('a')
+
+        cache.put('c', _row(3), ttl_seconds=3600)
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+    def test_invalidate(self):
+        cache = LocalCache(ttl_seconds=60, max_size=10)
+
+        cache.put('a1', _row(1), ttl_seconds=3600)
+        cache.put('a2', _row(1), ttl_seconds=3600)
+        cache.put('b', _row(2), ttl_seconds=3600)
+        cache.put('onboardee', _row(None), ttl_seconds=3600)
+
+        cache.invalidate(session_token_hashes=[], person_ids=[1])
+
+        self.assertIsNone(cache.get('a1'))
+        self.assertIsNone(cache.get('a2'))
+        self.assertIsNotNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('onboardee'))
+
+        cache.invalidate(session_token_hashes=['onboardee'], person_ids=[])
+
+        self.assertIsNone(cache.get('onboardee'))
+        self.assertIsNotNone(cache.get('b'))
+
+    def test_put_after_invalidate(self):
+        cache = LocalCache(ttl_seconds=60, max_size=10, tombstone_seconds=0.05)
+
+        # Rows which were read before their invalidation, but are cached after
+        # it, are dropped
+        cache.invalidate(session_token_hashes=['a'], person_ids=[2])
+
+        cache.put('a', _row(1), ttl_seconds=3600)
+        cache.put('b', _row(2), ttl_seconds=3600)
+        cache.put('c', _row(3), ttl_seconds=3600)
+
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+        # Once the tombstones expire, they can be cached again
+        time.sleep(0.1)
+
+        cache.put('a', _row(1), ttl_seconds=3600)
+        cache.put('b', _row(2), ttl_seconds=3600)
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('b'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from email.mime.text import MIMEText
 import traceback
 import smtplib
 import threading
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 import os
 import time
 
@@ -11,43 +12,191 @@ SMTP_PORT = os.environ['DUO_SMTP_PORT']
 SMTP_USER = os.environ['DUO_SMTP_USER']
 SMTP_PASS = os.environ['DUO_SMTP_PASS']
 
+# Credentials are only ever sent after STARTTLS. It can only be turned off for
+# local servers, like the dev environment's, which don't support it.
+SMTP_STARTTLS = os.environ.get(
+    'DUO_SMTP_STARTTLS',
+    'true',
+).lower() not in ['false', 'f', '0', 'no']
+
+# The most connections each process holds open at once
+SMTP_POOL_SIZE = int(os.environ.get('DUO_SMTP_POOL_SIZE', '4'))
+
+# Connections are replaced after sending this many messages, before the server
+# starts rejecting them
+SMTP_MAX_MESSAGES_PER_CONNECTION = int(os.environ.get(
+    'DUO_SMTP_MAX_MESSAGES_PER_CONNECTION',
+    '100',
+))
+
+# Idle connections are sent a NOOP this often, so that the server doesn't time
+# them out. Zero disables the keep-alive.
+SMTP_KEEPALIVE_SECONDS = float(os.environ.get(
+    'DUO_SMTP_KEEPALIVE_SECONDS',
+    '30',
+))
+
+# Connections which have been idle for longer than this are closed instead of
+# being kept alive
+SMTP_MAX_IDLE_SECONDS = float(os.environ.get(
+    'DUO_SMTP_MAX_IDLE_SECONDS',
+    str(60 * 5), # 5 minutes
+))
+
+@dataclass
+class _Connection:
+    smtp: smtplib.SMTP
+    num_sent: int = 0
+    last_used: float = field(default_factory=time.monotonic)
+    last_noop: float = field(default_factory=time.monotonic)
+
 class Smtp:
-    def __init__(self, host: str, port: int, username: str, password: str):
+    """
+    A thread-safe pool of SMTP connections. Connections are opened lazily, so
+    that each forked worker opens its own.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        username: str,
+        password: str,
+        pool_size: int = SMTP_POOL_SIZE,
+        max_messages_per_connection: int = SMTP_MAX_MESSAGES_PER_CONNECTION,
+        keepalive_seconds: float = SMTP_KEEPALIVE_SECONDS,
+        max_idle_seconds: float = SMTP_MAX_IDLE_SECONDS,
+        starttls: bool = SMTP_STARTTLS,
+    ):
         self.host = host
         self.port = port
         self.username = username
         self.password = password
-        self.smtp = None
+        self.starttls = starttls
+
+        self._pool_size = max(1, pool_size)
+        self._max_messages_per_connection = max_messages_per_connection
+        self._keepalive_seconds = keepalive_seconds
+        self._max_idle_seconds = max_idle_seconds
+
+        self._lock = threading.Lock()
+        self._idle: list[_Connection] = []
+        self._slots = threading.BoundedSemaphore(self._pool_size)
+
+        self._keepalive_started = False
+
+    def _connect(self) -> _Connection:
+        print(f'Establishing connection to SMTP server at {self.host}')
 
-        self._connect()
+        smtp = smtplib.SMTP(self.host, self.port, timeout=30)
 
-    def _connect(self):
         try:
-            print(f'Establishing connection to SMTP server at {self.host}')
-            self.smtp = smtplib.SMTP(self.host, self.port)
-            self.smtp.starttls()
-            self.smtp.login(self.username, self.password)
-            print(f'Connection to SMTP server at {self.host} established')
-        except Exception as e:
-            print(f'Failed to connect to SMTP server: {e}')
-
-    def _reconnect(self):
-        if self.smtp:
-            try:
-                self.smtp.quit()
-            except Exception as e:
-                print(f'Error while quitting SMTP connection: {e}')
-        self._connect()
+            smtp.ehlo()
+
+            # Raises if the server doesn't offer STARTTLS, rather than sending
+            # the credentials in the clear
+            if self.starttls:
+                smtp.starttls()
+                smtp.ehlo()
+
+            # The dev environment's server doesn't support AUTH
+            if smtp.has_extn('auth'):
+                smtp.login(self.username, self.password)
+        except:
+            smtp.close()
+            raise
+
+        print(f'Connection to SMTP server at {self.host} established')
+
+        return _Connection(smtp=smtp)
+
+    def _disconnect(self, connection: _Connection):
+        try:
+            connection.smtp.quit()
+        except Exception:
+            connection.smtp.close()
+
+    def _acquire(self, fresh: bool) -> _Connection:
+        self._start_keepalive()
+
+        self._slots.acquire()
+
+        try:
+            with self._lock:
+                if self._idle and not fresh:
+                    return self._idle.pop()
+
+            return self._connect()
+        except:
+            self._slots.release()
+            raise
+
+    def _put_idle(self, connection: _Connection):
+        # New connections might've been opened while the keep-alive had idle
+        # ones checked out, so there can be more than the pool should hold
+        with self._lock:
+            if len(self._idle) < self._pool_size:
+                self._idle.append(connection)
+                return
+
+        self._disconnect(connection)
+
+    def _release(self, connection: _Connection, is_healthy: bool):
+        try:
+            if (
+                is_healthy and
+                connection.num_sent < self._max_messages_per_connection
+            ):
+                connection.last_used = time.monotonic()
+                self._put_idle(connection)
+            else:
+                self._disconnect(connection)
+        finally:
+            self._slots.release()
+
+    def _keepalive_once(self):
+        now = time.monotonic()
+
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for connection in idle:
+            if now - connection.last_used > self._max_idle_seconds:
+                self._disconnect(connection)
+            elif now - connection.last_noop < self._keepalive_seconds:
+                self._put_idle(connection)
+            else:
+                try:
+                    connection.smtp.noop()
+                    connection.last_noop = now
+                    self._put_idle(connection)
+                except Exception:
+                    self._disconnect(connection)
+
+    def _keepalive_forever(self):
+        while True:
+            time.sleep(self._keepalive_seconds)
 
-    def __del__(self):
-        if self.smtp:
             try:
-                self.smtp.quit()
-            except Exception as e:
-                print(f'Error while quitting SMTP connection: {e}')
+                self._keepalive_once()
+            except Exception:
+                print(traceback.format_exc())
+
+    def _start_keepalive(self):
+        if self._keepalive_started or self._keepalive_seconds <= 0:
+            return
+
+        with self._lock:
+            if not self._keepalive_started:
+                threading.Thread(
+                    target=self._keepalive_forever,
+                    daemon=True,
+                ).start()
+                self._keepalive_started = True
 
     def _try_send(
         self,
+        connection: _Connection,
         to: str,
         subject: str,
         body: str,
@@ -55,30 +204,74 @@ class Smtp:
     ):
         _from_addr = from_addr or 'no-reply@duolicious.app'
 
-        msg = MIMEMultipart('alternative')
+        msg = MIMEText(body, 'html', 'utf-8')
         msg['From'] = f'Duolicious <{_from_addr}>'
         msg['To'] = to
         msg['Subject'] = subject
-        msg.attach(MIMEText(body, 'html'))
 
-        self.smtp.sendmail(
+        connection.smtp.sendmail(
             from_addr=_from_addr,
             to_addrs=to,
             msg=msg.as_string(),
         )
 
-    def send(self, to: str, subject: str, body: str, from_addr: str | None = None):
-        try:
-            self._try_send(to=to, subject=subject, body=body, from_addr=from_addr)
-        except:
-            print(traceback.format_exc())
-            print('First attempt to send mail failed. Trying again.')
+        connection.num_sent += 1
+
+    def send(
+        self,
+        to: str,
+        subject: str,
+        body: str,
+        from_addr: str | None = None,
+    ) -> bool:
+        # Pooled connections might've been dropped by the server, so the
+        # second attempt is always made on a new one
+        for attempt, fresh in [('First', False), ('Second', True)]:
+            try:
+                connection = self._acquire(fresh=fresh)
+            except:
+                print(traceback.format_exc())
+                print(f'{attempt} attempt to connect to SMTP server failed.')
+                continue
+
             try:
-                self._connect()
-                self._try_send(to=to, subject=subject, body=body, from_addr=from_addr)
+                self._try_send(
+                    connection,
+                    to=to,
+                    subject=subject,
+                    body=body,
+                    from_addr=from_addr,
+                )
+                self._release(connection, is_healthy=True)
+                return True
             except:
                 print(traceback.format_exc())
-                print('Second attempt to send mail failed. Giving up.')
+                print(f'{attempt} attempt to send mail failed.')
+                self._release(connection, is_healthy=False)
+
+        print('Giving up sending mail.')
+        return False
+
+    def send_many(self, messages: list[dict]) -> list[bool]:
+        """
+        Sends each of `messages`, which are dicts of `send`'s arguments, over
+        as many pooled connections as are free. Returns whether each message
+        was sent.
+        """
+        if not messages:
+            return []
+
+        with ThreadPoolExecutor(
+            max_workers=min(self._pool_size, len(messages)),
+        ) as executor:
+            return list(executor.map(lambda m: self.send(**m), messages))
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for connection in idle:
+            self._disconnect(connection)
 
 aws_smtp = Smtp(
     SMTP_HOST,
@@ -0,0 +1,109 @@
+import unittest
+from smtp import Smtp
+import socket
+import time
+
+# aiosmtpd is only in test.requirements.txt, which isn't installed in the api
+# image
+try:
+    from aiosmtpd.controller import Controller
+except ImportError:
+    Controller = None
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+class Handler:
+    def __init__(self):
+        self.messages = []
+        self.peers = set()
+        self.num_noops = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        self.peers.add(session.peer)
+        return '250 OK'
+
+    async def handle_NOOP(self, server, session, envelope, arg):
+        self.num_noops += 1
+        return '250 OK'
+
+@unittest.skipIf(Controller is None, 'aiosmtpd is not installed')
+class TestSmtp(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = Handler()
+        self.controller = Controller(
+            self.handler,
+            hostname='127.0.0.1',
+            port=free_port(),
+        )
+        self.controller.start()
+
+    def tearDown(self):
+        self.controller.stop()
+
+    def make_smtp(self, **kwargs):
+        smtp = Smtp(
+            self.controller.hostname,
+            self.controller.port,
+            'unused',
+            'unused',
+            starttls=False,
+            **kwargs,
+        )
+        self.addCleanup(smtp.close)
+        return smtp
+
+    def test_send_many(self):
+        smtp = self.make_smtp(pool_size=3, max_messages_per_connection=5)
+
+        results = smtp.send_many([
+            dict(to=f'user{i}@example.com', subject='Hi', body=f'<p>{i}</p>')
+            for i in range(20)
+        ])
+
+        self.assertEqual(results, [True] * 20)
+        self.assertEqual(len(self.handler.messages), 20)
+        self.assertEqual(
+            sorted(m.rcpt_tos[0] for m in self.handler.messages),
+            sorted(f'user{i}@example.com' for i in range(20)))
+
+        # Each connection sent at most five messages
+        self.assertGreaterEqual(len(self.handler.peers), 4)
+
+    def test_connection_is_reused(self):
+        smtp = self.make_smtp(pool_size=3)
+
+        for _ in range(5):
+            self.assertTrue(smtp.send('user@example.com', 'Hi', '<p>Hi</p>'))
+
+        self.assertEqual(len(self.handler.peers), 1)
+
+    def test_keepalive(self):
+        smtp = self.make_smtp(keepalive_seconds=0.1)
+
+        self.assertTrue(smtp.send('user@example.com', 'Hi', '<p>Hi</p>'))
+
+        time.sleep(0.5)
+
+        self.assertGreater(self.handler.num_noops, 0)
+
+    def test_requires_starttls(self):
+        smtp = Smtp(
+            self.controller.hostname,
+            self.controller.port,
+            'unused',
+            'unused',
+            starttls=True,
+        )
+        self.addCleanup(smtp.close)
+
+        # The server doesn't offer STARTTLS, so nothing is sent
+        self.assertFalse(smtp.send('user@example.com', 'Hi', '<p>Hi</p>'))
+        self.assertEqual(len(self.handler.messages), 0)
+
+if __name__ == '__main__':
+    unittest.main()
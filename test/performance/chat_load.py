@@ -0,0 +1,303 @@
+"""
+A load generator for the chat proxy. It opens many concurrent websocket
+sessions against `service/chat` and replays a mix of SASL auth, push token
+registration, intros with `check_uniqueness`, and chats between a pool of
+test persons. A minimal XMPP stand-in replaces MongooseIM as the proxy's
+upstream, so only the proxy and Postgres are measured.
+
+Run it from the repo root, with the DUO_DB_* variables pointing at a local
+Postgres which has init.sql and the chat service's init.sql applied, e.g.:
+
+    DUO_DB_HOST=localhost DUO_DB_PORT=5433 \\
+    DUO_DB_USER=postgres DUO_DB_PASS=password \\
+    PYTHONPATH=. python3 test/performance/chat_load.py 2000 20
+
+The proxy is started on a free port unless `--proxy-url` gives a running one,
+in which case its upstream must already be the stand-in. DB queries per
+message are counted with pg_stat_statements, if it's loaded.
+"""
+
+from chat_relay import free_port, percentile, start_proxy, wait_until_listening
+from database import api_conn
+import argparse
+import asyncio
+import base64
+import random
+import re
+import time
+import websockets
+
+Q_INSERT_PERSONS = """
+INSERT INTO person (
+    email,
+    normalized_email,
+    name,
+    date_of_birth,
+    coordinates,
+    gender_id,
+    about,
+    unit_id
+)
+SELECT
+    'chat-load-' || n || '@example.com',
+    'chat-load-' || n || '@example.com',
+    'Chat Load ' || n,
+    '1990-01-01',
+    ST_MakePoint(0.0, 0.0),
+    1,
+    '',
+    1
+FROM
+    generate_series(1, %(n)s) AS n
+RETURNING
+    uuid::TEXT
+"""
+
+Q_INSERT_SKIPPED = """
+INSERT INTO skipped (subject_person_id, object_person_id)
+SELECT
+    subject.id,
+    object.id
+FROM
+    UNNEST(%(subject_uuids)s::UUID[], %(object_uuids)s::UUID[])
+        AS t(subject_uuid, object_uuid)
+JOIN
+    person AS subject ON subject.uuid = t.subject_uuid
+JOIN
+    person AS object ON object.uuid = t.object_uuid
+ON CONFLICT DO NOTHING
+"""
+
+Q_DELETE_PERSONS = """
+DELETE FROM person WHERE email LIKE 'chat-load-%%@example.com'
+"""
+
+Q_STATEMENT_CALLS = """
+SELECT
+    COALESCE(SUM(calls), 0)::BIGINT AS calls
+FROM
+    pg_stat_statements
+JOIN
+    pg_database
+ON
+    pg_database.oid = pg_stat_statements.dbid
+WHERE
+    datname IN ('duo_api', 'duo_chat')
+AND
+    -- Excludes this script's own queries
+    query NOT LIKE '%%pg_stat_statements%%'
+"""
+
+Q_CREATE_PG_STAT_STATEMENTS = """
+CREATE EXTENSION IF NOT EXISTS pg_stat_statements
+"""
+
+_ID_RE = re.compile(r"""\bid=['"]([^'"]+)['"]""")
+
+async def upstream(ws, path):
+    """
+    Just enough of MongooseIM for the proxy's clients to get through a session
+    """
+    async for message in ws:
+        if message.startswith('<open'):
+            await ws.send(
+                "<open xmlns='urn:ietf:params:xml:ns:xmpp-framing' "
+                "from='duolicious.app' version='1.0'/>")
+            await ws.send(
+                "<stream:features xmlns:stream='http://etherx.jabber.org/streams'>"
+                "<mechanisms xmlns='urn:ietf:params:xml:ns:xmpp-sasl'>"
+                "<mechanism>PLAIN</mechanism>"
+                "</mechanisms>"
+                "</stream:features>")
+        elif message.startswith('<auth'):
+            await ws.send("<success xmlns='urn:ietf:params:xml:ns:xmpp-sasl'/>")
+        elif message.startswith('<iq'):
+            match = _ID_RE.search(message)
+            if match:
+                await ws.send(f"<iq type='result' id='{match.group(1)}'/>")
+
+class Results:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {}
+        self.errors = 0
+
+    def record(self, kind: str, latency: float):
+        self.latencies.setdefault(kind, []).append(latency)
+
+    @property
+    def num_messages(self):
+        return sum(len(xs) for xs in self.latencies.values())
+
+def intro_body(args) -> str:
+    # A share of intros are copy-pasted, which `check_uniqueness` rejects
+    if random.random() < args.duplicate_intro_ratio:
+        return 'hey, how are you?'
+    else:
+        return f'intro {random.getrandbits(64)}'
+
+async def session(
+    url: str,
+    uuid: str,
+    uuids: list[str],
+    args,
+    results: Results,
+):
+    async with websockets.connect(url, subprotocols=['xmpp']) as ws:
+        async def request(kind: str, frame: str, is_reply):
+            start = time.perf_counter()
+            await ws.send(frame)
+            while not is_reply(await ws.recv()):
+                pass
+            results.record(kind, time.perf_counter() - start)
+
+        await request(
+            'open',
+            "<open xmlns='urn:ietf:params:xml:ns:xmpp-framing' "
+            "to='duolicious.app' version='1.0'/>",
+            lambda m: m.startswith('<stream:features'))
+
+        credentials = base64.b64encode(f'\0{uuid}\0token'.encode()).decode()
+        await request(
+            'auth',
+            "<auth xmlns='urn:ietf:params:xml:ns:xmpp-sasl' mechanism='PLAIN'>"
+            f"{credentials}"
+            "</auth>",
+            lambda m: m.startswith('<success'))
+
+        await request(
+            'register',
+            f"<duo_register_push_token token='ExponentPushToken[{uuid}]'/>",
+            lambda m: m.startswith('<duo_registration_successful'))
+
+        partners = random.sample(uuids, min(len(uuids), args.partners))
+
+        for i in range(args.messages):
+            to = random.choice(partners)
+            if to == uuid:
+                continue
+
+            is_intro = random.random() < args.intro_ratio
+            body = intro_body(args) if is_intro else f'chat {i}'
+            check_uniqueness = " check_uniqueness='true'" if is_intro else ''
+            message_id = f'{uuid}-{i}'
+
+            await request(
+                'intro' if is_intro else 'chat',
+                f"<message type='chat' from='{uuid}@duolicious.app' "
+                f"to='{to}@duolicious.app' id='{message_id}' "
+                f"xmlns='jabber:client'{check_uniqueness}>"
+                f"<body>{body}</body>"
+                f"<request xmlns='urn:xmpp:receipts'/>"
+                f"</message>",
+                lambda m: m.startswith('<duo_message_') and message_id in m)
+
+            await asyncio.sleep(random.expovariate(1 / args.think_seconds))
+
+async def run_sessions(url: str, uuids: list[str], args, results: Results):
+    async def run_session(uuid: str, delay: float):
+        await asyncio.sleep(delay)
+        try:
+            await session(url, uuid, uuids, args, results)
+        except Exception as e:
+            results.errors += 1
+            print('Session failed:', repr(e))
+
+    # Connections are ramped up over `ramp_seconds`, rather than all at once
+    await asyncio.gather(*[
+        run_session(uuid, args.ramp_seconds * i / len(uuids))
+        for i, uuid in enumerate(uuids)
+    ])
+
+def statement_calls(conn) -> int | None:
+    try:
+        conn.execute(Q_CREATE_PG_STAT_STATEMENTS)
+        return conn.execute(Q_STATEMENT_CALLS).fetchone()['calls']
+    except Exception:
+        return None
+
+async def main(args):
+    with api_conn() as conn:
+        conn.execute(Q_DELETE_PERSONS)
+        uuids = [
+            row['uuid']
+            for row in conn.execute(
+                Q_INSERT_PERSONS,
+                dict(n=args.sessions)).fetchall()
+        ]
+
+        pairs = [
+            tuple(random.sample(uuids, 2))
+            for _ in range(int(args.skipped_ratio * len(uuids)))
+        ]
+        conn.execute(
+            Q_INSERT_SKIPPED,
+            dict(
+                subject_uuids=[s for s, _ in pairs],
+                object_uuids=[o for _, o in pairs],
+            ),
+        )
+
+        upstream_server = await websockets.serve(
+            upstream,
+            '127.0.0.1',
+            args.upstream_port,
+            compression=None,
+        )
+
+        proxy = None
+        if args.proxy_url:
+            url = args.proxy_url
+        else:
+            proxy_port = free_port()
+            url = f'ws://127.0.0.1:{proxy_port}'
+            proxy = start_proxy(proxy_port, args.upstream_port, {})
+            await wait_until_listening(proxy_port)
+
+        results = Results()
+
+        try:
+            calls_before = statement_calls(conn)
+            start = time.perf_counter()
+
+            await run_sessions(url, uuids, args, results)
+
+            elapsed = time.perf_counter() - start
+            calls_after = statement_calls(conn)
+        finally:
+            if proxy:
+                proxy.terminate()
+                proxy.wait()
+            upstream_server.close()
+            conn.execute(Q_DELETE_PERSONS)
+
+    print(f'sessions: {len(uuids)}, errors: {results.errors}')
+    print(f'msgs/s: {results.num_messages / elapsed:.0f}')
+    print()
+    print('kind            n   p50 ms   p95 ms   p99 ms')
+    for kind, latencies in results.latencies.items():
+        print(
+            f'{kind:8} {len(latencies):8} '
+            f'{1000 * percentile(latencies, 0.50):8.1f} '
+            f'{1000 * percentile(latencies, 0.95):8.1f} '
+            f'{1000 * percentile(latencies, 0.99):8.1f}')
+
+    if calls_before is not None and calls_after is not None:
+        print()
+        print(
+            'DB queries per message:',
+            f'{(calls_after - calls_before) / results.num_messages:.2f}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sessions', type=int)
+    parser.add_argument('messages', type=int, help='Messages per session')
+    parser.add_argument('--partners', type=int, default=5)
+    parser.add_argument('--intro-ratio', type=float, default=0.2)
+    parser.add_argument('--duplicate-intro-ratio', type=float, default=0.1)
+    parser.add_argument('--skipped-ratio', type=float, default=0.01)
+    parser.add_argument('--think-seconds', type=float, default=0.5)
+    parser.add_argument('--ramp-seconds', type=float, default=10)
+    parser.add_argument('--upstream-port', type=int, default=5442)
+    parser.add_argument('--proxy-url')
+
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,158 @@
+"""
+Compares the chat proxy's relay throughput and latency across event loops and
+websocket settings. Each setting starts `service/chat` against a local echo
+server standing in for MongooseIM, then has many clients send frames which
+the proxy forwards without touching the database.
+
+Run it from the repo root in an environment with chat.requirements.txt
+installed, e.g.:
+
+    PYTHONPATH=. python3 test/performance/chat_relay.py 200 500
+
+Other DUO_CHAT_WS_* variables in the environment are passed to the proxy.
+"""
+
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+import websockets
+
+SETTINGS = [
+    dict(DUO_EVENT_LOOP='asyncio', DUO_CHAT_WS_PERMESSAGE_DEFLATE='false'),
+    dict(DUO_EVENT_LOOP='asyncio', DUO_CHAT_WS_PERMESSAGE_DEFLATE='true'),
+    dict(DUO_EVENT_LOOP='uvloop', DUO_CHAT_WS_PERMESSAGE_DEFLATE='false'),
+    dict(DUO_EVENT_LOOP='uvloop', DUO_CHAT_WS_PERMESSAGE_DEFLATE='true'),
+]
+
+# Frames each client keeps in flight
+WINDOW = 10
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+async def echo(ws, path):
+    async for message in ws:
+        await ws.send(message)
+
+async def serve_echo(port: int):
+    async with websockets.serve(echo, '127.0.0.1', port, compression=None):
+        await asyncio.Future()
+
+def start_proxy(port: int, upstream_port: int, setting: dict[str, str]):
+    env = dict(
+        DUO_DB_HOST='127.0.0.1',
+        DUO_DB_PORT='5432',
+        DUO_DB_USER='postgres',
+        DUO_DB_PASS='password',
+    ) | os.environ | setting | dict(
+        DUO_CHAT_UPSTREAM_URL=f'ws://127.0.0.1:{upstream_port}',
+    )
+
+    return subprocess.Popen(
+        [sys.executable, 'service/chat/__init__.py', str(port)],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+async def wait_until_listening(port: int, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with websockets.connect(f'ws://127.0.0.1:{port}'):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+async def client(port: int, num_messages: int, latencies: list[float]):
+    in_flight = asyncio.Semaphore(WINDOW)
+
+    async with websockets.connect(
+        f'ws://127.0.0.1:{port}',
+        subprotocols=['xmpp'],
+        max_queue=None,
+    ) as ws:
+        async def send():
+            for i in range(num_messages):
+                await in_flight.acquire()
+                await ws.send(f"<iq id='{i}' sent='{time.perf_counter()}'/>")
+
+        async def receive():
+            for _ in range(num_messages):
+                message = await ws.recv()
+                sent = float(message.split("sent='")[1].split("'")[0])
+                latencies.append(time.perf_counter() - sent)
+                in_flight.release()
+
+        await asyncio.gather(send(), receive())
+
+def percentile(xs: list[float], p: float):
+    return sorted(xs)[min(len(xs) - 1, int(p * len(xs)))]
+
+async def benchmark(
+    setting: dict[str, str],
+    num_clients: int,
+    num_messages: int,
+):
+    echo_port = free_port()
+    proxy_port = free_port()
+
+    echo_server = subprocess.Popen(
+        [sys.executable, __file__, '--echo', str(echo_port)])
+    proxy = start_proxy(proxy_port, echo_port, setting)
+
+    try:
+        await wait_until_listening(echo_port)
+        await wait_until_listening(proxy_port)
+
+        latencies: list[float] = []
+
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            client(proxy_port, num_messages, latencies)
+            for _ in range(num_clients)
+        ])
+        elapsed = time.perf_counter() - start
+
+        return len(latencies) / elapsed, latencies
+    finally:
+        proxy.terminate()
+        echo_server.terminate()
+        proxy.wait()
+        echo_server.wait()
+
+async def main(num_clients: int, num_messages: int):
+    print('loop     deflate     msgs/s   p50 ms   p99 ms')
+
+    for setting in SETTINGS:
+        if setting['DUO_EVENT_LOOP'] == 'uvloop':
+            try:
+                import uvloop
+            except ImportError:
+                continue
+
+        throughput, latencies = await benchmark(
+            setting,
+            num_clients,
+            num_messages,
+        )
+
+        print(
+            f"{setting['DUO_EVENT_LOOP']:8} "
+            f"{setting['DUO_CHAT_WS_PERMESSAGE_DEFLATE']:7} "
+            f'{throughput:10.0f} '
+            f'{1000 * percentile(latencies, 0.50):8.1f} '
+            f'{1000 * percentile(latencies, 0.99):8.1f}')
+
+if __name__ == '__main__':
+    if sys.argv[1] == '--echo':
+        asyncio.run(serve_echo(int(sys.argv[2])))
+    else:
+        asyncio.run(main(int(sys.argv[1]), int(sys.argv[2])))
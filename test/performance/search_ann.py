@@ -0,0 +1,104 @@
+"""
+Compares the recall and latency of the approximate (DUO_SEARCH_ENGINE=ann)
+first pass of an uncached search against the exact one, for a sample of
+searchers. Nothing is written; each search runs in a rolled-back transaction.
+
+Run it from the repo root against a populated database, e.g.:
+
+    docker compose exec api \\
+        env PYTHONPATH=. python3 test/performance/search_ann.py 200 40 100 400
+
+The API must have been started with DUO_SEARCH_ENGINE=ann, so that the HNSW
+index exists.
+"""
+
+from database import api_conn
+from service.search.sql import (
+    Q_SET_ANN_SETTINGS,
+    Q_UNCACHED_SEARCH_1,
+    Q_UNCACHED_SEARCH_2,
+    Q_UNCACHED_SEARCH_2_ANN,
+)
+import statistics
+import sys
+import time
+
+Q_SAMPLE_SEARCHERS = """
+SELECT id FROM person WHERE activated ORDER BY RANDOM() LIMIT %(n)s
+"""
+
+Q_SEARCH_CACHE_IDS = """
+SELECT UNNEST(prospect_person_ids) AS prospect_person_id
+FROM search_cache
+WHERE searcher_person_id = %(searcher_person_id)s
+"""
+
+def search(conn, searcher_person_id: int, ef_search: int | None):
+    params = dict(
+        searcher_person_id=searcher_person_id,
+        n=10,
+        o=0,
+        ann_candidates=2000,
+    )
+
+    with conn.transaction(force_rollback=True):
+        conn.execute(Q_UNCACHED_SEARCH_1, params)
+
+        start = time.perf_counter()
+        if ef_search is None:
+            conn.execute(Q_UNCACHED_SEARCH_2, params)
+        else:
+            conn.execute(
+                Q_SET_ANN_SETTINGS,
+                dict(ef_search=str(ef_search), max_scan_tuples=str(20000)))
+            conn.execute(Q_UNCACHED_SEARCH_2_ANN, params)
+        elapsed = time.perf_counter() - start
+
+        rows = conn.execute(Q_SEARCH_CACHE_IDS, params).fetchall()
+
+    return elapsed, {row['prospect_person_id'] for row in rows}
+
+def percentile(xs: list[float], p: float):
+    return sorted(xs)[min(len(xs) - 1, int(p * len(xs)))]
+
+def main(num_searchers: int, ef_searches: list[int]):
+    with api_conn() as conn:
+        searchers = [
+            row['id']
+            for row in conn.execute(
+                Q_SAMPLE_SEARCHERS,
+                dict(n=num_searchers)).fetchall()
+        ]
+
+        exact = {s: search(conn, s, None) for s in searchers}
+
+        print('mode        recall   p50 ms   p95 ms')
+
+        latencies = [elapsed for elapsed, _ in exact.values()]
+        print(
+            f'exact       {1:6.3f} '
+            f'{1000 * statistics.median(latencies):8.1f} '
+            f'{1000 * percentile(latencies, 0.95):8.1f}')
+
+        for ef_search in ef_searches:
+            latencies = []
+            recalls = []
+            for s in searchers:
+                elapsed, ids = search(conn, s, ef_search)
+                _, exact_ids = exact[s]
+
+                latencies.append(elapsed)
+                if exact_ids:
+                    recalls.append(len(ids & exact_ids) / len(exact_ids))
+
+            recall = statistics.mean(recalls) if recalls else 1
+            print(
+                f'ef={ef_search:<7} {recall:6.3f} '
+                f'{1000 * statistics.median(latencies):8.1f} '
+                f'{1000 * percentile(latencies, 0.95):8.1f}')
+
+if __name__ == '__main__':
+    num_searchers = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    ef_searches = [int(x) for x in sys.argv[2:]] or [40, 100, 200, 400]
+
+    main(num_searchers, ef_searches)
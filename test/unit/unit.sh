@@ -15,3 +15,12 @@ fi
 
 "${sudos[@]}" docker exec "$("${sudos[@]}" docker ps | grep api | cut -d ' ' -f 1)" \
   python3 -m unittest discover -s service/application
+
+"${sudos[@]}" docker exec "$("${sudos[@]}" docker ps | grep api | cut -d ' ' -f 1)" \
+  python3 -m unittest discover -s service/search
+
+"${sudos[@]}" docker exec "$("${sudos[@]}" docker ps | grep api | cut -d ' ' -f 1)" \
+  python3 -m unittest discover -s sessioncache
+
+"${sudos[@]}" docker exec "$("${sudos[@]}" docker ps | grep api | cut -d ' ' -f 1)" \
+  python3 -m unittest discover -s smtp